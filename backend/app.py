@@ -1,56 +1,107 @@
+from time import perf_counter
+_boot_started = perf_counter()
+
+import base64
+import csv
+import io
+import json
 import os
 import re
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 from functools import wraps
 from typing import Optional
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify, make_response, stream_with_context
 from flask_cors import CORS
-from pymongo import MongoClient
-from pymongo.errors import PyMongoError
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError, PyMongoError
 from bson import ObjectId
 from zoneinfo import ZoneInfo
 from dotenv import load_dotenv
 
-# Google Calendar
-from google.oauth2.credentials import Credentials
-from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
-
-# LINE push
-from linebot import LineBotApi
-from linebot.models import TextSendMessage
-from linebot.exceptions import LineBotApiError
+from archive import (ARCHIVE_BOOKINGS_AFTER_DAYS, ARCHIVE_DEADLINE_SECS, ARCHIVE_HAIR_RECORDS_AFTER_DAYS, ARCHIVE_REMINDERS_AFTER_DAYS,
+                     ARCHIVE_REMINDERS_RETENTION_DAYS, Archiver, Tier, bookings_aged, hair_records_aged,
+                     reminders_aged, union_find)
+from calsync import CalendarSync
+from catalog import ServiceCatalog
+from gcal import CalendarClient, http_status
+from idempotency import IdempotencyStore, valid_key as valid_idempotency_key
+from outbox import Outbox
+from dispatcher import REMINDER_DEADLINE_SECS, ReminderDispatcher
+from line_delivery import LineDelivery
+from live import LIVE_TICKET_SECS, LiveFeed, decode_token, issue_ticket, verify_ticket
+from availability import PENDING_HOLD_MINS, AvailabilityIndex
+from perf import StageStats, StageTimer, startup
+from ratelimit import RATE_LIMIT_STORE, Admission, LocalBucketStore, MongoBucketStore, RateLimiter, client_ip
+from scheduler import ReminderScheduler
+import metrics
+import migrations
+from mongo import Connections
+from stats import KINDS as STATS_KINDS, StatsRollup
+from serialize import LocalClock, compress_response, json_provider_class, utc_iso
+from search import SEARCH_FIELDS, customer_keys, customer_query, phone_digits, text_keys
+
+# Google Calendar / LINE SDK 在 gcal.py、line_delivery.py 第一次使用時才載入
+startup.begin(_boot_started)
+startup.mark("imports")
 
 # ----------------------------------------------------------------------------- #
 # Initialization
 # ----------------------------------------------------------------------------- #
 load_dotenv()
 app = Flask(__name__)
+app.json = json_provider_class()(app)
 
 ALLOWED_ORIGINS = os.environ.get("ALLOWED_ORIGINS", "*")
 origins = [o.strip() for o in ALLOWED_ORIGINS.split(",")] if ALLOWED_ORIGINS != "*" else "*"
-CORS(app, resources={r"/api/*": {"origins": origins}})
+CORS(app, resources={r"/api/*": {"origins": origins}}, expose_headers=["X-Next-Cursor", "Idempotent-Replayed"])
 
 MONGO_URI = os.environ.get("MONGO_URI")
 if not MONGO_URI:
     raise RuntimeError("FATAL: MONGO_URI is not set.")
-client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=5000)
-db = client.minyue_db
-client.admin.command("ping")
-
-services_col = db.services
-bookings_col = db.bookings
-users_col = db.users
-customers_col = db.customers
-hair_records_col = db.hair_records
-reminders_col = db.reminders
+# 連線在第一次查詢時才建立（每個 worker process 各自一個）；可用性由 /api/health/ready 檢查
+mongo_listener = metrics.MongoCommandListener()
+mongo = Connections(MONGO_URI, [mongo_listener])
+mongo_listener.set_explainer(
+    lambda db_name, cmd: mongo.client[db_name].command({"explain": cmd, "verbosity": "queryPlanner"}))
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+
+services_col = mongo.collection("services")
+bookings_col = mongo.collection("bookings")
+users_col = mongo.collection("users")
+customers_col = mongo.collection("customers")
+hair_records_col = mongo.collection("hair_records")
+reminders_col = mongo.collection("reminders")
+meta_col = mongo.collection("meta")
+outbox_col = mongo.collection("outbox")
+slots_col = mongo.collection("booking_slots")
+stats_col = mongo.collection("stats_rollups")
+idempotency_col = mongo.collection("idempotency_keys")
+rate_limits_col = mongo.collection("rate_limits")
+calendar_events_col = mongo.collection("calendar_events")
+# 冷資料（archive.py 搬移）
+bookings_archive_col = mongo.collection("bookings_archive")
+reminders_archive_col = mongo.collection("reminders_archive")
+hair_records_archive_col = mongo.collection("hair_records_archive")
+# 後台唯讀的列表 / 匯出 / 統計走 MONGO_ADMIN_READS（預設 secondaryPreferred）
+customers_read = mongo.collection("customers", secondary=True)
+hair_records_read = mongo.collection("hair_records", secondary=True)
+bookings_read = mongo.collection("bookings", secondary=True)
+stats_read = mongo.collection("stats_rollups", secondary=True)
+bookings_archive_read = mongo.collection("bookings_archive", secondary=True)
+hair_records_archive_read = mongo.collection("hair_records_archive", secondary=True)
+
+service_catalog = ServiceCatalog(services_col, meta_col)
 
 TAIPEI = ZoneInfo("Asia/Taipei")
+local_clock = LocalClock(TAIPEI)
+availability = AvailabilityIndex(slots_col, TAIPEI)
+stats_rollup = StatsRollup(stats_col, TAIPEI, meta_col, read_col=stats_read)
 
 LINE_CHANNEL_ACCESS_TOKEN = os.environ.get("LINE_CHANNEL_ACCESS_TOKEN")
-line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN) if LINE_CHANNEL_ACCESS_TOKEN else None
+line_delivery = LineDelivery(LINE_CHANNEL_ACCESS_TOKEN)
 
 GOOGLE_CLIENT_ID = os.environ.get("GOOGLE_CLIENT_ID")
 GOOGLE_CLIENT_SECRET = os.environ.get("GOOGLE_CLIENT_SECRET")
@@ -58,22 +109,81 @@ GOOGLE_REFRESH_TOKEN = os.environ.get("GOOGLE_REFRESH_TOKEN")
 GOOGLE_CALENDAR_ID = os.environ.get("GOOGLE_CALENDAR_ID", "primary")
 SALON_ADDRESS = os.environ.get("SALON_ADDRESS", "")
 
+google_calendar = CalendarClient(GOOGLE_CLIENT_ID, GOOGLE_CLIENT_SECRET, GOOGLE_REFRESH_TOKEN)
+# 行事曆事件（含手動加的休假 / 現場客）鏡像到 calendar_events，由 cron 增量同步
+calendar_sync = CalendarSync(calendar_events_col, meta_col, bookings_col, google_calendar, GOOGLE_CALENDAR_ID, TAIPEI)
+
 ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
 CRON_SECRET = os.environ.get("CRON_SECRET")
 MAX_ATTEMPTS = int(os.environ.get("MAX_ATTEMPTS", "5"))
 
-# 索引
-try:
-    users_col.create_index("userId", unique=True)
-    services_col.create_index([("is_active", 1), ("display_order", 1)])
-    bookings_col.create_index([("userId", 1), ("startAt", 1)])
-    bookings_col.create_index([("status", 1), ("finalStartAt", 1)])
-    reminders_col.create_index([("status", 1), ("dueAt", 1)])
-    customers_col.create_index("phone", unique=False)
-    customers_col.create_index("lineUserId", unique=False)
-    hair_records_col.create_index([("userId", 1), ("customerId", 1), ("date", 1)])
-except Exception:
-    pass
+outbox = Outbox(outbox_col, MAX_ATTEMPTS)
+archiver = Archiver(meta_col, [
+    Tier("reminders", reminders_col, reminders_archive_col, reminders_aged, ARCHIVE_REMINDERS_AFTER_DAYS,
+         retention_days=ARCHIVE_REMINDERS_RETENTION_DAYS),
+    Tier("bookings", bookings_col, bookings_archive_col, bookings_aged, ARCHIVE_BOOKINGS_AFTER_DAYS,
+         indexes=[[("startAt", 1)]]),
+    Tier("hair_records", hair_records_col, hair_records_archive_col, hair_records_aged,
+         ARCHIVE_HAIR_RECORDS_AFTER_DAYS,
+         indexes=[[("customerId", 1), ("date", -1), ("_id", -1)], [("userId", 1), ("date", -1), ("_id", -1)]]),
+])
+idempotency = IdempotencyStore(idempotency_col)
+# 公開端點限流：key 為 "方法 路由"；每條規則 "容量/秒數"，可用環境變數調整
+rate_limiter = RateLimiter(
+    LocalBucketStore() if RATE_LIMIT_STORE == "local" else MongoBucketStore(rate_limits_col),
+    {
+        "POST /api/bookings": {"user": os.environ.get("RATE_BOOKING_USER", "5/300"),
+                               "ip": os.environ.get("RATE_BOOKING_IP", "20/60")},
+        "PUT /api/users": {"user": os.environ.get("RATE_USERS_USER", "10/300"),
+                           "ip": os.environ.get("RATE_USERS_IP", "30/60")},
+        "GET /api/users/check": {"user": os.environ.get("RATE_USERS_CHECK_USER", "30/60"),
+                                 "ip": os.environ.get("RATE_USERS_CHECK_IP", "120/60")},
+    },
+    Admission(),
+)
+SERVICES_MAX_AGE = int(os.environ.get("SERVICES_MAX_AGE", "60"))
+CONFIRM_BATCH_MAX = int(os.environ.get("CONFIRM_BATCH_MAX", "100"))
+AVAILABILITY_MAX_DAYS = int(os.environ.get("AVAILABILITY_MAX_DAYS", "62"))
+CUSTOMERS_SYNC_CHUNK = int(os.environ.get("CUSTOMERS_SYNC_CHUNK", "500"))
+CUSTOMERS_SYNC_META_ID = "customers_sync"
+PAGE_DEFAULT = 200
+PAGE_MAX = 500
+EXPORT_BATCH_SIZE = int(os.environ.get("EXPORT_BATCH_SIZE", "1000"))
+
+stage_stats = StageStats()
+# 不影響回應內容的寫入（例如 customers 同步）丟到背景執行
+_background = ThreadPoolExecutor(max_workers=2, thread_name_prefix="bg")
+startup.mark("clients")
+
+# 索引規格：由 python -m migrations（或 POST /api/admin/migrate）建立，import 時不連線
+def index_specs() -> list:
+    return [
+        (users_col, [("userId", 1)], {"unique": True}),
+        (users_col, [("updatedAt", 1)], {}),
+        (services_col, [("is_active", 1), ("display_order", 1)], {}),
+        (bookings_col, [("userId", 1), ("startAt", 1)], {
+            "unique": True,
+            "partialFilterExpression": {"status": {"$in": ["pending", "confirmed"]}},
+            "name": "uniq_active_user_startAt",
+        }),
+        (bookings_col, [("status", 1), ("finalStartAt", 1)], {}),
+        (reminders_col, [("status", 1), ("dueAt", 1)], {}),
+        (customers_col, [("phone", 1)], {}),
+        (customers_col, [("phoneDigits", 1)], {}),
+        (customers_col, [("searchKeys", 1)], {}),
+        (customers_col, [("updatedAt", -1), ("_id", -1)], {}),
+        (customers_col, [("lineUserId", 1)], {}),
+        (hair_records_col, [("userId", 1), ("customerId", 1), ("date", 1)], {}),
+        (hair_records_col, [("customerId", 1), ("date", -1), ("_id", -1)], {}),
+        (hair_records_col, [("userId", 1), ("date", -1), ("_id", -1)], {}),
+    ] + outbox.indexes() + reminder_dispatcher.indexes() + availability.indexes() + stats_rollup.indexes() \
+        + idempotency.indexes() + rate_limiter.store.indexes() + calendar_sync.indexes() + archiver.indexes()
+
+# 舊的 (userId, startAt) 一般索引由唯一部分索引 uniq_active_user_startAt 取代
+LEGACY_INDEXES = [(bookings_col, "userId_1_startAt_1")]
+
+def run_migrations(dry_run: bool = False) -> dict:
+    return migrations.migrate(index_specs(), LEGACY_INDEXES, meta_col, dry_run=dry_run)
 
 # ----------------------------------------------------------------------------- #
 # Utilities
@@ -81,22 +191,21 @@ except Exception:
 def _is_valid_object_id(s: str) -> bool:
     return bool(re.fullmatch(r"[0-9a-fA-F]{24}", s))
 
+def _as_oid(v) -> Optional[ObjectId]:
+    if isinstance(v, ObjectId):
+        return v
+    return ObjectId(v) if isinstance(v, str) and ObjectId.is_valid(v) else None
+
 def _to_utc_naive(dt_aware):
     if dt_aware is None:
         return None
     return dt_aware.astimezone(timezone.utc).replace(tzinfo=None)
 
 def _to_local(dt_utc_naive):
-    if dt_utc_naive is None:
-        return None
-    return dt_utc_naive.replace(tzinfo=timezone.utc).astimezone(TAIPEI)
+    return local_clock.local(dt_utc_naive)
 
 def _iso_or_none(dt):
-    if not dt:
-        return None
-    if dt.tzinfo is None:
-        return dt.replace(tzinfo=timezone.utc).isoformat()
-    return dt.isoformat()
+    return utc_iso(dt)
 
 def _json_booking(doc: dict) -> dict:
     return {
@@ -107,22 +216,69 @@ def _json_booking(doc: dict) -> dict:
         "serviceIds": [str(x) for x in doc.get("serviceIds", [])],
         "status": doc.get("status"),
         "startAt": _iso_or_none(doc.get("startAt")),
-        "startAtLocal": _iso_or_none(_to_local(doc.get("startAt"))),
+        "startAtLocal": local_clock.local_iso(doc.get("startAt")),
         "finalStartAt": _iso_or_none(doc.get("finalStartAt")),
-        "finalStartAtLocal": _iso_or_none(_to_local(doc.get("finalStartAt"))),
+        "finalStartAtLocal": local_clock.local_iso(doc.get("finalStartAt")),
         "finalEndAt": _iso_or_none(doc.get("finalEndAt")),
-        "finalEndAtLocal": _iso_or_none(_to_local(doc.get("finalEndAt"))),
+        "finalEndAtLocal": local_clock.local_iso(doc.get("finalEndAt")),
         "calendarEventId": doc.get("calendarEventId"),
         "calendarHtmlLink": doc.get("calendarHtmlLink"),
+        # 行事曆上的事件被移動過（與最終時間不同）時由同步標記
+        "calendarMoved": bool(doc.get("calendarMoved")),
+        "calendarStartAtLocal": local_clock.local_iso(doc.get("calendarStartAt")),
         "reminderId": str(doc.get("reminderId")) if doc.get("reminderId") else None,
         "createdAt": _iso_or_none(doc.get("createdAt")),
         "updatedAt": _iso_or_none(doc.get("updatedAt")),
     }
 
+# 分頁游標：base64(JSON [值, _id])，datetime 以 {"$dt": iso} 表示
+def _encode_cursor(value, oid) -> str:
+    v = {"$dt": value.isoformat()} if isinstance(value, datetime) else value
+    raw = json.dumps([v, str(oid)], separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def _decode_cursor(cursor: Optional[str]):
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        v, oid = json.loads(raw)
+        if isinstance(v, dict) and "$dt" in v:
+            v = datetime.fromisoformat(v["$dt"])
+        return v, ObjectId(oid)
+    except Exception:
+        raise ValueError("不合法的 cursor")
+
+# 依 (field, _id) 由大到小排序時，排在游標之後的條件
+def _keyset_before(field: str, value, oid) -> dict:
+    if value is None:
+        return {field: None, "_id": {"$lt": oid}}
+    return {"$or": [
+        {field: {"$lt": value}},
+        {field: value, "_id": {"$lt": oid}},
+        {field: None},
+    ]}
+
+# 依 (field, _id) 由小到大排序時，排在游標之後的條件（field 不為 null）
+def _keyset_after(field: str, value, oid) -> dict:
+    return {"$or": [
+        {field: {"$gt": value}},
+        {field: value, "_id": {"$gt": oid}},
+    ]}
+
+def _page_limit(default: int = PAGE_DEFAULT) -> int:
+    try:
+        limit = int(request.args.get("limit", default))
+    except ValueError:
+        raise ValueError("limit 需為整數")
+    return max(1, min(limit, PAGE_MAX))
+
 def _require_admin() -> Optional[str]:
+    return _check_admin_token(request.headers.get("X-Admin-Token"))
+
+def _check_admin_token(token: Optional[str]) -> Optional[str]:
     if not ADMIN_TOKEN:
         return "後台未設定 Admin Token"
-    token = request.headers.get("X-Admin-Token")
     if token != ADMIN_TOKEN:
         return "未授權"
     return None
@@ -140,51 +296,65 @@ def verify_cron() -> bool:
     token = request.args.get("token") or request.headers.get("X-Cron-Token")
     return bool(token and CRON_SECRET and token == CRON_SECRET)
 
-# 同步 users -> customers
-def _sync_customer_from_user(user_id: str):
-    u = users_col.find_one({"userId": user_id})
-    if not u:
-        return
-    customers_col.update_one(
-        {"lineUserId": user_id},
-        {
-            "$set": {
-                "lineUserId": user_id,
-                "lineDisplayName": u.get("displayName"),
-                "phone": u.get("phone") or "",
-                "birthday": u.get("birthday") or "",
-                "updatedAt": datetime.utcnow(),
-            },
-            "$setOnInsert": {
-                "name": u.get("displayName") or "",
-                "nickname": "",
-                "note": "",
-                "createdAt": datetime.utcnow(),
-            },
+# 同步 users -> customers；已經有 user 文件時直接傳入，省一次讀取
+_CUSTOMER_SYNC_FIELDS = {"_id": 0, "displayName": 1, "phone": 1, "birthday": 1}
+
+# refresh_snapshot：名稱或電話有變動時才更新待確認預約上的顧客快照（後台列表不必再查 users）
+def _sync_customer_from_user(user_id: str, u: Optional[dict] = None, refresh_snapshot: bool = True):
+    try:
+        if u is None:
+            u = users_col.find_one({"userId": user_id}, _CUSTOMER_SYNC_FIELDS)
+        if not u:
+            return
+        _upsert_customer(user_id, u)
+        if refresh_snapshot:
+            bookings_col.update_many({"userId": user_id, "status": "pending"},
+                                     {"$set": {"userSnapshot": _user_snapshot(u)}})
+    except PyMongoError as e:
+        print(f"[SYNC] customer sync error ({user_id}): {e}")
+
+def _user_snapshot(u: dict) -> dict:
+    return {"displayName": u.get("displayName"), "phone": u.get("phone")}
+
+# 由更新前的 user（ReturnDocument.BEFORE）與 $set 欄位算出更新後的同步欄位，
+# 並判斷顧客快照是否改變；新使用者不會有待確認預約
+def _profile_after(before: Optional[dict], fields: dict) -> tuple:
+    u = {**(before or {}), **{k: fields[k] for k in _CUSTOMER_SYNC_FIELDS if k != "_id" and k in fields}}
+    return u, before is not None and _user_snapshot(before) != _user_snapshot(u)
+
+# 搜尋鍵以 $addToSet 累加 LINE 名稱的鍵（新建時 name 也等於 LINE 名稱）；
+# 後台編輯顧客時會整份重算
+def _customer_sync_update(user_id: str, u: dict) -> dict:
+    return {
+        "$set": {
+            "lineUserId": user_id,
+            "lineDisplayName": u.get("displayName"),
+            "phone": u.get("phone") or "",
+            "phoneDigits": phone_digits(u.get("phone")),
+            "birthday": u.get("birthday") or "",
+            "updatedAt": datetime.utcnow(),
         },
-        upsert=True,
-    )
+        "$addToSet": {"searchKeys": {"$each": text_keys(u.get("displayName"))}},
+        "$setOnInsert": {
+            "name": u.get("displayName") or "",
+            "nickname": "",
+            "note": "",
+            "createdAt": datetime.utcnow(),
+        },
+    }
+
+def _upsert_customer(user_id: str, u: dict):
+    customers_col.update_one({"lineUserId": user_id}, _customer_sync_update(user_id, u), upsert=True)
 
 # ----------------------------------------------------------------------------- #
 # Google Calendar helpers
 # ----------------------------------------------------------------------------- #
 def _calendar_service():
-    if not (GOOGLE_CLIENT_ID and GOOGLE_CLIENT_SECRET and GOOGLE_REFRESH_TOKEN):
-        raise RuntimeError("Google OAuth 環境變數未設定完全")
-    creds = Credentials(
-        None,
-        refresh_token=GOOGLE_REFRESH_TOKEN,
-        token_uri="https://oauth2.googleapis.com/token",
-        client_id=GOOGLE_CLIENT_ID,
-        client_secret=GOOGLE_CLIENT_SECRET,
-        scopes=["https://www.googleapis.com/auth/calendar"],
-    )
-    if not creds.valid and creds.refresh_token:
-        creds.refresh(Request())
-    return build("calendar", "v3", credentials=creds)
+    return google_calendar.service()
 
-def create_calendar_event(summary: str, description: str, start_local, end_local):
-    svc = _calendar_service()
+# 預約建立的事件帶 extendedProperties.private.bookingId，行事曆鏡像據此排除（時段已由 booking_slots 佔用）
+def _calendar_event_body(summary: str, description: str, start_local, end_local,
+                         event_id: Optional[str] = None, booking_id=None) -> dict:
     body = {
         "summary": summary,
         "description": description,
@@ -192,22 +362,175 @@ def create_calendar_event(summary: str, description: str, start_local, end_local
         "end":   {"dateTime": end_local.isoformat(),   "timeZone": "Asia/Taipei"},
         "location": SALON_ADDRESS or None,
     }
-    ev = svc.events().insert(calendarId=GOOGLE_CALENDAR_ID, body=body, sendUpdates="none").execute()
+    if event_id:
+        body["id"] = event_id
+    if booking_id:
+        body["extendedProperties"] = {"private": {"bookingId": str(booking_id)}}
+    return body
+
+def create_calendar_event(summary: str, description: str, start_local, end_local,
+                          event_id: Optional[str] = None, booking_id=None):
+    svc = _calendar_service()
+    # 指定 event id 讓重試具冪等性：已建立過就會回 409，改讀既有事件
+    body = _calendar_event_body(summary, description, start_local, end_local, event_id, booking_id)
+    try:
+        ev = google_calendar.execute(
+            svc.events().insert(calendarId=GOOGLE_CALENDAR_ID, body=body, sendUpdates="none"), "events.insert")
+    except Exception as he:
+        if not (event_id and http_status(he) == 409):
+            raise
+        ev = google_calendar.execute(
+            svc.events().get(calendarId=GOOGLE_CALENDAR_ID, eventId=event_id), "events.get")
     return ev.get("id"), ev.get("htmlLink")
 
 # ----------------------------------------------------------------------------- #
 # LINE push
 # ----------------------------------------------------------------------------- #
-def send_line_push(user_id: str, message: str) -> bool:
-    if not line_bot_api:
-        print("[LINE] LINE_CHANNEL_ACCESS_TOKEN 未設定，跳過推播")
-        return False
-    try:
-        line_bot_api.push_message(user_id, TextSendMessage(text=message))
-        return True
-    except LineBotApiError as e:
-        print(f"[LINE] push error: {e}")
+def send_line_push(user_id: str, message: str, retry_key: Optional[str] = None) -> bool:
+    return line_delivery.push(user_id, message, retry_key=retry_key)
+
+# ----------------------------------------------------------------------------- #
+# Outbox handlers
+# ----------------------------------------------------------------------------- #
+@outbox.handler("line_push")
+def _outbox_line_push(job: dict):
+    p = job["payload"]
+    if not LINE_CHANNEL_ACCESS_TOKEN:
+        # 未設定 token 時重試也不會成功，直接結束工作
+        return {"skipped": True}
+    retry_key = str(uuid.uuid5(uuid.NAMESPACE_OID, job["idemKey"]))
+    if not send_line_push(p["userId"], p["message"], retry_key=retry_key):
+        raise RuntimeError("LINE push 失敗")
+    return {"retryKey": retry_key}
+
+@outbox.handler("calendar_event")
+def _outbox_calendar_event(job: dict):
+    p = job["payload"]
+    event_id, event_link = create_calendar_event(
+        p["summary"], p["description"], _to_local(p["startAt"]), _to_local(p["endAt"]),
+        event_id=str(job["_id"]), booking_id=p["bookingId"],
+    )
+    # 只回寫仍是同一個最終時間的預約，避免舊工作覆蓋重新確認後的結果
+    bookings_col.update_one(
+        {"_id": p["bookingId"], "finalStartAt": p["startAt"]},
+        {"$set": {"calendarEventId": event_id, "calendarHtmlLink": event_link, "updatedAt": datetime.utcnow()}},
+    )
+    return {"calendarEventId": event_id, "calendarHtmlLink": event_link}
+
+# 提醒推播：同一則提醒重送時帶相同 retry key，LINE 端不會重複發送
+def _reminder_retry_key(r: dict) -> str:
+    return str(uuid.uuid5(uuid.NAMESPACE_OID, f"reminder:{r['_id']}"))
+
+def _send_reminder(r: dict) -> bool:
+    if r.get("channel") != "line" or not r.get("userId") or not r.get("message"):
         return False
+    return send_line_push(r["userId"], r["message"], retry_key=_reminder_retry_key(r))
+
+# 同一批裡內容相同的提醒（例如同一時段）合併成 multicast
+def _send_reminders(batch: list, pool) -> list:
+    items = [
+        (r["_id"], r["userId"], r["message"], _reminder_retry_key(r))
+        for r in batch
+        if r.get("channel") == "line" and r.get("userId") and r.get("message")
+    ]
+    sent = line_delivery.deliver(items, "reminders", pool=pool)
+    return [sent.get(r["_id"], False) for r in batch]
+
+reminder_dispatcher = ReminderDispatcher(reminders_col, _send_reminder, MAX_ATTEMPTS, send_batch=_send_reminders)
+
+# 派送一輪並記錄提醒結果；cron 與排程器共用（cron_dispatch_* 只由 cron 路由記錄）
+def _dispatch_reminders(max_items: Optional[int] = None, deadline: float = REMINDER_DEADLINE_SECS) -> dict:
+    stats = reminder_dispatcher.dispatch(max_items=max_items, deadline_secs=deadline)
+    for outcome in ("sent", "retried", "failed"):
+        if stats[outcome]:
+            metrics.REMINDERS.inc(stats[outcome], outcome=outcome)
+    return stats
+
+# 到期時間一到就派送（leader 才會排程）；cron 仍可補派漏掉的
+reminder_scheduler = ReminderScheduler(reminders_col, meta_col, lambda deadline: _dispatch_reminders(deadline=deadline))
+
+@outbox.handler("line_broadcast")
+def _outbox_line_broadcast(job: dict):
+    p = job["payload"]
+    items = [(u, u, p["text"], None) for u in p["userIds"]]
+    sent = line_delivery.deliver(items, job["idemKey"])
+    failed = [u for u, ok in sent.items() if not ok]
+    if failed:
+        # 重試時已送出的 multicast / push 會因 retry key 相同而被 LINE 擋下，不會重複
+        raise RuntimeError(f"{len(failed)} / {len(items)} 位推播失敗")
+    return {"sent": len(items)}
+
+@app.before_request
+def _start_outbox_worker():
+    if outbox.autostart:
+        outbox.start()
+    if reminder_scheduler.autostart:
+        reminder_scheduler.start()
+
+# 路由耗時直方圖：以路由樣板（/api/admin/customers/<cid>）為 label，避免 label 爆量
+@app.before_request
+def _start_request_timer():
+    g.request_started = perf_counter()
+    metrics.set_route(request.url_rule.rule if request.url_rule else "unmatched")
+
+# 公開端點：先過 admission / 限流，才做任何 DB 工作
+def _rate_limit_user_id(route: str) -> Optional[str]:
+    if route == "GET /api/users/check":
+        return request.args.get("userId")
+    data = request.get_json(force=True, silent=True)
+    if not isinstance(data, dict):
+        return None
+    if route == "POST /api/bookings":
+        return (data.get("userProfile") or {}).get("userId")
+    return data.get("userId")
+
+@app.before_request
+def _admit_public_request():
+    route = f"{request.method} {request.url_rule.rule}" if request.url_rule else None
+    if not route or not rate_limiter.limited(route):
+        return None
+    ip = client_ip(request.headers.get("X-Forwarded-For"), request.remote_addr)
+    rejected = rate_limiter.check(route, _rate_limit_user_id(route), ip)
+    if rejected:
+        status, msg, retry_after = rejected
+        return jsonify({"error": msg}), status, {"Retry-After": str(retry_after)}
+    g.admitted = True
+    return None
+
+@app.teardown_request
+def _leave_public_request(exc):
+    if g.pop("admitted", False):
+        rate_limiter.leave()
+
+@app.after_request
+def _observe_request(resp):
+    started = g.pop("request_started", None)
+    if started is not None:
+        metrics.HTTP_DURATION.observe(
+            perf_counter() - started,
+            method=request.method,
+            route=request.url_rule.rule if request.url_rule else "unmatched",
+            status=resp.status_code,
+        )
+    metrics.set_route(None)
+    return resp
+
+# 後台列表 / 匯出等大回應依 Accept-Encoding 壓縮（串流回應不處理）
+@app.after_request
+def _compress_admin_response(resp):
+    if request.path.startswith("/api/admin/"):
+        return compress_response(resp, request.headers.get("Accept-Encoding", ""))
+    return resp
+
+# Idempotency-Key 的檢查結果 -> (body, status, headers)；None 表示這次要實際處理
+def _idempotency_outcome(state: str, doc: Optional[dict]) -> Optional[tuple]:
+    if state == "replay":
+        return doc["body"], doc["status"], {"Idempotent-Replayed": "true"}
+    if state == "in_progress":
+        return {"error": "相同的請求正在處理中，請稍後再試"}, 409, {"Retry-After": "1"}
+    if state == "mismatch":
+        return {"error": "Idempotency-Key 已用於不同的預約內容"}, 422, {}
+    return None
 
 # ----------------------------------------------------------------------------- #
 # Validators
@@ -244,9 +567,168 @@ def _validate_booking_payload(payload: dict) -> Optional[str]:
 
     return None
 
+def _parse_availability_range(args):
+    from_day = args.get("from", "")
+    to_day = args.get("to", "") or from_day
+    if not re.fullmatch(r"\d{4}-\d{2}-\d{2}", from_day) or not re.fullmatch(r"\d{4}-\d{2}-\d{2}", to_day):
+        return None, None, "from / to 需為 YYYY-MM-DD"
+    try:
+        span = (datetime.strptime(to_day, "%Y-%m-%d") - datetime.strptime(from_day, "%Y-%m-%d")).days
+    except ValueError:
+        return None, None, "不合法的日期"
+    if span < 0 or span > AVAILABILITY_MAX_DAYS:
+        return None, None, f"查詢區間需在 {AVAILABILITY_MAX_DAYS} 天內"
+    return from_day, to_day, None
+
+# 行事曆上的忙碌事件（本機鏡像），轉成當地時間區間給 availability 合併
+def _calendar_blocks(from_day: str, to_day: str) -> list:
+    start, end = availability.day_bounds(from_day, to_day)
+    return [(_to_local(e["start"]), _to_local(e["end"]))
+            for e in calendar_sync.busy_events(_to_utc_naive(start), _to_utc_naive(end))]
+
+def _availability_body(busy: dict) -> dict:
+    return {"slotMins": availability.slot_mins, "holdMins": PENDING_HOLD_MINS, "busy": busy}
+
+# ----------------------------------------------------------------------------- #
+# Booking creation helpers（同步 Flask 與 asgi.py 共用）
+# ----------------------------------------------------------------------------- #
+def _user_profile_update(up: dict) -> dict:
+    return {
+        "$set": {
+            "displayName": up.get("displayName"),
+            "pictureUrl": up.get("pictureUrl"),
+            "updatedAt": datetime.utcnow(),
+        },
+        "$setOnInsert": {"createdAt": datetime.utcnow()},
+    }
+
+def _booking_start_local(date: str, time: str):
+    y, m, d = map(int, date.split("-"))
+    hh, mm = map(int, time.split(":"))
+    return datetime(y, m, d, hh, mm, tzinfo=TAIPEI)
+
+def _booking_doc(rid, user_id: str, date: str, time: str, start_utc_naive, svc_oids: list,
+                 u: Optional[dict], found: list) -> dict:
+    return {
+        "_id": rid,
+        "userId": user_id,
+        "date": date,
+        "time": time,
+        "startAt": start_utc_naive,
+        "serviceIds": svc_oids,
+        # 寫入當下的顧客與服務名稱快照，待確認列表直接讀取
+        "userSnapshot": _user_snapshot(u or {}),
+        "serviceNames": [s["name"] for s in found],
+        "status": "pending",
+        "createdAt": datetime.utcnow(),
+        "updatedAt": datetime.utcnow(),
+    }
+
+def _booking_received_message(date: str, time: str, found: list) -> str:
+    svc_names = "、".join(s["name"] for s in found)
+    return f"已收到您的預約申請：{date} {time}（{svc_names}）。我們將盡快與您確認最終時間。"
+
+# ----------------------------------------------------------------------------- #
+# Booking confirmation helpers
+# ----------------------------------------------------------------------------- #
+def _parse_confirm_times(data: dict):
+    # 回傳 (final_start_local, final_end_local, error)
+    try:
+        duration = int(data.get("durationMins", 90))
+        if duration <= 0 or duration > 8 * 60:
+            return None, None, "不合法的 durationMins"
+    except Exception:
+        return None, None, "不合法的 durationMins"
+
+    final_start_str = (data.get("finalStart") or "").strip()
+    final_datetime_iso = (data.get("final_datetime") or "").strip()
+    final_date = (data.get("finalDate") or "").strip()
+    final_time = (data.get("finalTime") or "").strip()
+
+    try:
+        if final_start_str:
+            if "T" not in final_start_str:
+                return None, None, "finalStart 需為 YYYY-MM-DDTHH:MM"
+            ymd, hm = final_start_str.split("T")
+            y, m, d = map(int, ymd.split("-"))
+            hh, mm = map(int, hm.split(":"))
+            final_start_local = datetime(y, m, d, hh, mm, tzinfo=TAIPEI)
+        elif final_datetime_iso:
+            try:
+                iso = final_datetime_iso.replace("Z", "+00:00")
+                dt_aware = datetime.fromisoformat(iso)
+                final_start_local = dt_aware.astimezone(TAIPEI)
+            except Exception:
+                return None, None, "final_datetime 格式不合法（需 ISO 8601）"
+        else:
+            if not final_date or not final_time:
+                return None, None, "需提供 finalStart 或 final_datetime 或 finalDate+finalTime"
+            y, m, d = map(int, final_date.split("-"))
+            hh, mm = map(int, final_time.split(":"))
+            final_start_local = datetime(y, m, d, hh, mm, tzinfo=TAIPEI)
+    except ValueError:
+        return None, None, "不合法的日期或時間"
+
+    return final_start_local, final_start_local + timedelta(minutes=duration), None
+
+def _confirm_event_text(b: dict, user: dict):
+    svc_names = "、".join(service_catalog.names(b.get("serviceIds", []))) or "服務"
+    summary = f"顧客預約：{user.get('displayName') or 'LINE 使用者'} - {svc_names}"
+    desc_lines = [
+        f"顧客：{user.get('displayName') or ''}",
+        f"LINE ID：{b.get('userId') or ''}",
+        f"電話：{user.get('phone') or ''}",
+        f"項目：{svc_names}",
+    ]
+    return summary, "\n".join(desc_lines)
+
+def _reminder_doc(b: dict, final_start_local) -> Optional[dict]:
+    due_local = final_start_local - timedelta(hours=2)
+    if due_local <= datetime.now(tz=TAIPEI):
+        return None
+    msg = f"溫馨提醒：您在『茗月髮型設計』的預約將於 {final_start_local.strftime('%m/%d %H:%M')} 開始，期待您的光臨！"
+    return {
+        "_id": ObjectId(),
+        "bookingId": b["_id"],
+        "userId": b.get("userId"),
+        "channel": "line",
+        "message": msg,
+        "dueAt": _to_utc_naive(due_local),
+        "status": "scheduled",
+        "attempts": 0,
+        "createdAt": datetime.utcnow(),
+        "updatedAt": datetime.utcnow()
+    }
+
+def _enqueue_calendar_event(booking_id, summary: str, description: str, start_utc, end_utc):
+    outbox.enqueue("calendar_event", {
+        "bookingId": booking_id,
+        "summary": summary,
+        "description": description,
+        "startAt": start_utc,
+        "endAt": end_utc,
+    }, f"calendar:{booking_id}:{start_utc.isoformat()}")
+
 # ----------------------------------------------------------------------------- #
 # Public Routes
 # ----------------------------------------------------------------------------- #
+# 統計彙總寫入失敗不影響主流程；數字可用 /api/admin/stats/rebuild 重算
+def _record_confirmations(items: list, confirmed_at):
+    try:
+        stats_rollup.record_confirmations([
+            (b, start_local, service_catalog.names([sid for sid in b.get("serviceIds") or [] if isinstance(sid, ObjectId)]))
+            for b, start_local in items
+        ], confirmed_at)
+    except PyMongoError as e:
+        print(f"[STATS] record confirmations error: {e}")
+
+def _service_names_by_id(oids: list) -> dict:
+    return {s["_id"]: s["name"] for s in service_catalog.lookup([x for x in oids if isinstance(x, ObjectId)])}
+
+def rebuild_stats() -> dict:
+    return stats_rollup.rebuild([hair_records_col, hair_records_archive_col], [bookings_col, bookings_archive_col],
+                                _service_names_by_id)
+
 @app.route("/")
 def index():
     return "茗月髮型設計 - API 伺服器已啟動！"
@@ -254,17 +736,33 @@ def index():
 @app.route("/api/services", methods=["GET"])
 def get_services():
     try:
-        cursor = services_col.find(
-            {"is_active": True},
-            {"name": 1, "price": 1, "display_order": 1}
-        ).sort("display_order", 1)
-        services = [{"_id": str(s["_id"]), "name": s["name"], "price": s.get("price", 0)} for s in cursor]
-        return jsonify(services), 200
+        etag, active = service_catalog.snapshot()
+        services = [{"_id": str(s["_id"]), "name": s["name"], "price": s["price"]} for s in active]
+        resp = jsonify(services)
+        resp.set_etag(etag)
+        resp.headers["Cache-Control"] = f"public, max-age={SERVICES_MAX_AGE}"
+        return resp.make_conditional(request)
     except PyMongoError as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route("/api/bookings", methods=["POST"])
 def create_booking():
+    timer = StageTimer("create_booking", stage_stats)
+    idem_key = request.headers.get("Idempotency-Key")
+    idem_scope = None
+
+    def done(body, status):
+        # 有帶 Idempotency-Key 時保存結果（5xx 不保存，讓重送重跑）
+        if idem_scope:
+            try:
+                if status < 500:
+                    idempotency.finish(idem_scope, idem_key, status, body)
+                else:
+                    idempotency.release(idem_scope, idem_key)
+            except PyMongoError:
+                pass
+        return timer.finish(make_response(jsonify(body), status))
+
     try:
         payload = request.get_json(force=True)
     except Exception:
@@ -273,6 +771,8 @@ def create_booking():
     err = _validate_booking_payload(payload)
     if err:
         return jsonify({"error": err}), 400
+    if idem_key is not None and not valid_idempotency_key(idem_key):
+        return jsonify({"error": "Idempotency-Key 格式不正確"}), 400
 
     up = payload["userProfile"]
     user_id = up["userId"]
@@ -280,64 +780,104 @@ def create_booking():
     time = payload["time"]
     svc_ids = list(dict.fromkeys(payload["serviceIds"]))
 
-    # upsert 使用者
-    users_col.update_one(
-        {"userId": user_id},
-        {
-            "$set": {
-                "displayName": up.get("displayName"),
-                "pictureUrl": up.get("pictureUrl"),
-                "updatedAt": datetime.utcnow(),
-            },
-            "$setOnInsert": {"createdAt": datetime.utcnow()},
-        },
-        upsert=True,
-    )
-    # 同步到 customers
-    _sync_customer_from_user(user_id)
+    # 重送的請求：一次 _id 查詢就回傳第一次的結果，不再 upsert 使用者 / 佔時段 / 推播
+    if idem_key:
+        try:
+            state, doc = idempotency.begin(f"bookings:{user_id}", idem_key, payload)
+        except PyMongoError as e:
+            return jsonify({"error": str(e)}), 500
+        outcome = _idempotency_outcome(state, doc)
+        if outcome:
+            body, status, headers = outcome
+            return jsonify(body), status, headers
+        idem_scope = f"bookings:{user_id}"
+        timer.mark("idempotency")
+
+    try:
+        return _create_booking(up, user_id, date, time, svc_ids, timer, done)
+    except Exception as e:
+        # 未預期的錯誤也要經過 done() 釋放 Idempotency-Key，否則重送會在整個租約期間收到 409
+        print(f"[BOOKING] create error ({user_id}): {e}")
+        return done({"error": str(e)}, 500)
 
-    # 驗證服務
+# create_booking 在 Idempotency-Key 檢查之後的流程；所有回應都經過 done()
+def _create_booking(up: dict, user_id: str, date: str, time: str, svc_ids: list, timer, done):
+    # 驗證服務（記憶體快取）
     svc_oids = [ObjectId(x) for x in svc_ids]
-    found = list(services_col.find({"_id": {"$in": svc_oids}, "is_active": True}, {"_id": 1}))
+    found = service_catalog.lookup(svc_oids, active_only=True)
     if len(found) != len(svc_oids):
-        return jsonify({"error": "包含不存在或未啟用的服務項目"}), 400
+        return done({"error": "包含不存在或未啟用的服務項目"}, 400)
+    timer.mark("validate")
 
-    y, m, d = map(int, date.split("-"))
-    hh, mm = map(int, time.split(":"))
-    start_local = datetime(y, m, d, hh, mm, tzinfo=TAIPEI)
+    # upsert 使用者並取回更新前的文件，同步 customers 時不必再讀一次
+    try:
+        profile = _user_profile_update(up)
+        before = users_col.find_one_and_update(
+            {"userId": user_id},
+            profile,
+            upsert=True,
+            return_document=ReturnDocument.BEFORE,
+            projection=_CUSTOMER_SYNC_FIELDS,
+        )
+    except PyMongoError as e:
+        return done({"error": str(e)}, 500)
+    u, snapshot_changed = _profile_after(before, profile["$set"])
+    timer.mark("user")
+    # 同步到 customers：移到背景執行，不佔回應時間
+    _background.submit(_sync_customer_from_user, user_id, u, snapshot_changed)
+
+    start_local = _booking_start_local(date, time)
     start_utc_naive = _to_utc_naive(start_local)
 
-    dup = bookings_col.find_one({
-        "userId": user_id,
-        "startAt": start_utc_naive,
-        "status": {"$in": ["pending", "confirmed"]},
-    })
-    if dup:
-        return jsonify({"error": "同一時段已有未完成的預約"}), 409
-
-    try:
-        rid = bookings_col.insert_one({
-            "userId": user_id,
-            "date": date,
-            "time": time,
-            "startAt": start_utc_naive,
-            "serviceIds": svc_oids,
-            "status": "pending",
-            "createdAt": datetime.utcnow(),
-            "updatedAt": datetime.utcnow(),
-        }).inserted_id
+    # 行事曆上手動排的休假 / 現場客（本機鏡像，一次索引查詢）
+    end_local = start_local + timedelta(minutes=PENDING_HOLD_MINS)
+    if calendar_sync.overlaps(start_utc_naive, _to_utc_naive(end_local)):
+        return done({"error": "此時段已被預約，請選擇其他時間"}, 409)
+
+    # 先佔用時段（唯一索引保證不會與其他顧客重疊），再寫入預約
+    rid = ObjectId()
+    conflicts = availability.hold(rid, start_local, end_local, new=True)
+    timer.mark("slot")
+    if conflicts:
+        # 只有衝突時才讀一次，分辨是同一人重複送出還是別人佔走
+        mine = bookings_col.find_one({"_id": {"$in": conflicts}, "userId": user_id, "startAt": start_utc_naive},
+                                     {"_id": 1})
+        if mine:
+            return done({"error": "同一時段已有未完成的預約"}, 409)
+        return done({"error": "此時段已被預約，請選擇其他時間"}, 409)
 
-        # （新）嘗試推播一則「已收到預約申請」訊息（若未加好友會失敗，無礙流程）
-        try:
-            svc_names = "、".join([s.get("name","") for s in services_col.find({"_id": {"$in": svc_oids}}, {"name":1})])
-            msg = f"已收到您的預約申請：{date} {time}（{svc_names}）。我們將盡快與您確認最終時間。"
-            send_line_push(user_id, msg)
-        except Exception:
-            pass
+    try:
+        # (userId, startAt) 的唯一部分索引擋掉同一人同時段的重複預約
+        bookings_col.insert_one(_booking_doc(rid, user_id, date, time, start_utc_naive, svc_oids, u, found))
+        timer.mark("insert")
+    except DuplicateKeyError:
+        availability.release(rid)
+        return done({"error": "同一時段已有未完成的預約"}, 409)
+    except PyMongoError as e:
+        availability.release(rid)
+        return done({"error": str(e)}, 500)
+
+    # （新）排入推播「已收到預約申請」訊息（若未加好友會失敗，無礙流程）
+    try:
+        msg = _booking_received_message(date, time, found)
+        outbox.enqueue("line_push", {"userId": user_id, "message": msg}, f"booking-received:{rid}")
+    except Exception:
+        pass
+    timer.mark("enqueue")
 
-        return jsonify({"_id": str(rid), "status": "pending"}), 201
+    return done({"_id": str(rid), "status": "pending"}, 201)
+
+# 可預約時段：由時段佔用索引回答，不掃 bookings
+@app.route("/api/availability", methods=["GET"])
+def get_availability():
+    from_day, to_day, err = _parse_availability_range(request.args)
+    if err:
+        return jsonify({"error": err}), 400
+    try:
+        busy = availability.busy(from_day, to_day, _calendar_blocks(from_day, to_day))
     except PyMongoError as e:
         return jsonify({"error": str(e)}), 500
+    return jsonify(_availability_body(busy)), 200
 
 @app.route("/api/users/check", methods=["GET"])
 def check_user():
@@ -369,12 +909,13 @@ def upsert_user():
         "birthday": birthday,
         "updatedAt": datetime.utcnow()
     }
-    users_col.update_one(
+    before = users_col.find_one_and_update(
         {"userId": user_id},
         {"$set": update, "$setOnInsert": {"createdAt": datetime.utcnow()}},
-        upsert=True
+        upsert=True,
+        projection=_CUSTOMER_SYNC_FIELDS,
     )
-    _sync_customer_from_user(user_id)
+    _sync_customer_from_user(user_id, *_profile_after(before, update))
 
     user = users_col.find_one({"userId": user_id}, {"_id": 0})
     return jsonify(user), 200
@@ -382,49 +923,54 @@ def upsert_user():
 # ----------------------------------------------------------------------------- #
 # Admin Routes
 # ----------------------------------------------------------------------------- #
-@app.route("/api/admin/bookings/pending", methods=["GET"])
-@require_admin
-def admin_list_pending_bookings():
-    now_utc = datetime.utcnow()
-    cur = bookings_col.find({"status": "pending", "startAt": {"$gte": now_utc}}).sort("startAt", 1)
-    bookings = list(cur)
-
-    user_ids = {b.get("userId") for b in bookings if b.get("userId")}
-    svc_oid_set = set()
-    for b in bookings:
-        for sid in b.get("serviceIds", []):
-            try:
-                svc_oid_set.add(ObjectId(sid) if not isinstance(sid, ObjectId) else sid)
-            except Exception:
-                pass
-
+# 快照欄位上線前建立的預約：退回查 users / 服務目錄
+def _legacy_booking_names(bookings: list) -> tuple:
+    legacy = [b for b in bookings if "userSnapshot" not in b]
+    if not legacy:
+        return {}, {}
     users_map = {
-        u["userId"]: {"displayName": u.get("displayName"), "phone": u.get("phone")}
+        u["userId"]: _user_snapshot(u)
         for u in users_col.find(
-            {"userId": {"$in": list(user_ids)}},
+            {"userId": {"$in": list({b.get("userId") for b in legacy if b.get("userId")})}},
             {"_id": 0, "userId": 1, "displayName": 1, "phone": 1}
         )
     }
-    services_map = {
-        s["_id"]: s.get("name")
-        for s in services_col.find({"_id": {"$in": list(svc_oid_set)}}, {"_id": 1, "name": 1})
-    }
-
-    def enrich(doc):
-        base = _json_booking(doc)
+    sids = {_as_oid(sid) for b in legacy for sid in b.get("serviceIds", [])}
+    return users_map, _service_names_by_id([x for x in sids if x])
+
+# 後台預約卡片：顧客與服務名稱讀預約上的快照（userSnapshot / serviceNames）
+def _admin_booking_json(doc: dict, users_map: dict, services_map: dict) -> dict:
+    base = _json_booking(doc)
+    if "userSnapshot" in doc:
+        base["user"] = doc["userSnapshot"] or {}
+        base["serviceNames"] = doc.get("serviceNames") or []
+    else:
         base["user"] = users_map.get(doc.get("userId"), {})
-        base["serviceNames"] = []
-        for sid in doc.get("serviceIds", []):
-            try:
-                key = ObjectId(sid) if not isinstance(sid, ObjectId) else sid
-            except Exception:
-                continue
-            n = services_map.get(key)
-            if n:
-                base["serviceNames"].append(n)
-        return base
+        names = (services_map.get(_as_oid(sid)) for sid in doc.get("serviceIds", []))
+        base["serviceNames"] = [n for n in names if n]
+    return base
 
-    return jsonify([enrich(b) for b in bookings]), 200
+@app.route("/api/admin/bookings/pending", methods=["GET"])
+@require_admin
+def admin_list_pending_bookings():
+    # 依 (startAt, _id) 由早到晚分頁
+    try:
+        limit = _page_limit()
+        after = _decode_cursor(request.args.get("cursor"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    q = {"status": "pending", "startAt": {"$gte": datetime.utcnow()}}
+    if after:
+        q = {"$and": [q, _keyset_after("startAt", *after)]}
+    docs = list(bookings_col.find(q).sort([("startAt", 1), ("_id", 1)]).limit(limit + 1))
+    bookings = docs[:limit]
+
+    users_map, services_map = _legacy_booking_names(bookings)
+    resp = jsonify([_admin_booking_json(b, users_map, services_map) for b in bookings])
+    if len(docs) > limit:
+        last = bookings[-1]
+        resp.headers["X-Next-Cursor"] = _encode_cursor(last.get("startAt"), last["_id"])
+    return resp, 200
 
 @app.route("/api/admin/bookings/<bid>/confirm", methods=["POST"])
 @require_admin
@@ -435,120 +981,269 @@ def admin_confirm_booking(bid):
         return jsonify({"error": "無效的 JSON"}), 400
 
     try:
-        duration = int(data.get("durationMins", 90))
-        if duration <= 0 or duration > 8 * 60:
-            return jsonify({"error": "不合法的 durationMins"}), 400
-    except Exception:
-        return jsonify({"error": "不合法的 durationMins"}), 400
+        oid = ObjectId(bid)
+        final_start_local, final_end_local, err = _parse_confirm_times(data or {})
+        if err:
+            return jsonify({"error": err}), 400
 
-    final_start_str = (data.get("finalStart") or "").strip()
-    final_datetime_iso = (data.get("final_datetime") or "").strip()
-    final_date = (data.get("finalDate") or "").strip()
-    final_time = (data.get("finalTime") or "").strip()
-
-    try:
-        b = bookings_col.find_one({"_id": ObjectId(bid)})
+        b = bookings_col.find_one({"_id": oid})
         if not b:
             return jsonify({"error": "找不到預約"}), 404
         if b.get("status") not in ("pending", "confirmed"):
             return jsonify({"error": "此預約狀態不可確認"}), 400
 
-        final_start_local = None
-        if final_start_str:
-            if "T" not in final_start_str:
-                return jsonify({"error": "finalStart 需為 YYYY-MM-DDTHH:MM"}), 400
-            ymd, hm = final_start_str.split("T")
-            y, m, d = map(int, ymd.split("-"))
-            hh, mm = map(int, hm.split(":"))
-            final_start_local = datetime(y, m, d, hh, mm, tzinfo=TAIPEI)
-        elif final_datetime_iso:
-            try:
-                iso = final_datetime_iso.replace("Z", "+00:00")
-                dt_aware = datetime.fromisoformat(iso)
-                final_start_local = dt_aware.astimezone(TAIPEI)
-            except Exception:
-                return jsonify({"error": "final_datetime 格式不合法（需 ISO 8601）"}), 400
-        else:
-            if not final_date or not final_time:
-                return jsonify({"error": "需提供 finalStart 或 final_datetime 或 finalDate+finalTime"}), 400
-            y, m, d = map(int, final_date.split("-"))
-            hh, mm = map(int, final_time.split(":"))
-            final_start_local = datetime(y, m, d, hh, mm, tzinfo=TAIPEI)
-
-        final_end_local = final_start_local + timedelta(minutes=duration)
+        conflicts = availability.hold(b["_id"], final_start_local, final_end_local, "confirmed",
+                                      force=bool(data.get("force")))
+        if conflicts:
+            return jsonify({"error": "與其他預約時段重疊", "conflicts": [str(x) for x in conflicts]}), 409
 
         user = users_col.find_one({"userId": b.get("userId")}) or {}
-        svc_docs = list(services_col.find({"_id": {"$in": b.get("serviceIds", [])}}, {"name": 1}))
-        svc_names = "、".join([s.get("name", "") for s in svc_docs]) or "服務"
-
-        summary = f"顧客預約：{user.get('displayName') or 'LINE 使用者'} - {svc_names}"
-        desc_lines = [
-            f"顧客：{user.get('displayName') or ''}",
-            f"LINE ID：{b.get('userId') or ''}",
-            f"電話：{user.get('phone') or ''}",
-            f"項目：{svc_names}",
-        ]
+        summary, description = _confirm_event_text(b, user)
+        final_start_utc = _to_utc_naive(final_start_local)
+        final_end_utc = _to_utc_naive(final_end_local)
+
+        reminder = _reminder_doc(b, final_start_local)
+        now = datetime.utcnow()
+        update = {
+            "status": "confirmed",
+            "finalStartAt": final_start_utc,
+            "finalEndAt": final_end_utc,
+            **stats_rollup.confirmation_fields(b, now, stats_rollup.rebuild_boundary()),
+            "updatedAt": now
+        }
+        if reminder:
+            reminders_col.insert_one(reminder)
+            update["reminderId"] = reminder["_id"]
+        bookings_col.update_one({"_id": oid}, {"$set": update})
+        _record_confirmations([(b, final_start_local)], now)
+
+        # 行事曆事件交給 outbox 背景建立，完成後回寫 calendarEventId / calendarHtmlLink
+        _enqueue_calendar_event(b["_id"], summary, description, final_start_utc, final_end_utc)
+
+        return jsonify({"ok": True, "calendarQueued": True, "reminderCreated": bool(reminder)}), 200
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# 一次確認多筆預約：行事曆用 Google batch request，Mongo 用 insert_many / bulk_write
+@app.route("/api/admin/bookings/confirm-batch", methods=["POST"])
+@require_admin
+def admin_confirm_bookings_batch():
+    try:
+        data = request.get_json(force=True) or {}
+    except Exception:
+        return jsonify({"error": "無效的 JSON"}), 400
+    items = data.get("items")
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "items 必須為非空陣列"}), 400
+    if len(items) > CONFIRM_BATCH_MAX:
+        return jsonify({"error": f"一次最多確認 {CONFIRM_BATCH_MAX} 筆"}), 400
+
+    results = []
+    pending = []
+    seen = set()
+    for it in items:
+        it = it if isinstance(it, dict) else {}
+        bid = str(it.get("bookingId") or "")
+        res = {"bookingId": bid, "ok": False}
+        results.append(res)
+        if not _is_valid_object_id(bid):
+            res["error"] = "不合法的預約 ID"
+            continue
+        if bid in seen:
+            res["error"] = "重複的預約 ID"
+            continue
+        seen.add(bid)
+        start_local, end_local, err = _parse_confirm_times(it)
+        if err:
+            res["error"] = err
+            continue
+        pending.append((res, ObjectId(bid), start_local, end_local, bool(it.get("force"))))
+
+    try:
+        bookings = {b["_id"]: b for b in bookings_col.find({"_id": {"$in": [p[1] for p in pending]}})}
+        user_ids = list({b.get("userId") for b in bookings.values() if b.get("userId")})
+        users = {u["userId"]: u for u in users_col.find(
+            {"userId": {"$in": user_ids}}, {"_id": 0, "userId": 1, "displayName": 1, "phone": 1})}
+    except PyMongoError as e:
+        return jsonify({"error": str(e)}), 500
+
+    work = []
+    for res, oid, start_local, end_local, force in pending:
+        b = bookings.get(oid)
+        if not b:
+            res["error"] = "找不到預約"
+            continue
+        if b.get("status") not in ("pending", "confirmed"):
+            res["error"] = "此預約狀態不可確認"
+            continue
         try:
-            event_id, event_link = create_calendar_event(summary, "\n".join(desc_lines),
-                                                         final_start_local, final_end_local)
-        except HttpError as he:
-            return jsonify({"error": f"建立行事曆事件失敗（HttpError）: {he}"}), 500
+            conflicts = availability.hold(oid, start_local, end_local, "confirmed", force=force)
+        except PyMongoError as e:
+            res["error"] = str(e)
+            continue
+        if conflicts:
+            res["error"] = "與其他預約時段重疊"
+            res["conflicts"] = [str(x) for x in conflicts]
+            continue
+        summary, description = _confirm_event_text(b, users.get(b.get("userId")) or {})
+        work.append({
+            "res": res, "booking": b, "start": start_local, "end": end_local,
+            "summary": summary, "description": description, "eventId": str(ObjectId()),
+        })
+
+    # 行事曆：單一 batch request（每 50 筆一包）；失敗的改排入 outbox 重試
+    cal = {}
+    if work:
+        try:
+            svc = _calendar_service()
+            reqs = {
+                w["eventId"]: svc.events().insert(
+                    calendarId=GOOGLE_CALENDAR_ID, sendUpdates="none",
+                    body=_calendar_event_body(w["summary"], w["description"], w["start"], w["end"], w["eventId"],
+                                              w["booking"]["_id"]))
+                for w in work
+            }
+            cal = google_calendar.batch_execute(reqs, "events.insert")
         except Exception as e:
-            return jsonify({"error": f"建立行事曆事件失敗: {e}"}), 500
-
-        bookings_col.update_one(
-            {"_id": ObjectId(bid)},
-            {"$set": {
-                "status": "confirmed",
-                "finalStartAt": _to_utc_naive(final_start_local),
-                "finalEndAt": _to_utc_naive(final_end_local),
-                "calendarEventId": event_id,
-                "calendarHtmlLink": event_link,
-                "updatedAt": datetime.utcnow()
-            }}
-        )
+            print(f"[CONFIRM-BATCH] calendar batch error: {e}")
 
-        due_local = final_start_local - timedelta(hours=2)
-        reminder_id = None
-        if due_local > datetime.now(tz=TAIPEI):
-            msg = f"溫馨提醒：您在『茗月髮型設計』的預約將於 {final_start_local.strftime('%m/%d %H:%M')} 開始，期待您的光臨！"
-            reminder_id = reminders_col.insert_one({
-                "bookingId": b["_id"],
-                "userId": b.get("userId"),
-                "channel": "line",
-                "message": msg,
-                "dueAt": _to_utc_naive(due_local),
-                "status": "scheduled",
-                "attempts": 0,
-                "createdAt": datetime.utcnow(),
-                "updatedAt": datetime.utcnow()
-            }).inserted_id
-            bookings_col.update_one({"_id": ObjectId(bid)}, {"$set": {"reminderId": reminder_id}})
-
-        return jsonify({"ok": True, "calendarHtmlLink": event_link, "reminderCreated": bool(reminder_id)}), 200
+    reminders = []
+    ops = []
+    now = datetime.utcnow()
+    try:
+        stats_boundary = stats_rollup.rebuild_boundary()
+    except PyMongoError as e:
+        return jsonify({"error": str(e), "results": results}), 500
+    for w in work:
+        b, res = w["booking"], w["res"]
+        update = {
+            "status": "confirmed",
+            "finalStartAt": _to_utc_naive(w["start"]),
+            "finalEndAt": _to_utc_naive(w["end"]),
+            **stats_rollup.confirmation_fields(b, now, stats_boundary),
+            "updatedAt": now,
+        }
+        ev, exc = cal.get(w["eventId"], (None, None))
+        if ev and not exc:
+            update["calendarEventId"] = ev.get("id")
+            update["calendarHtmlLink"] = ev.get("htmlLink")
+            res["calendarHtmlLink"] = ev.get("htmlLink")
+        reminder = _reminder_doc(b, w["start"])
+        if reminder:
+            reminders.append(reminder)
+            update["reminderId"] = reminder["_id"]
+        res["reminderCreated"] = bool(reminder)
+        ops.append(UpdateOne({"_id": b["_id"]}, {"$set": update}))
 
+    try:
+        if reminders:
+            reminders_col.insert_many(reminders, ordered=False)
+        if ops:
+            bookings_col.bulk_write(ops, ordered=False)
+    except PyMongoError as e:
+        return jsonify({"error": str(e), "results": results}), 500
+    _record_confirmations([(w["booking"], w["start"]) for w in work], now)
+
+    for w in work:
+        res = w["res"]
+        res["ok"] = True
+        res["calendarQueued"] = "calendarHtmlLink" not in res
+        if res["calendarQueued"]:
+            try:
+                _enqueue_calendar_event(w["booking"]["_id"], w["summary"], w["description"],
+                                        _to_utc_naive(w["start"]), _to_utc_naive(w["end"]))
+            except Exception as e:
+                print(f"[CONFIRM-BATCH] enqueue error: {e}")
+
+    return jsonify({"ok": all(r["ok"] for r in results), "results": results}), 200
+
+# 即時更新（SSE）：推送給後台的事件內容，與列表 API 同一份格式
+def _live_payload(event: str, doc: dict) -> dict:
+    if event.startswith("booking."):
+        return _admin_booking_json(doc, *_legacy_booking_names([doc]))
+    b = bookings_col.find_one({"_id": doc.get("bookingId")},
+                              {"userId": 1, "serviceIds": 1, "userSnapshot": 1, "serviceNames": 1}) or {}
+    names = _admin_booking_json(b, *_legacy_booking_names([b])) if b else {"user": {}, "serviceNames": []}
+    return {
+        "_id": str(doc["_id"]),
+        "bookingId": str(doc.get("bookingId")),
+        "userId": doc.get("userId"),
+        "status": doc.get("status"),
+        "attempts": doc.get("attempts", 0),
+        "dueAt": _iso_or_none(doc.get("dueAt")),
+        "dueAtLocal": local_clock.local_iso(doc.get("dueAt")),
+        "sentAt": _iso_or_none(doc.get("sentAt")),
+        "user": names["user"],
+        "serviceNames": names["serviceNames"],
+    }
+
+live_feed = LiveFeed(mongo, bookings_col.name, reminders_col.name, _live_payload, app.json.dumps)
+
+# EventSource 不能帶 X-Admin-Token：先換一張短效 ticket
+@app.route("/api/admin/stream/ticket", methods=["POST"])
+@require_admin
+def admin_stream_ticket():
+    return jsonify({"ticket": issue_ticket(ADMIN_TOKEN), "expiresIn": LIVE_TICKET_SECS}), 200
+
+@app.route("/api/admin/stream", methods=["GET"])
+def admin_stream():
+    ticket = request.args.get("ticket")
+    if ticket and ADMIN_TOKEN:
+        msg = None if verify_ticket(ADMIN_TOKEN, ticket) else "未授權"
+    else:
+        msg = _require_admin()
+    if msg:
+        return jsonify({"error": msg}), 401 if msg == "未授權" else 500
+    # 瀏覽器自動重連帶 Last-Event-ID；前端自行重連（換新 ticket）時改放 ?lastEventId=
+    last_id = request.headers.get("Last-Event-ID") or request.args.get("lastEventId")
+    try:
+        resume = decode_token(last_id) if last_id else None
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        stream, reset = live_feed.connect(resume)
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        # 單機 mongod 等不支援 change stream：前端退回手動重新整理
+        print(f"[LIVE] change stream 不可用：{e}")
+        return jsonify({"error": "資料庫不支援即時更新"}), 503
+    if stream is None:
+        return jsonify({"error": "即時連線數已達上限"}), 503, {"Retry-After": "30"}
+    resp = Response(stream_with_context(live_feed.events(stream, reset)), mimetype="text/event-stream")
+    resp.call_on_close(lambda: live_feed.disconnect(stream))
+    resp.headers["Cache-Control"] = "no-cache"
+    # 讓 nginx / Render 的 proxy 不要緩衝
+    resp.headers["X-Accel-Buffering"] = "no"
+    return resp
 
 # 顧客管理
 @app.route("/api/admin/customers", methods=["GET"])
 @require_admin
 def admin_list_customers():
-    q = {}
-    keyword = request.args.get("q", "").strip()
-    if keyword:
-        q["$or"] = [
-            {"name": {"$regex": keyword, "$options": "i"}},
-            {"phone": {"$regex": keyword}},
-            {"lineDisplayName": {"$regex": keyword, "$options": "i"}},
-            {"nickname": {"$regex": keyword, "$options": "i"}},
-        ]
-    cur = customers_col.find(q).sort("updatedAt", -1).limit(200)
+    # 以正規化後的搜尋鍵查詢（可走索引）；依 (updatedAt, _id) 由新到舊分頁
+    q = customer_query(request.args.get("q", ""))
+    if q is None:
+        return jsonify([]), 200
+    try:
+        limit = _page_limit()
+        after = _decode_cursor(request.args.get("cursor"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if after:
+        q = {"$and": [q, _keyset_before("updatedAt", *after)]}
+
+    cur = customers_read.find(q, {"searchKeys": 0, "phoneDigits": 0}) \
+        .sort([("updatedAt", -1), ("_id", -1)]).limit(limit + 1)
+    docs = list(cur)
     data = []
-    for c in cur:
+    for c in docs[:limit]:
         c["_id"] = str(c["_id"])
         data.append(c)
-    return jsonify(data), 200
+    resp = jsonify(data)
+    if len(docs) > limit:
+        last = docs[limit - 1]
+        resp.headers["X-Next-Cursor"] = _encode_cursor(last.get("updatedAt"), ObjectId(last["_id"]))
+    return resp, 200
 
 @app.route("/api/admin/customers", methods=["POST"])
 @require_admin
@@ -568,6 +1263,7 @@ def admin_create_customer():
         "createdAt": datetime.utcnow(),
         "updatedAt": datetime.utcnow()
     }
+    doc.update(customer_keys(doc))
     cid = customers_col.insert_one(doc).inserted_id
     return jsonify({"_id": str(cid)}), 201
 
@@ -582,21 +1278,89 @@ def admin_update_customer(cid):
     if not update:
         return jsonify({"error": "沒有可更新欄位"}), 400
     try:
-        customers_col.update_one({"_id": ObjectId(cid)}, {"$set": {**update, "updatedAt": datetime.utcnow()}})
-        return jsonify({"ok": True}), 200
+        c = customers_col.find_one_and_update(
+            {"_id": ObjectId(cid)},
+            {"$set": {**update, "updatedAt": datetime.utcnow()}},
+            return_document=ReturnDocument.AFTER,
+        )
     except Exception:
         return jsonify({"error": "不合法的顧客 ID"}), 400
+    # 重新計算搜尋鍵（同時清掉舊 LINE 名稱留下的鍵）
+    if c and any(k in update for k in ("name", "nickname", "phone")):
+        customers_col.update_one({"_id": c["_id"]}, {"$set": customer_keys(c)})
+    return jsonify({"ok": True}), 200
+
+# 回填 / 重建所有顧客的搜尋鍵
+@app.route("/api/admin/customers/reindex-search", methods=["POST"])
+@require_admin
+def admin_reindex_customer_search():
+    t0 = perf_counter()
+    ops = []
+    count = 0
+    try:
+        for c in customers_col.find({}, {f: 1 for f in (*SEARCH_FIELDS, "phone")}).batch_size(CUSTOMERS_SYNC_CHUNK):
+            ops.append(UpdateOne({"_id": c["_id"]}, {"$set": customer_keys(c)}))
+            count += 1
+            if len(ops) >= CUSTOMERS_SYNC_CHUNK:
+                customers_col.bulk_write(ops, ordered=False)
+                ops = []
+        if ops:
+            customers_col.bulk_write(ops, ordered=False)
+    except PyMongoError as e:
+        return jsonify({"ok": False, "error": str(e), "indexed": count}), 500
+    return jsonify({"ok": True, "indexed": count, "elapsedMs": round((perf_counter() - t0) * 1000, 1)}), 200
 
 # 一鍵回填：把所有 users 同步到 customers（解決舊客沒出現）
 @app.route("/api/admin/customers/sync-users", methods=["POST"])
 @require_admin
 def admin_sync_users_to_customers():
-    count = 0
-    for u in users_col.find({}, {"userId": 1}):
-        if u.get("userId"):
-            _sync_customer_from_user(u["userId"])
-            count += 1
-    return jsonify({"ok": True, "synced": count}), 200
+    # ?mode=incremental 只同步 updatedAt 晚於上次水位的 users
+    incremental = request.args.get("mode") == "incremental"
+    t0 = perf_counter()
+    run_started = datetime.utcnow()
+
+    q = {"userId": {"$nin": [None, ""]}}
+    watermark = None
+    if incremental:
+        wm = meta_col.find_one({"_id": CUSTOMERS_SYNC_META_ID}) or {}
+        watermark = wm.get("watermark")
+        if watermark:
+            q["updatedAt"] = {"$gt": watermark}
+
+    stats = {"scanned": 0, "upserted": 0, "modified": 0, "batches": 0}
+    ops = []
+
+    def flush():
+        if not ops:
+            return
+        res = customers_col.bulk_write(ops, ordered=False)
+        stats["upserted"] += res.upserted_count
+        stats["modified"] += res.modified_count
+        stats["batches"] += 1
+        ops.clear()
+
+    try:
+        cur = users_col.find(q, {"_id": 0, "userId": 1, **_CUSTOMER_SYNC_FIELDS}).batch_size(CUSTOMERS_SYNC_CHUNK)
+        for u in cur:
+            stats["scanned"] += 1
+            ops.append(UpdateOne({"lineUserId": u["userId"]}, _customer_sync_update(u["userId"], u), upsert=True))
+            if len(ops) >= CUSTOMERS_SYNC_CHUNK:
+                flush()
+        flush()
+        # 水位取本次開始時間：同步途中被更新的 users 下次會再同步一次（冪等）
+        meta_col.update_one({"_id": CUSTOMERS_SYNC_META_ID}, {"$set": {"watermark": run_started}}, upsert=True)
+    except PyMongoError as e:
+        return jsonify({"ok": False, "error": str(e), **stats}), 500
+
+    return jsonify({
+        "ok": True,
+        "mode": "incremental" if incremental else "full",
+        "synced": stats["scanned"],
+        **stats,
+        "since": _iso_or_none(watermark),
+        "watermark": _iso_or_none(run_started),
+        "elapsedMs": round((perf_counter() - t0) * 1000, 1),
+    }), 200
 
 # 染燙/消費紀錄
 @app.route("/api/admin/hair-records", methods=["POST"])
@@ -613,7 +1377,7 @@ def admin_create_hair_record():
     items = d.get("items") or []
     amount = int(d.get("amount", 0))
 
-    rid = hair_records_col.insert_one({
+    rec = {
         "userId": user_id,
         "customerId": ObjectId(customer_id) if customer_id else None,
         "date": date,
@@ -624,12 +1388,50 @@ def admin_create_hair_record():
         "notes": d.get("notes", ""),
         "createdAt": datetime.utcnow(),
         "updatedAt": datetime.utcnow()
-    }).inserted_id
+    }
+    rid = hair_records_col.insert_one(rec).inserted_id
+    try:
+        stats_rollup.record_visit(rec)
+    except PyMongoError as e:
+        print(f"[STATS] record visit error: {e}")
     return jsonify({"_id": str(rid)}), 201
 
 @app.route("/api/admin/hair-records", methods=["GET"])
 @require_admin
 def admin_list_hair_records():
+    q, err = _hair_records_query()
+    if err:
+        return jsonify({"error": err}), 400
+    # 依 (date, _id) 由新到舊分頁
+    try:
+        limit = _page_limit()
+        after = _decode_cursor(request.args.get("cursor"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if after:
+        q = {"$and": [q, _keyset_before("date", *after)]}
+    sort = [("date", -1), ("_id", -1)]
+    if _include_archived():
+        docs = list(union_find([hair_records_read, hair_records_archive_read], q, sort, limit + 1))
+    else:
+        docs = list(hair_records_read.find(q).sort(sort).limit(limit + 1))
+    data = []
+    for r in docs[:limit]:
+        r["_id"] = str(r["_id"])
+        if r.get("customerId"):
+            r["customerId"] = str(r["customerId"])
+        data.append(r)
+    resp = jsonify(data)
+    if len(docs) > limit:
+        last = docs[limit - 1]
+        resp.headers["X-Next-Cursor"] = _encode_cursor(last.get("date"), last["_id"])
+    return resp, 200
+
+# ?includeArchived=1：同時讀 hot 與 archive（archive.py 搬走的舊資料）
+def _include_archived() -> bool:
+    return request.args.get("includeArchived") == "1"
+
+def _hair_records_query():
     user_id = request.args.get("userId")
     customer_id = request.args.get("customerId")
     q = {}
@@ -639,15 +1441,113 @@ def admin_list_hair_records():
         try:
             q["customerId"] = ObjectId(customer_id)
         except Exception:
-            return jsonify({"error": "不合法的 customerId"}), 400
-    cur = hair_records_col.find(q).sort("date", -1).limit(200)
-    data = []
-    for r in cur:
-        r["_id"] = str(r["_id"])
-        if r.get("customerId"):
-            r["customerId"] = str(r["customerId"])
-        data.append(r)
-    return jsonify(data), 200
+            return None, "不合法的 customerId"
+    return q, None
+
+# ----------------------------------------------------------------------------- #
+# 匯出：逐批讀取 cursor 並串流輸出（NDJSON / CSV），記憶體用量固定
+# ----------------------------------------------------------------------------- #
+def _export_value(v):
+    if isinstance(v, ObjectId):
+        return str(v)
+    if isinstance(v, datetime):
+        return _iso_or_none(v)
+    if isinstance(v, list):
+        return [_export_value(x) for x in v]
+    if isinstance(v, dict):
+        return {k: _export_value(x) for k, x in v.items()}
+    return v
+
+def _csv_cell(v):
+    v = _export_value(v)
+    if isinstance(v, list):
+        return "、".join(str(x) for x in v)
+    return "" if v is None else v
+
+def _stream_export(cursor, fields: list, name: str):
+    fmt = request.args.get("format", "ndjson")
+    if fmt not in ("ndjson", "csv"):
+        return jsonify({"error": "format 需為 ndjson 或 csv"}), 400
+
+    def gen_ndjson():
+        for doc in cursor:
+            yield json.dumps({f: _export_value(doc.get(f)) for f in fields}, ensure_ascii=False) + "\n"
+
+    def gen_csv():
+        buf = io.StringIO()
+        w = csv.writer(buf)
+        # BOM 讓 Excel 以 UTF-8 開啟
+        buf.write("\ufeff")
+        w.writerow(fields)
+        n = 0
+        for doc in cursor:
+            w.writerow([_csv_cell(doc.get(f)) for f in fields])
+            n += 1
+            if n % 200 == 0:
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+        yield buf.getvalue()
+
+    stamp = datetime.now(tz=TAIPEI).strftime("%Y%m%d")
+    if fmt == "csv":
+        resp = Response(stream_with_context(gen_csv()), mimetype="text/csv; charset=utf-8")
+    else:
+        resp = Response(stream_with_context(gen_ndjson()), mimetype="application/x-ndjson")
+    resp.headers["Content-Disposition"] = f"attachment; filename={name}-{stamp}.{fmt}"
+    return resp
+
+@app.route("/api/admin/export/hair-records", methods=["GET"])
+@require_admin
+def admin_export_hair_records():
+    q, err = _hair_records_query()
+    if err:
+        return jsonify({"error": err}), 400
+    date_q = {}
+    for arg, op in (("from", "$gte"), ("to", "$lte")):
+        v = request.args.get(arg)
+        if v:
+            if not re.fullmatch(r"\d{4}-\d{2}-\d{2}", v):
+                return jsonify({"error": f"{arg} 需為 YYYY-MM-DD"}), 400
+            date_q[op] = v
+    if date_q:
+        q["date"] = date_q
+    fields = ["_id", "userId", "customerId", "date", "items", "amount",
+              "formula1", "formula2", "notes", "createdAt", "updatedAt"]
+    sort = [("date", 1), ("_id", 1)]
+    if _include_archived():
+        cur = union_find([hair_records_read, hair_records_archive_read], q, sort, projection={f: 1 for f in fields},
+                         batch_size=EXPORT_BATCH_SIZE)
+    else:
+        cur = hair_records_read.find(q, {f: 1 for f in fields}).sort(sort).batch_size(EXPORT_BATCH_SIZE)
+    return _stream_export(cur, fields, "hair-records")
+
+@app.route("/api/admin/export/bookings", methods=["GET"])
+@require_admin
+def admin_export_bookings():
+    q = {}
+    status = request.args.get("status")
+    if status:
+        q["status"] = status
+    start_q = {}
+    for arg, op in (("from", "$gte"), ("to", "$lt")):
+        v = request.args.get(arg)
+        if v:
+            if not re.fullmatch(r"\d{4}-\d{2}-\d{2}", v):
+                return jsonify({"error": f"{arg} 需為 YYYY-MM-DD"}), 400
+            y, m, d = map(int, v.split("-"))
+            day = datetime(y, m, d, tzinfo=TAIPEI) + (timedelta(days=1) if arg == "to" else timedelta())
+            start_q[op] = _to_utc_naive(day)
+    if start_q:
+        q["startAt"] = start_q
+    fields = ["_id", "userId", "date", "time", "serviceIds", "status", "startAt",
+              "finalStartAt", "finalEndAt", "calendarEventId", "createdAt", "updatedAt"]
+    if _include_archived():
+        cur = union_find([bookings_read, bookings_archive_read], q, [("_id", 1)], projection={f: 1 for f in fields},
+                         batch_size=EXPORT_BATCH_SIZE)
+    else:
+        cur = bookings_read.find(q, {f: 1 for f in fields}).sort("_id", 1).batch_size(EXPORT_BATCH_SIZE)
+    return _stream_export(cur, fields, "bookings")
 
 # 服務管理
 @app.route("/api/admin/services", methods=["GET"])
@@ -683,6 +1583,7 @@ def admin_create_service():
         "createdAt": datetime.utcnow(),
         "updatedAt": datetime.utcnow()
     }).inserted_id
+    service_catalog.invalidate()
     return jsonify({"_id": str(sid)}), 201
 
 @app.route("/api/admin/services/<sid>", methods=["PATCH"])
@@ -712,55 +1613,142 @@ def admin_update_service(sid):
         return jsonify({"error": "沒有可更新欄位"}), 400
 
     try:
-        services_col.update_one({"_id": ObjectId(sid)}, {"$set": {**update, "updatedAt": datetime.utcnow()}})
-        return jsonify({"ok": True}), 200
+        oid = ObjectId(sid)
+        services_col.update_one({"_id": oid}, {"$set": {**update, "updatedAt": datetime.utcnow()}})
     except Exception:
         return jsonify({"error": "不合法的服務 ID"}), 400
+    service_catalog.invalidate()
+    if "name" in update:
+        try:
+            _refresh_pending_service_names(oid)
+        except PyMongoError as e:
+            print(f"[SERVICES] refresh serviceNames error ({sid}): {e}")
+    return jsonify({"ok": True}), 200
+
+# 服務改名：待確認預約上的 serviceNames 快照跟著更新
+def _refresh_pending_service_names(oid):
+    ops = [UpdateOne({"_id": b["_id"]}, {"$set": {"serviceNames": service_catalog.names(b["serviceIds"])}})
+           for b in bookings_col.find({"status": "pending", "serviceIds": oid}, {"serviceIds": 1})]
+    if ops:
+        bookings_col.bulk_write(ops, ordered=False)
+
+# 由 bookings 重建時段佔用索引
+@app.route("/api/admin/availability/rebuild", methods=["POST"])
+@require_admin
+def admin_rebuild_availability():
+    try:
+        stats = availability.rebuild(bookings_col, _to_local)
+    except PyMongoError as e:
+        return jsonify({"error": str(e)}), 500
+    return jsonify({"ok": True, **stats}), 200
+
+# 營收 / 來店統計：直接讀預先彙總的 stats_rollups
+def _stats_doc(d: dict) -> dict:
+    d.pop("_id", None)
+    d.pop("kind", None)
+    d["updatedAt"] = _iso_or_none(d.get("updatedAt"))
+    return d
+
+@app.route("/api/admin/stats", methods=["GET"])
+@require_admin
+def admin_stats_summary():
+    today = datetime.now(tz=TAIPEI).strftime("%Y-%m-%d")
+    docs = {d["_id"]: d for d in stats_read.find({"_id": {"$in": ["total", f"day:{today}", f"month:{today[:7]}"]}})}
+    return jsonify({
+        "total": _stats_doc(docs.get("total", {})),
+        "today": _stats_doc(docs.get(f"day:{today}", {"key": today})),
+        "month": _stats_doc(docs.get(f"month:{today[:7]}", {"key": today[:7]})),
+    }), 200
+
+# kind=day|month：?from=&to= 依 key 範圍；kind=service|customer：依營收排序，?key= 取單筆
+@app.route("/api/admin/stats/<kind>", methods=["GET"])
+@require_admin
+def admin_stats_list(kind):
+    if kind not in STATS_KINDS or kind == "total":
+        return jsonify({"error": "不支援的統計類型"}), 400
+    key = request.args.get("key")
+    if key:
+        doc = stats_rollup.get(kind, key)
+        if not doc:
+            return jsonify({"error": "找不到統計資料"}), 404
+        return jsonify(_stats_doc(doc)), 200
+    try:
+        limit = _page_limit(default=100)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    docs = stats_rollup.range(kind, request.args.get("from"), request.args.get("to"), limit,
+                              by_revenue=kind in ("service", "customer"))
+    return jsonify([_stats_doc(d) for d in docs]), 200
+
+@app.route("/api/admin/stats/rebuild", methods=["POST"])
+@require_admin
+def admin_rebuild_stats():
+    try:
+        result = rebuild_stats()
+    except PyMongoError as e:
+        return jsonify({"error": str(e)}), 500
+    return jsonify({"ok": True, **result}), 200
+
+# 各階段耗時統計（例如 create_booking 的 validate / user / slot / insert / enqueue）
+@app.route("/api/admin/perf/stages", methods=["GET"])
+@require_admin
+def admin_perf_stages():
+    return jsonify(stage_stats.snapshot()), 200
 
-# Cron：派送提醒
+# Cron：派送提醒（排程器的補派；REMINDER_SCHEDULER=off 時為唯一的派送方式）
 @app.route("/api/admin/cron/dispatch", methods=["GET", "POST"])
 def cron_dispatch():
     if not verify_cron():
         return jsonify({"error": "未授權"}), 401
 
-    now_utc = datetime.utcnow()
-    processed = 0
-    for _ in range(50):
-        r = reminders_col.find_one_and_update(
-            {"status": "scheduled", "dueAt": {"$lte": now_utc}},
-            {"$set": {"status": "sending", "updatedAt": datetime.utcnow()}},
-            sort=[("dueAt", 1)]
-        )
-        if not r:
-            break
+    try:
+        max_items = int(request.args["limit"]) if request.args.get("limit") else None
+        deadline = float(request.args.get("deadline", REMINDER_DEADLINE_SECS))
+    except ValueError:
+        return jsonify({"error": "limit/deadline 需為數字"}), 400
 
-        ok = False
-        try:
-            if r.get("channel") == "line" and r.get("userId") and r.get("message"):
-                ok = send_line_push(r["userId"], r["message"])
-        except Exception as e:
-            ok = False
-            print(f"[CRON] send error: {e}")
-
-        if ok:
-            reminders_col.update_one(
-                {"_id": r["_id"]},
-                {"$set": {"status": "sent", "sentAt": datetime.utcnow(), "updatedAt": datetime.utcnow()}}
-            )
-        else:
-            if r.get("attempts", 0) + 1 >= MAX_ATTEMPTS:
-                reminders_col.update_one(
-                    {"_id": r["_id"]},
-                    {"$set": {"status": "failed", "updatedAt": datetime.utcnow()}, "$inc": {"attempts": 1}}
-                )
-            else:
-                reminders_col.update_one(
-                    {"_id": r["_id"]},
-                    {"$inc": {"attempts": 1}, "$set": {"status": "scheduled", "updatedAt": datetime.utcnow()}}
-                )
-        processed += 1
-
-    return jsonify({"ok": True, "processed": processed}), 200
+    stats = _dispatch_reminders(max_items, deadline)
+    metrics.CRON_RUNS.inc()
+    metrics.CRON_DURATION.observe(stats["elapsedMs"] / 1000)
+    return jsonify({"ok": True, **stats}), 200
+
+# Cron：行事曆增量同步（syncToken）；?full=1 重新整批同步
+@app.route("/api/admin/cron/calendar-sync", methods=["GET", "POST"])
+def cron_calendar_sync():
+    if not verify_cron():
+        return jsonify({"error": "未授權"}), 401
+    if not google_calendar.configured():
+        return jsonify({"ok": False, "error": "Google OAuth 環境變數未設定完全"}), 500
+    try:
+        stats = calendar_sync.sync(full=request.args.get("full") == "1")
+    except Exception as e:
+        return jsonify({"ok": False, "error": str(e)}), 500
+    return jsonify({"ok": True, **stats}), 200
+
+# Cron：把舊的提醒 / 預約 / 消費紀錄搬到 archive；每次最多跑 ?deadline= 秒，剩下的下次繼續
+@app.route("/api/admin/cron/archive", methods=["GET", "POST"])
+def cron_archive():
+    if not verify_cron():
+        return jsonify({"error": "未授權"}), 401
+    try:
+        deadline = float(request.args.get("deadline", ARCHIVE_DEADLINE_SECS))
+    except ValueError:
+        return jsonify({"error": "deadline 需為數字"}), 400
+    try:
+        stats = archiver.run(deadline_secs=deadline)
+    except PyMongoError as e:
+        return jsonify({"ok": False, "error": str(e)}), 500
+    return jsonify({"ok": True, **stats}), 200
+
+@app.route("/api/admin/archive", methods=["GET"])
+@require_admin
+def admin_archive_status():
+    return jsonify(archiver.status()), 200
+
+@app.route("/api/admin/calendar/sync", methods=["GET"])
+@require_admin
+def admin_calendar_sync_status():
+    return jsonify(calendar_sync.status()), 200
 
 # Google 診斷：確認 refresh token & Calendar ID 可用
 @app.route("/api/admin/diag/google", methods=["GET"])
@@ -768,12 +1756,13 @@ def cron_dispatch():
 def admin_diag_google():
     try:
         svc = _calendar_service()
-        info = svc.calendarList().get(calendarId=GOOGLE_CALENDAR_ID).execute()
-        return jsonify({"ok": True, "calendarId": info.get("id"), "summary": info.get("summary")}), 200
-    except HttpError as e:
-        return jsonify({"ok": False, "error": f"HttpError: {e}"}), 500
+        info = google_calendar.execute(svc.calendarList().get(calendarId=GOOGLE_CALENDAR_ID), "calendarList.get")
+        return jsonify({"ok": True, "calendarId": info.get("id"), "summary": info.get("summary"),
+                        "stats": google_calendar.stats()}), 200
     except Exception as e:
-        return jsonify({"ok": False, "error": str(e)}), 500
+        if http_status(e) is not None:
+            return jsonify({"ok": False, "error": f"HttpError: {e}", "stats": google_calendar.stats()}), 500
+        return jsonify({"ok": False, "error": str(e), "stats": google_calendar.stats()}), 500
 
 # （新）簡單推播 API：後台測試用
 @app.route("/api/admin/push", methods=["POST"])
@@ -789,6 +1778,141 @@ def admin_push():
         return jsonify({"ok": True}), 200
     return jsonify({"ok": False, "error": "LINE push 失敗（多半是尚未加好友）"}), 502
 
+# 群發：依 customers 條件挑出有綁 LINE 的顧客，交給 outbox 以 multicast 送出
+def _segment_query(d: dict):
+    q = {"lineUserId": {"$nin": [None, ""]}}
+    segment = d.get("segment") or "all"
+    if segment == "all":
+        return q, None
+    if segment == "birthdayMonth":
+        try:
+            month = int(d.get("month"))
+            if not 1 <= month <= 12:
+                raise ValueError
+        except (TypeError, ValueError):
+            return None, "month 需為 1-12"
+        q["birthday"] = {"$regex": f"^\\d{{4}}-{month:02d}-"}
+        return q, None
+    if segment == "updatedSince":
+        since = d.get("since") or ""
+        if not re.fullmatch(r"\d{4}-\d{2}-\d{2}", since):
+            return None, "since 需為 YYYY-MM-DD"
+        y, m, dd = map(int, since.split("-"))
+        q["updatedAt"] = {"$gte": _to_utc_naive(datetime(y, m, dd, tzinfo=TAIPEI))}
+        return q, None
+    return None, "segment 需為 all / birthdayMonth / updatedSince"
+
+@app.route("/api/admin/broadcast", methods=["POST"])
+@require_admin
+def admin_broadcast():
+    d = request.get_json(force=True) or {}
+    text = (d.get("text") or "").strip()
+    if not text:
+        return jsonify({"error": "缺少 text"}), 400
+    q, err = _segment_query(d)
+    if err:
+        return jsonify({"error": err}), 400
+
+    user_ids = list(dict.fromkeys(c["lineUserId"] for c in customers_col.find(q, {"_id": 0, "lineUserId": 1})))
+    if d.get("dryRun") or not user_ids:
+        return jsonify({"ok": True, "recipients": len(user_ids), "queued": False}), 200
+
+    key = f"broadcast:{d.get('requestId') or uuid.uuid4().hex}"
+    outbox.enqueue("line_broadcast", {"text": text, "userIds": user_ids}, key)
+    job = outbox_col.find_one({"idemKey": key}, {"_id": 1})
+    return jsonify({"ok": True, "recipients": len(user_ids), "queued": True, "jobId": str(job["_id"])}), 202
+
+@app.route("/api/admin/broadcast/<jid>", methods=["GET"])
+@require_admin
+def admin_broadcast_status(jid):
+    if not _is_valid_object_id(jid):
+        return jsonify({"error": "不合法的 jobId"}), 400
+    job = outbox_col.find_one({"_id": ObjectId(jid), "kind": "line_broadcast"}, {"payload.userIds": 0})
+    if not job:
+        return jsonify({"error": "找不到群發工作"}), 404
+    return jsonify({
+        "jobId": jid,
+        "status": job.get("status"),
+        "attempts": job.get("attempts", 0),
+        "result": job.get("result"),
+        "lastError": job.get("lastError"),
+        "createdAt": _iso_or_none(job.get("createdAt")),
+        "delivery": line_delivery.stats(),
+    }), 200
+
+# ----------------------------------------------------------------------------- #
+# Health
+# ----------------------------------------------------------------------------- #
+# liveness：process 活著即可，不碰任何外部服務
+@app.route("/api/health/live", methods=["GET"])
+def health_live():
+    return jsonify({"ok": True}), 200
+
+# readiness：Mongo 可連線且索引遷移已套用目前版本
+@app.route("/api/health/ready", methods=["GET"])
+def health_ready():
+    checks = {}
+    try:
+        t0 = perf_counter()
+        mongo.client.admin.command("ping")
+        checks["mongoPingMs"] = round((perf_counter() - t0) * 1000, 1)
+        checks["migrations"] = "applied" if migrations.applied(index_specs(), LEGACY_INDEXES, meta_col) else "pending"
+    except PyMongoError as e:
+        return jsonify({"ok": False, "error": str(e), **checks}), 503
+    ok = checks["migrations"] == "applied"
+    return jsonify({"ok": ok, **checks}), 200 if ok else 503
+
+# Prometheus 抓取用；設定 METRICS_TOKEN 時需帶 Authorization: Bearer <token>
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        return jsonify({"error": "未授權"}), 401
+    return Response(metrics.registry.render(), mimetype="text/plain; version=0.0.4")
+
+# 最近的慢查詢（需設定 SLOW_QUERY_MS）與其 explain 結果
+@app.route("/api/admin/perf/slow-queries", methods=["GET"])
+@require_admin
+def admin_slow_queries():
+    return jsonify({"thresholdMs": mongo_listener.slow_ms, "items": list(mongo_listener.slow)[::-1]}), 200
+
+@app.route("/api/admin/perf/scheduler", methods=["GET"])
+@require_admin
+def admin_perf_scheduler():
+    return jsonify(reminder_scheduler.stats()), 200
+
+@app.route("/api/admin/perf/rate-limit", methods=["GET"])
+@require_admin
+def admin_perf_rate_limit():
+    return jsonify(rate_limiter.stats()), 200
+
+@app.route("/api/admin/perf/live", methods=["GET"])
+@require_admin
+def admin_perf_live():
+    return jsonify(live_feed.stats()), 200
+
+# 這個 worker 的 Mongo 連線池設定與各 server 的連線數
+@app.route("/api/admin/perf/pool", methods=["GET"])
+@require_admin
+def admin_perf_pool():
+    return jsonify(mongo.stats()), 200
+
+@app.route("/api/admin/perf/startup", methods=["GET"])
+@require_admin
+def admin_perf_startup():
+    return jsonify(startup.snapshot()), 200
+
+@app.route("/api/admin/migrate", methods=["POST"])
+@require_admin
+def admin_migrate():
+    try:
+        report = run_migrations(dry_run=request.args.get("dryRun") == "1")
+    except PyMongoError as e:
+        return jsonify({"error": str(e)}), 500
+    return jsonify({"ok": not report["conflicts"], **report}), 200
+
+startup.mark("routes")
+print(f"[STARTUP] {startup.summary()}")
+
 # ----------------------------------------------------------------------------- #
 # Main
 # ----------------------------------------------------------------------------- #
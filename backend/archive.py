@@ -0,0 +1,156 @@
+import heapq
+import itertools
+import os
+import time
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from pymongo import ReplaceOne
+
+from scheduler import LeaderLease
+
+# ----------------------------------------------------------------------------- #
+# 冷熱分層：已結束的資料分批搬到 *_archive，讓常用的 collection 與索引維持小而熱
+#   reminders     已送出 / 失敗、dueAt 早於 ARCHIVE_REMINDERS_AFTER_DAYS 天前
+#   bookings      建立時間與（最終）開始時間都早於 ARCHIVE_BOOKINGS_AFTER_DAYS 天前
+#   hair_records  建立時間與消費日期都早於 ARCHIVE_HAIR_RECORDS_AFTER_DAYS 天前
+# 天數設 0 表示不搬。先 upsert 到 archive 再從 hot 刪除（不需 transaction，重跑也安全）；
+# 複製後又被改動而不再符合條件的文件留在 hot，archive 裡的副本撤回
+# 封存的提醒只留 ARCHIVE_REMINDERS_RETENTION_DAYS 天（archivedAt 上的 TTL 索引）；預約與紀錄永久保留
+# ----------------------------------------------------------------------------- #
+ARCHIVE_REMINDERS_AFTER_DAYS = int(os.environ.get("ARCHIVE_REMINDERS_AFTER_DAYS", "7"))
+ARCHIVE_BOOKINGS_AFTER_DAYS = int(os.environ.get("ARCHIVE_BOOKINGS_AFTER_DAYS", "180"))
+ARCHIVE_HAIR_RECORDS_AFTER_DAYS = int(os.environ.get("ARCHIVE_HAIR_RECORDS_AFTER_DAYS", "730"))
+ARCHIVE_REMINDERS_RETENTION_DAYS = int(os.environ.get("ARCHIVE_REMINDERS_RETENTION_DAYS", "365"))
+ARCHIVE_BATCH_SIZE = int(os.environ.get("ARCHIVE_BATCH_SIZE", "500"))
+ARCHIVE_DEADLINE_SECS = float(os.environ.get("ARCHIVE_DEADLINE_SECS", "25"))
+ARCHIVE_LEASE_SECS = int(os.environ.get("ARCHIVE_LEASE_SECS", "300"))
+ARCHIVE_META_ID = "archive"
+
+
+def reminders_aged(cutoff) -> dict:
+    # 走 (status, dueAt) 索引
+    return {"status": {"$in": ["sent", "failed"]}, "dueAt": {"$lt": cutoff}}
+
+
+def bookings_aged(cutoff) -> dict:
+    # _id 範圍走預設索引；改期到 cutoff 之後的（finalStartAt）不搬
+    return {"_id": {"$lt": ObjectId.from_datetime(cutoff)}, "startAt": {"$lt": cutoff},
+            "finalStartAt": {"$not": {"$gte": cutoff}}}
+
+
+def hair_records_aged(cutoff) -> dict:
+    return {"_id": {"$lt": ObjectId.from_datetime(cutoff)}, "date": {"$lt": cutoff.strftime("%Y-%m-%d")}}
+
+
+class Tier:
+    # aged(cutoff) -> 要搬的查詢；indexes：archive 上的查詢索引（與 hot 上的讀取路徑對應）
+    def __init__(self, name: str, hot, archive, aged, after_days: int, retention_days: int = 0,
+                 indexes: list = ()):
+        self.name = name
+        self.hot = hot
+        self.archive = archive
+        self.aged = aged
+        self.after_days = after_days
+        self.retention_days = retention_days
+        self.read_indexes = list(indexes)
+
+
+class Archiver:
+    def __init__(self, meta_col, tiers: list, batch_size: int = ARCHIVE_BATCH_SIZE):
+        self.meta_col = meta_col
+        self.tiers = tiers
+        self.batch_size = batch_size
+        self.lease = LeaderLease(meta_col, ARCHIVE_META_ID, ARCHIVE_LEASE_SECS)
+
+    # (collection, keys, options)；由 migrations 建立
+    def indexes(self) -> list:
+        out = []
+        for t in self.tiers:
+            out += [(t.archive, keys, {}) for keys in t.read_indexes]
+            if t.retention_days > 0:
+                out.append((t.archive, [("archivedAt", 1)], {"expireAfterSeconds": t.retention_days * 86400}))
+        return out
+
+    # 回傳 (這批取出幾筆, 實際搬走幾筆)；差額是複製後被改動而留在 hot 的
+    def _move_batch(self, tier: Tier, q: dict, now) -> tuple:
+        docs = list(tier.hot.find(q).limit(self.batch_size))
+        if not docs:
+            return 0, 0
+        tier.archive.bulk_write([ReplaceOne({"_id": d["_id"]}, {**d, "archivedAt": now}, upsert=True)
+                                 for d in docs], ordered=False)
+        ids = [d["_id"] for d in docs]
+        moved = tier.hot.delete_many({"$and": [{"_id": {"$in": ids}}, q]}).deleted_count
+        if moved < len(ids):
+            kept = [d["_id"] for d in tier.hot.find({"_id": {"$in": ids}}, {"_id": 1})]
+            if kept:
+                tier.archive.delete_many({"_id": {"$in": kept}})
+        return len(docs), moved
+
+    # 一輪搬移；超過 deadline 就停，剩下的下次 cron 繼續
+    def run(self, deadline_secs: float = ARCHIVE_DEADLINE_SECS) -> dict:
+        if not self.lease.acquire():
+            return {"skipped": "另一個封存正在進行"}
+        t0 = time.monotonic()
+        now = datetime.utcnow()
+        stats = {}
+        try:
+            for t in self.tiers:
+                s = stats[t.name] = {"moved": 0, "kept": 0, "batches": 0, "done": t.after_days <= 0}
+                if s["done"]:
+                    continue
+                q = t.aged(now - timedelta(days=t.after_days))
+                while time.monotonic() - t0 < deadline_secs:
+                    fetched, moved = self._move_batch(t, q, now)
+                    s["batches"] += 1
+                    s["moved"] += moved
+                    s["kept"] += fetched - moved
+                    # 以取出的筆數判斷：被留下的文件不代表已經沒有到期的資料
+                    if fetched < self.batch_size:
+                        s["done"] = True
+                        break
+            self.meta_col.update_one({"_id": ARCHIVE_META_ID},
+                                     {"$set": {"lastRunAt": now, "lastStats": stats,
+                                               "lastDurationSecs": round(time.monotonic() - t0, 3)}})
+            return stats
+        finally:
+            self.lease.release()
+
+    def status(self) -> dict:
+        state = self.meta_col.find_one({"_id": ARCHIVE_META_ID}, {"_id": 0}) or {}
+        return {
+            "lastRunAt": state.get("lastRunAt"),
+            "lastDurationSecs": state.get("lastDurationSecs"),
+            "lastStats": state.get("lastStats"),
+            "tiers": {t.name: {"afterDays": t.after_days, "retentionDays": t.retention_days,
+                               "hot": t.hot.estimated_document_count(),
+                               "archive": t.archive.estimated_document_count()}
+                      for t in self.tiers},
+        }
+
+
+def _sort_value(v):
+    # Mongo 把 null 排在最前面；Python 不能比較 None 與字串
+    return (v is not None, v)
+
+
+# 同一個查詢分別在 hot / archive 執行、依相同排序合併（排序欄位需同方向，最後以 _id 決勝）
+def union_find(cols: list, query: dict, sort: list, limit: int = None, projection: dict = None,
+               batch_size: int = None):
+    reverse = sort[0][1] < 0
+    cursors = []
+    for col in cols:
+        cur = col.find(query, projection).sort(sort)
+        if limit:
+            cur = cur.limit(limit)
+        if batch_size:
+            cur = cur.batch_size(batch_size)
+        cursors.append(cur)
+    merged = heapq.merge(*cursors, key=lambda d: tuple(_sort_value(d.get(f)) for f, _ in sort), reverse=reverse)
+    return itertools.islice(merged, limit) if limit else merged
+
+
+if __name__ == "__main__":
+    # 手動封存：python -m archive（在 backend/ 目錄下）
+    import app as _app
+    print(f"[ARCHIVE] {_app.archiver.run(deadline_secs=float('inf'))}")
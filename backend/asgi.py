@@ -0,0 +1,367 @@
+import os
+from datetime import datetime, timedelta
+from time import perf_counter
+
+import aiohttp
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import Response
+from starlette.routing import Mount, Route
+
+import app as sync_app
+import metrics
+import mongo
+from availability import AvailabilityIndex
+from perf import StageTimer
+from ratelimit import client_ip
+
+# ----------------------------------------------------------------------------- #
+# 非同步部署模式：uvicorn asgi:app --workers 4（在 backend/ 目錄下）
+# I/O 為主的前台路由在 event loop 上以 Motor / aiohttp 處理；
+# 其餘 /api/* 交給原本的 Flask app（a2wsgi 以 thread pool 執行），回應格式完全相同
+# ----------------------------------------------------------------------------- #
+ASGI_WSGI_THREADS = int(os.environ.get("ASGI_WSGI_THREADS", "16"))
+# event loop 上的公開路由不受執行緒數限制，admission 上限不沿用 gunicorn threads 算出的預設
+ASGI_PUBLIC_MAX_INFLIGHT = int(os.environ.get("PUBLIC_MAX_INFLIGHT", "32"))
+LINE_PUSH_URL = "https://api.line.me/v2/bot/message/push"
+GOOGLE_CALENDAR_API = "https://www.googleapis.com/calendar/v3"
+HTTP_TIMEOUT_SECS = float(os.environ.get("ASGI_HTTP_TIMEOUT_SECS", "10"))
+
+
+class AsyncAvailability(AvailabilityIndex):
+    # 只實作前台需要的部分：新預約佔用 / 撤銷、查詢忙碌時段；格子計算沿用同步版
+    async def hold_new(self, booking_id, start_local, end_local) -> list:
+        docs = [self._doc(k, booking_id, "pending") for k in self._keys(start_local, end_local)]
+        if not docs:
+            return []
+        try:
+            await self.col.insert_many(docs, ordered=True)
+        except BulkWriteError as e:
+            inserted, taken = self._duplicate_at(e, docs)
+            if inserted:
+                await self.col.delete_many({"_id": {"$in": inserted}, "bookingId": booking_id})
+            holder = await self.col.find_one({"_id": taken}, {"bookingId": 1}) or {}
+            return [holder.get("bookingId")]
+        return []
+
+    async def release(self, booking_id):
+        await self.col.update_many({"extraHolders.bookingId": booking_id},
+                                   {"$pull": {"extraHolders": {"bookingId": booking_id}},
+                                    "$set": {"heldAt": datetime.utcnow()}})
+        async for d in self.col.find({"bookingId": booking_id, "extraHolders.0": {"$exists": True}},
+                                     {"extraHolders": 1}):
+            await self.col.update_one({"_id": d["_id"], "bookingId": booking_id}, self._promote(d))
+        await self.col.delete_many({"bookingId": booking_id, "extraHolders.0": {"$exists": False}})
+
+    async def busy(self, from_day: str, to_day: str, blocks=()) -> dict:
+        cur = self.col.find(self._range(from_day, to_day), {"_id": 1}).sort("_id", 1)
+        return self._merge(self._with_blocks([s["_id"] async for s in cur], from_day, to_day, blocks))
+
+
+class _State:
+    db = None
+    availability = None
+    http = None
+
+
+state = _State()
+
+
+def _json(body, status: int = 200, headers: dict = None) -> Response:
+    return Response(sync_app.app.json.dumps(body), status_code=status, headers=headers,
+                    media_type="application/json")
+
+
+def _error(msg: str, status: int) -> Response:
+    return _json({"error": msg}, status)
+
+
+def _admin_error(request):
+    msg = sync_app._check_admin_token(request.headers.get("X-Admin-Token"))
+    if msg:
+        return _error(msg, 401 if msg == "未授權" else 500)
+    return None
+
+
+async def _body(request):
+    try:
+        return await request.json()
+    except ValueError:
+        return None
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    tags = [t.strip() for t in (header or "").split(",")]
+    return "*" in tags or any(t.removeprefix("W/").strip('"') == etag for t in tags)
+
+
+async def get_services(request):
+    try:
+        etag, active = await run_in_threadpool(sync_app.service_catalog.snapshot)
+    except PyMongoError as e:
+        return _error(str(e), 500)
+    headers = {"ETag": f'"{etag}"', "Cache-Control": f"public, max-age={sync_app.SERVICES_MAX_AGE}"}
+    if _etag_matches(request.headers.get("If-None-Match"), etag):
+        return Response(status_code=304, headers=headers)
+    return _json([{"_id": str(s["_id"]), "name": s["name"], "price": s["price"]} for s in active], headers=headers)
+
+
+async def get_availability(request):
+    from_day, to_day, err = sync_app._parse_availability_range(request.query_params)
+    if err:
+        return _error(err, 400)
+    try:
+        blocks = await run_in_threadpool(sync_app._calendar_blocks, from_day, to_day)
+        busy = await state.availability.busy(from_day, to_day, blocks)
+    except PyMongoError as e:
+        return _error(str(e), 500)
+    return _json(sync_app._availability_body(busy))
+
+
+async def check_user(request):
+    user_id = request.query_params.get("userId")
+    if not user_id:
+        return _error("缺少 userId", 400)
+    user = await state.db.users.find_one({"userId": user_id}, {"_id": 0})
+    registered = bool(user and user.get("phone") and user.get("birthday"))
+    return _json({"registered": registered, "user": user})
+
+
+# 與 app.create_booking 相同的流程與回應；Mongo 呼叫改為 await
+async def create_booking(request):
+    timer = StageTimer("create_booking_async", sync_app.stage_stats)
+    idem_key = request.headers.get("Idempotency-Key")
+    idem_scope = None
+
+    async def done(body, status):
+        if idem_scope:
+            try:
+                if status < 500:
+                    await run_in_threadpool(sync_app.idempotency.finish, idem_scope, idem_key, status, body)
+                else:
+                    await run_in_threadpool(sync_app.idempotency.release, idem_scope, idem_key)
+            except PyMongoError:
+                pass
+        return timer.finish(_json(body, status))
+
+    payload = await _body(request)
+    if payload is None:
+        return _error("無效的 JSON", 400)
+    err = sync_app._validate_booking_payload(payload)
+    if err:
+        return _error(err, 400)
+    if idem_key is not None and not sync_app.valid_idempotency_key(idem_key):
+        return _error("Idempotency-Key 格式不正確", 400)
+
+    up = payload["userProfile"]
+    user_id = up["userId"]
+    date = payload["date"]
+    time = payload["time"]
+    if idem_key:
+        try:
+            state_, doc = await run_in_threadpool(sync_app.idempotency.begin, f"bookings:{user_id}", idem_key, payload)
+        except PyMongoError as e:
+            return _error(str(e), 500)
+        outcome = sync_app._idempotency_outcome(state_, doc)
+        if outcome:
+            return _json(*outcome)
+        idem_scope = f"bookings:{user_id}"
+        timer.mark("idempotency")
+
+    try:
+        return await _create_booking(payload, up, user_id, date, time, timer, done)
+    except Exception as e:
+        # 未預期的錯誤也要經過 done() 釋放 Idempotency-Key
+        print(f"[BOOKING] create error ({user_id}): {e}")
+        return await done({"error": str(e)}, 500)
+
+
+async def _create_booking(payload: dict, up: dict, user_id: str, date: str, time: str, timer, done):
+    svc_oids = [ObjectId(x) for x in dict.fromkeys(payload["serviceIds"])]
+    found = await run_in_threadpool(sync_app.service_catalog.lookup, svc_oids, True)
+    if len(found) != len(svc_oids):
+        return await done({"error": "包含不存在或未啟用的服務項目"}, 400)
+    timer.mark("validate")
+
+    try:
+        profile = sync_app._user_profile_update(up)
+        before = await state.db.users.find_one_and_update(
+            {"userId": user_id},
+            profile,
+            upsert=True,
+            return_document=ReturnDocument.BEFORE,
+            projection=sync_app._CUSTOMER_SYNC_FIELDS,
+        )
+    except PyMongoError as e:
+        return await done({"error": str(e)}, 500)
+    u, snapshot_changed = sync_app._profile_after(before, profile["$set"])
+    timer.mark("user")
+    sync_app._background.submit(sync_app._sync_customer_from_user, user_id, u, snapshot_changed)
+
+    start_local = sync_app._booking_start_local(date, time)
+    start_utc_naive = sync_app._to_utc_naive(start_local)
+
+    rid = ObjectId()
+    end_local = start_local + timedelta(minutes=sync_app.PENDING_HOLD_MINS)
+    if await run_in_threadpool(sync_app.calendar_sync.overlaps, start_utc_naive, sync_app._to_utc_naive(end_local)):
+        return await done({"error": "此時段已被預約，請選擇其他時間"}, 409)
+    conflicts = await state.availability.hold_new(rid, start_local, end_local)
+    timer.mark("slot")
+    if conflicts:
+        mine = await state.db.bookings.find_one(
+            {"_id": {"$in": conflicts}, "userId": user_id, "startAt": start_utc_naive}, {"_id": 1})
+        if mine:
+            return await done({"error": "同一時段已有未完成的預約"}, 409)
+        return await done({"error": "此時段已被預約，請選擇其他時間"}, 409)
+
+    try:
+        await state.db.bookings.insert_one(
+            sync_app._booking_doc(rid, user_id, date, time, start_utc_naive, svc_oids, u, found))
+        timer.mark("insert")
+    except DuplicateKeyError:
+        await state.availability.release(rid)
+        return await done({"error": "同一時段已有未完成的預約"}, 409)
+    except PyMongoError as e:
+        await state.availability.release(rid)
+        return await done({"error": str(e)}, 500)
+
+    try:
+        msg = sync_app._booking_received_message(date, time, found)
+        await run_in_threadpool(sync_app.outbox.enqueue, "line_push", {"userId": user_id, "message": msg},
+                                f"booking-received:{rid}")
+    except Exception:
+        pass
+    timer.mark("enqueue")
+
+    return await done({"_id": str(rid), "status": "pending"}, 201)
+
+
+# 後台測試推播：直接呼叫 LINE Messaging API（aiohttp），仍經過同一個 token bucket
+async def admin_push(request):
+    denied = _admin_error(request)
+    if denied:
+        return denied
+    data = await _body(request) or {}
+    user_id = (data.get("userId") or "").strip()
+    text = (data.get("text") or "").strip()
+    if not user_id or not text:
+        return _error("缺少 userId 或 text", 400)
+    if not sync_app.LINE_CHANNEL_ACCESS_TOKEN:
+        print("[LINE] LINE_CHANNEL_ACCESS_TOKEN 未設定，跳過推播")
+        return _json({"ok": False, "error": "LINE push 失敗（多半是尚未加好友）"}, 502)
+    await run_in_threadpool(sync_app.line_delivery.bucket.acquire)
+    try:
+        async with state.http.post(
+            LINE_PUSH_URL,
+            json={"to": user_id, "messages": [{"type": "text", "text": text}]},
+            headers={"Authorization": f"Bearer {sync_app.LINE_CHANNEL_ACCESS_TOKEN}"},
+        ) as r:
+            if r.status == 200:
+                return _json({"ok": True})
+            print(f"[LINE] push error: {r.status} {await r.text()}")
+    except aiohttp.ClientError as e:
+        print(f"[LINE] push error: {e}")
+    return _json({"ok": False, "error": "LINE push 失敗（多半是尚未加好友）"}, 502)
+
+
+# Google 診斷：token 更新沿用 CalendarClient（在 thread 執行），API 呼叫用 aiohttp
+async def admin_diag_google(request):
+    denied = _admin_error(request)
+    if denied:
+        return denied
+    cal = sync_app.google_calendar
+    try:
+        creds = await run_in_threadpool(cal.credentials)
+        url = f"{GOOGLE_CALENDAR_API}/users/me/calendarList/{sync_app.GOOGLE_CALENDAR_ID}"
+        async with state.http.get(url, headers={"Authorization": f"Bearer {creds.token}"}) as r:
+            info = await r.json(content_type=None)
+            if r.status != 200:
+                return _json({"ok": False, "error": f"HttpError: {r.status} {info}", "stats": cal.stats()}, 500)
+        return _json({"ok": True, "calendarId": info.get("id"), "summary": info.get("summary"),
+                      "stats": cal.stats()})
+    except Exception as e:
+        return _json({"ok": False, "error": str(e), "stats": cal.stats()}, 500)
+
+
+async def startup():
+    # uvicorn --workers 會在 fork 後各自執行 startup，所以每個 worker 各有一個 Motor client
+    # 連線池統計與 pymongo 的分開（/api/admin/perf/pool 的 clients.motor、/metrics 的 client="motor"）
+    client = AsyncIOMotorClient(sync_app.MONGO_URI,
+                                **mongo.client_options([sync_app.mongo_listener, sync_app.mongo.client_pool("motor")]))
+    state.db = client[mongo.MONGO_DB_NAME]
+    state.availability = AsyncAvailability(state.db.booking_slots, sync_app.TAIPEI)
+    state.http = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT_SECS))
+    sync_app.rate_limiter.admission.limit = ASGI_PUBLIC_MAX_INFLIGHT
+    if sync_app.outbox.autostart:
+        sync_app.outbox.start()
+    if sync_app.reminder_scheduler.autostart:
+        sync_app.reminder_scheduler.start()
+
+
+async def shutdown():
+    if state.http:
+        await state.http.close()
+
+
+async def _rate_limit_user_id(request, route: str):
+    if route == "GET /api/users/check":
+        return request.query_params.get("userId")
+    data = await _body(request)
+    if not isinstance(data, dict):
+        return None
+    if route == "POST /api/bookings":
+        return (data.get("userProfile") or {}).get("userId")
+    return data.get("userId")
+
+
+# 與 Flask 路由相同的耗時直方圖與限流（轉給 Flask 的路由由 Flask 自己處理）
+def _route(path: str, endpoint, method: str) -> Route:
+    key = f"{method} {path}"
+
+    async def timed(request):
+        t0 = perf_counter()
+        status = 500
+        admitted = False
+        try:
+            if sync_app.rate_limiter.limited(key):
+                ip = client_ip(request.headers.get("X-Forwarded-For"), request.client.host if request.client else None)
+                rejected = await run_in_threadpool(sync_app.rate_limiter.check, key,
+                                                   await _rate_limit_user_id(request, key), ip)
+                if rejected:
+                    status, msg, retry_after = rejected
+                    return _json({"error": msg}, status, {"Retry-After": str(retry_after)})
+                admitted = True
+            resp = await endpoint(request)
+            status = resp.status_code
+            return resp
+        finally:
+            if admitted:
+                sync_app.rate_limiter.leave()
+            metrics.HTTP_DURATION.observe(perf_counter() - t0, method=method, route=path, status=status)
+    return Route(path, timed, methods=[method])
+
+
+app = Starlette(
+    routes=[
+        _route("/api/services", get_services, "GET"),
+        _route("/api/availability", get_availability, "GET"),
+        _route("/api/users/check", check_user, "GET"),
+        _route("/api/bookings", create_booking, "POST"),
+        _route("/api/admin/push", admin_push, "POST"),
+        _route("/api/admin/diag/google", admin_diag_google, "GET"),
+        Mount("/", app=WSGIMiddleware(sync_app.app, workers=ASGI_WSGI_THREADS)),
+    ],
+    middleware=[
+        Middleware(CORSMiddleware, allow_origins=["*"] if sync_app.origins == "*" else sync_app.origins,
+                   allow_methods=["*"], allow_headers=["*"], expose_headers=["X-Next-Cursor", "Idempotent-Replayed"]),
+    ],
+    on_startup=[startup],
+    on_shutdown=[shutdown],
+)
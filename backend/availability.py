@@ -0,0 +1,235 @@
+import os
+from datetime import datetime, timedelta, timezone
+
+from pymongo import ReplaceOne, UpdateOne
+from pymongo.errors import BulkWriteError
+
+# 時段佔用索引：每個 SLOT_MINS 分鐘一筆，_id = 當地時間 "YYYY-MM-DDTHH:MM"
+# _id 唯一即代表同一格只能有一筆預約；查詢某段日期只需一次 _id 範圍查詢
+# 管理員強制確認重疊的預約時，後來者記在 extraHolders，原持有者不受影響
+# 每次即時寫入都更新 heldAt，重建時據此判斷格子是否在讀取 bookings 之後才改動
+SLOT_MINS = int(os.environ.get("SLOT_MINS", "30"))
+# 尚未確認的預約先佔用的長度（LIFF 以整點為單位）
+PENDING_HOLD_MINS = int(os.environ.get("PENDING_HOLD_MINS", "60"))
+# 時段結束後保留幾天再由 TTL 清掉
+SLOT_RETENTION_DAYS = int(os.environ.get("SLOT_RETENTION_DAYS", "7"))
+
+_DUPLICATE_KEY = 11000
+_REBUILD_FIELDS = {"status": 1, "startAt": 1, "finalStartAt": 1, "finalEndAt": 1}
+
+
+class AvailabilityIndex:
+    def __init__(self, col, tz, slot_mins: int = SLOT_MINS):
+        self.col = col
+        self.tz = tz
+        self.slot_mins = slot_mins
+
+    # (collection, keys, options)；由 migrations 建立
+    def indexes(self) -> list:
+        return [
+            (self.col, [("bookingId", 1)], {}),
+            (self.col, [("extraHolders.bookingId", 1)], {}),
+            (self.col, [("expireAt", 1)], {"expireAfterSeconds": 0}),
+        ]
+
+    def _keys(self, start_local, end_local) -> list:
+        start_local = start_local.astimezone(self.tz)
+        end_local = end_local.astimezone(self.tz)
+        floor = start_local.minute % self.slot_mins
+        t = start_local.replace(second=0, microsecond=0) - timedelta(minutes=floor)
+        keys = []
+        while t < end_local:
+            keys.append(t.strftime("%Y-%m-%dT%H:%M"))
+            t += timedelta(minutes=self.slot_mins)
+        return keys
+
+    def _doc(self, key: str, booking_id, status: str) -> dict:
+        y, mo, d = map(int, key[:10].split("-"))
+        hh, mm = map(int, key[11:].split(":"))
+        end_utc = (datetime(y, mo, d, hh, mm, tzinfo=self.tz) + timedelta(minutes=self.slot_mins)).astimezone(timezone.utc)
+        return {
+            "_id": key,
+            "day": key[:10],
+            "bookingId": booking_id,
+            "status": status,
+            "heldAt": datetime.utcnow(),
+            "expireAt": end_utc.replace(tzinfo=None) + timedelta(days=SLOT_RETENTION_DAYS),
+        }
+
+    # 佔用 [start, end)；回傳衝突的 bookingId 清單（空清單代表成功）
+    # 非 force 時以 _id 唯一索引擋重疊：插到第一個重複的格子就停，已插入的再撤掉
+    # new=True：剛產生的 bookingId，不可能已佔用任何格子，省一次讀取
+    def hold(self, booking_id, start_local, end_local, status: str = "pending", force: bool = False,
+             new: bool = False) -> list:
+        keys = self._keys(start_local, end_local)
+        owned, shared = set(), set()
+        if not new:
+            for d in self.col.find({"$or": [{"bookingId": booking_id}, {"extraHolders.bookingId": booking_id}]},
+                                   {"bookingId": 1}):
+                (owned if d.get("bookingId") == booking_id else shared).add(d["_id"])
+        docs = [self._doc(k, booking_id, status) for k in keys]
+        if force:
+            ops = []
+            for d in docs:
+                if d["_id"] in owned:
+                    ops.append(UpdateOne({"_id": d["_id"], "bookingId": booking_id},
+                                         {"$set": {"status": status, "heldAt": d["heldAt"]}}))
+                    continue
+                ops.append(UpdateOne({"_id": d["_id"]}, {"$setOnInsert": d}, upsert=True))
+                # 格子已被其他預約佔用：保留原持有者，自己記在 extraHolders
+                other = {"_id": d["_id"], "bookingId": {"$ne": booking_id}}
+                ops.append(UpdateOne(other, {"$pull": {"extraHolders": {"bookingId": booking_id}}}))
+                ops.append(UpdateOne(other, {"$push": {"extraHolders": {"bookingId": booking_id, "status": status}},
+                                             "$set": {"heldAt": d["heldAt"]}}))
+            if ops:
+                self.col.bulk_write(ops, ordered=True)
+        else:
+            new_docs = [d for d in docs if d["_id"] not in owned]
+            if new_docs:
+                try:
+                    self.col.insert_many(new_docs, ordered=True)
+                except BulkWriteError as e:
+                    inserted, taken = self._duplicate_at(e, new_docs)
+                    if inserted:
+                        self.col.delete_many({"_id": {"$in": inserted}, "bookingId": booking_id})
+                    holder = self.col.find_one({"_id": taken}, {"bookingId": 1}) or {}
+                    return [holder.get("bookingId")]
+            if owned:
+                # 已佔用的格子改成新狀態（例如 pending -> confirmed）
+                self.col.update_many({"_id": {"$in": [k for k in keys if k in owned]}, "bookingId": booking_id},
+                                     {"$set": {"status": status, "heldAt": datetime.utcnow()}})
+        stale = list((owned | shared) - set(keys))
+        if stale:
+            self._drop(booking_id, {"_id": {"$in": stale}})
+        return []
+
+    # ordered insert_many 撞到重複的格子：回傳 (已插入的 _id, 被佔用的 _id)；其他錯誤照常丟出
+    @staticmethod
+    def _duplicate_at(e: BulkWriteError, docs: list) -> tuple:
+        errors = e.details.get("writeErrors") or []
+        if not errors or errors[0].get("code") != _DUPLICATE_KEY:
+            raise e
+        idx = errors[0]["index"]
+        return [d["_id"] for d in docs[:idx]], docs[idx]["_id"]
+
+    def release(self, booking_id):
+        self._drop(booking_id, {})
+
+    # 撤銷 booking_id 在 scope 內的佔用；主持有者離開時由 extraHolders 第一位接手，沒有才刪除格子
+    def _drop(self, booking_id, scope: dict):
+        self.col.update_many({**scope, "extraHolders.bookingId": booking_id},
+                             {"$pull": {"extraHolders": {"bookingId": booking_id}},
+                              "$set": {"heldAt": datetime.utcnow()}})
+        for d in self.col.find({**scope, "bookingId": booking_id, "extraHolders.0": {"$exists": True}},
+                               {"extraHolders": 1}):
+            self.col.update_one({"_id": d["_id"], "bookingId": booking_id}, self._promote(d))
+        self.col.delete_many({**scope, "bookingId": booking_id, "extraHolders.0": {"$exists": False}})
+
+    @staticmethod
+    def _promote(doc: dict) -> dict:
+        nxt = doc["extraHolders"][0]
+        return {"$set": {"bookingId": nxt["bookingId"], "status": nxt["status"],
+                         "extraHolders": doc["extraHolders"][1:], "heldAt": datetime.utcnow()}}
+
+    # from_day / to_day：YYYY-MM-DD（含）；回傳 {day: [[HH:MM, HH:MM], ...]} 已合併相鄰格子
+    # blocks：其他來源的忙碌區間 [(start, end)]（aware datetime，例如行事曆事件），換成格子一起合併
+    def busy(self, from_day: str, to_day: str, blocks=()) -> dict:
+        keys = [s["_id"] for s in self.col.find(self._range(from_day, to_day), {"_id": 1}).sort("_id", 1)]
+        return self._merge(self._with_blocks(keys, from_day, to_day, blocks))
+
+    def _with_blocks(self, keys: list, from_day: str, to_day: str, blocks) -> list:
+        if not blocks:
+            return keys
+        out = set(keys)
+        for start, end in blocks:
+            out.update(k for k in self._keys(start, end) if from_day <= k[:10] <= to_day)
+        return sorted(out)
+
+    # 查詢範圍（當地日期，含 to_day）換成 aware datetime 的 [start, end)
+    def day_bounds(self, from_day: str, to_day: str) -> tuple:
+        y, m, d = map(int, from_day.split("-"))
+        start = datetime(y, m, d, tzinfo=self.tz)
+        y, m, d = map(int, to_day.split("-"))
+        return start, datetime(y, m, d, tzinfo=self.tz) + timedelta(days=1)
+
+    @staticmethod
+    def _range(from_day: str, to_day: str) -> dict:
+        y, m, d = map(int, to_day.split("-"))
+        upper = (datetime(y, m, d) + timedelta(days=1)).strftime("%Y-%m-%d")
+        return {"_id": {"$gte": from_day, "$lt": upper}}
+
+    # 依序的格子 _id -> {day: [[HH:MM, HH:MM], ...]}
+    def _merge(self, keys) -> dict:
+        out = {}
+        last_end = {}
+        for key in keys:
+            day, hm = key[:10], key[11:]
+            hh, mm = map(int, hm.split(":"))
+            end_min = hh * 60 + mm + self.slot_mins
+            end = f"{end_min // 60:02d}:{end_min % 60:02d}" if end_min < 24 * 60 else "24:00"
+            ranges = out.setdefault(day, [])
+            if ranges and last_end.get(day) == hm:
+                ranges[-1][1] = end
+            else:
+                ranges.append([hm, end])
+            last_end[day] = end
+        return out
+
+    @staticmethod
+    def _active_query(now) -> dict:
+        return {"$or": [
+            {"status": "pending", "startAt": {"$gte": now - timedelta(minutes=PENDING_HOLD_MINS)}},
+            {"status": "confirmed", "finalEndAt": {"$gte": now}},
+        ]}
+
+    # 預約目前應佔用的格子
+    def _booking_keys(self, b: dict, to_local) -> list:
+        if b["status"] == "confirmed" and b.get("finalStartAt") and b.get("finalEndAt"):
+            return self._keys(to_local(b["finalStartAt"]), to_local(b["finalEndAt"]))
+        if b.get("startAt"):
+            start = to_local(b["startAt"])
+            return self._keys(start, start + timedelta(minutes=PENDING_HOLD_MINS))
+        return []
+
+    # 由 bookings 重建整個索引（部署 / 修復用）
+    # 不先清空，也不覆蓋重建開始後才寫入的格子（heldAt 較新）：重建期間的即時佔用 / 撤銷以即時寫入為準
+    def rebuild(self, bookings_col, to_local) -> dict:
+        now = datetime.utcnow()
+        held_before = {"$or": [{"heldAt": {"$lt": now}}, {"heldAt": {"$exists": False}}]}
+        holders = {}
+        for b in bookings_col.find(self._active_query(now), _REBUILD_FIELDS):
+            for k in self._booking_keys(b, to_local):
+                holders.setdefault(k, []).append((b["_id"], b["status"]))
+        ops = []
+        for k, hs in holders.items():
+            # 同一格有重疊時以已確認的預約為主持有者，其餘記在 extraHolders
+            hs.sort(key=lambda h: h[1] != "confirmed")
+            doc = {**self._doc(k, *hs[0]), "heldAt": now}
+            if len(hs) > 1:
+                doc["extraHolders"] = [{"bookingId": i, "status": st} for i, st in hs[1:]]
+            ops.append(ReplaceOne({"_id": k, **held_before}, doc, upsert=True))
+        upserted = []
+        if ops:
+            try:
+                upserted = list(self.col.bulk_write(ops, ordered=False).upserted_ids.values())
+            except BulkWriteError as e:
+                # 格子在重建期間被即時寫入：條件不符而 upsert 撞到 _id，保留即時的內容
+                if any(err.get("code") != _DUPLICATE_KEY for err in e.details.get("writeErrors") or []):
+                    raise
+                upserted = [u["_id"] for u in e.details.get("upserted") or []]
+        restored = self._drop_released(upserted, holders, bookings_col, to_local, now)
+        removed = self.col.delete_many({"_id": {"$nin": list(holders)}, **held_before}).deleted_count
+        return {"slots": len(ops), "removed": removed + restored}
+
+    # 重建補回的格子（upsert 新增的）再對照一次 bookings：讀取快照之後才撤銷或改時間的預約，
+    # 格子已被即時刪除，不能由重建加回來
+    def _drop_released(self, upserted: list, holders: dict, bookings_col, to_local, now) -> int:
+        if not upserted:
+            return 0
+        ids = list({bid for k in upserted for bid, _ in holders[k]})
+        current = {b["_id"]: set(self._booking_keys(b, to_local))
+                   for b in bookings_col.find({"_id": {"$in": ids}, **self._active_query(now)}, _REBUILD_FIELDS)}
+        stale = [k for k in upserted if not any(k in current.get(bid, ()) for bid, _ in holders[k])]
+        if not stale:
+            return 0
+        return self.col.delete_many({"_id": {"$in": stale}, "heldAt": now}).deleted_count
@@ -0,0 +1,111 @@
+"""同步（gunicorn + Flask）與非同步（uvicorn + asgi.py）部署的負載比較
+
+先以相同的 worker 數分別啟動兩種模式（在 backend/ 目錄下）：
+    RATE_LIMIT_ENABLED=0 gunicorn -w 4 -b 127.0.0.1:8000 app:app
+    RATE_LIMIT_ENABLED=0 uvicorn asgi:app --workers 4 --port 8001
+
+所有請求都來自同一個 IP，開著限流時 booking 情境每 60 秒只有前 20 筆會進入寫入路徑，
+其餘都是 429，比較的會是限流本身；要比較兩種部署的吞吐量請關閉限流。
+429 在報告中另外計為 limited（不算 errors）；若確實要量測限流，加上 --expect-rate-limited 省略警告。
+
+再對兩者各跑一次：
+    python bench/load_test.py --base http://127.0.0.1:8000 --concurrency 64 --duration 20
+    python bench/load_test.py --base http://127.0.0.1:8001 --concurrency 64 --duration 20
+
+情境（--scenario，可重複指定）：
+  services      GET /api/services
+  availability  GET /api/availability（隨機 7 天區間）
+  booking       POST /api/bookings（隨機未來時段；多數會是 409，一樣走完整個寫入路徑）
+--service-id 用於 booking 情境；未指定時先呼叫 /api/services 取第一個。
+"""
+import argparse
+import asyncio
+import random
+import statistics
+import time
+from datetime import date, timedelta
+
+import aiohttp
+
+
+def _pct(sorted_ms: list, p: float) -> float:
+    if not sorted_ms:
+        return 0.0
+    return sorted_ms[min(len(sorted_ms) - 1, int(len(sorted_ms) * p))]
+
+
+def _request(scenario: str, rnd: random.Random, service_id: str):
+    if scenario == "services":
+        return "GET", "/api/services", None
+    day = date.today() + timedelta(days=rnd.randint(1, 120))
+    if scenario == "availability":
+        return "GET", f"/api/availability?from={day}&to={day + timedelta(days=6)}", None
+    body = {
+        "userProfile": {"userId": f"Uload{rnd.randint(0, 99999):05d}", "displayName": "load"},
+        "date": day.isoformat(),
+        "time": f"{rnd.randint(10, 19):02d}:00",
+        "serviceIds": [service_id],
+    }
+    return "POST", "/api/bookings", body
+
+
+async def worker(session, base, scenarios, service_id, deadline, results, seed):
+    rnd = random.Random(seed)
+    while time.monotonic() < deadline:
+        scenario = rnd.choice(scenarios)
+        method, path, body = _request(scenario, rnd, service_id)
+        t0 = time.perf_counter()
+        try:
+            async with session.request(method, base + path, json=body) as r:
+                await r.read()
+                status = r.status
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            # 逾時（ClientTimeout）也記成失敗，不中斷整個測試
+            status = 0
+        results.setdefault(scenario, []).append(((time.perf_counter() - t0) * 1000, status))
+
+
+async def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--base", required=True)
+    ap.add_argument("--concurrency", type=int, default=64)
+    ap.add_argument("--duration", type=float, default=20)
+    ap.add_argument("--scenario", action="append", choices=["services", "availability", "booking"])
+    ap.add_argument("--service-id")
+    ap.add_argument("--expect-rate-limited", action="store_true", help="量測限流本身，出現 429 時不警告")
+    args = ap.parse_args()
+    scenarios = args.scenario or ["services", "availability", "booking"]
+
+    conn = aiohttp.TCPConnector(limit=args.concurrency)
+    async with aiohttp.ClientSession(connector=conn, timeout=aiohttp.ClientTimeout(total=30)) as session:
+        service_id = args.service_id
+        if "booking" in scenarios and not service_id:
+            async with session.get(args.base + "/api/services") as r:
+                service_id = (await r.json())[0]["_id"]
+
+        results = {}
+        t0 = time.monotonic()
+        deadline = t0 + args.duration
+        await asyncio.gather(*(worker(session, args.base, scenarios, service_id, deadline, results, i)
+                               for i in range(args.concurrency)))
+        elapsed = time.monotonic() - t0
+
+    print(f"{args.base} concurrency={args.concurrency} duration={elapsed:.1f}s")
+    total = 0
+    total_limited = 0
+    for scenario, rows in sorted(results.items()):
+        ms = sorted(r[0] for r in rows)
+        errors = sum(1 for _, s in rows if s == 0 or s >= 500)
+        limited = sum(1 for _, s in rows if s == 429)
+        total += len(rows)
+        total_limited += limited
+        print(f"  {scenario:12s} n={len(rows):7d} rps={len(rows) / elapsed:8.1f} "
+              f"p50={_pct(ms, 0.5):7.1f}ms p95={_pct(ms, 0.95):7.1f}ms p99={_pct(ms, 0.99):7.1f}ms "
+              f"mean={statistics.fmean(ms):7.1f}ms errors={errors} limited={limited}")
+    print(f"  total        rps={total / elapsed:8.1f}")
+    if total_limited and not args.expect_rate_limited:
+        print(f"  警告：{total_limited} 個請求被限流（429），結果量測的是限流；請以 RATE_LIMIT_ENABLED=0 啟動伺服器")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,150 @@
+"""待確認預約列表的讀取方式比較（10k 筆 pending）
+
+    python bench/pending_read_model.py                 # 使用 MONGO_URI（寫入 minyue_bench 資料庫）
+    python bench/pending_read_model.py --mock          # 使用 mongomock（只比較程式路徑，不代表真實延遲）
+
+比較三種做法，每種都以 200 筆一頁讀完全部：
+  fanout   原本的做法：bookings + users $in + services $in，Python 端組合
+  lookup   單一 aggregation：$lookup users / services，伺服器端 projection 與分頁
+  snapshot 預約上的 userSnapshot / serviceNames 快照，只讀 bookings
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+
+PAGE = 200
+PROJECTION = {"userId": 1, "date": 1, "time": 1, "serviceIds": 1, "status": 1, "startAt": 1}
+
+
+def seed(db, n: int):
+    for name in ("bookings", "users", "services"):
+        db[name].drop()
+    services = [{"_id": ObjectId(), "name": f"服務{i}", "price": 100 * i, "is_active": True, "display_order": i}
+                for i in range(12)]
+    db.services.insert_many(services)
+    users = [{"userId": f"U{i:05d}", "displayName": f"顧客{i}", "phone": f"09{i:08d}"} for i in range(n // 3)]
+    db.users.insert_many(users)
+    rnd = random.Random(42)
+    now = datetime.utcnow()
+    docs = []
+    for i in range(n):
+        u = rnd.choice(users)
+        svcs = rnd.sample(services, rnd.randint(1, 3))
+        start = now + timedelta(hours=1 + i)
+        docs.append({
+            "userId": u["userId"], "date": start.strftime("%Y-%m-%d"), "time": start.strftime("%H:00"),
+            "serviceIds": [s["_id"] for s in svcs], "status": "pending", "startAt": start,
+            "userSnapshot": {"displayName": u["displayName"], "phone": u["phone"]},
+            "serviceNames": [s["name"] for s in svcs],
+        })
+    db.bookings.insert_many(docs)
+    db.bookings.create_index([("status", 1), ("startAt", 1), ("_id", 1)])
+    db.users.create_index("userId", unique=True)
+
+
+def _after(last):
+    if not last:
+        return {}
+    return {"$or": [{"startAt": {"$gt": last["startAt"]}},
+                    {"startAt": last["startAt"], "_id": {"$gt": last["_id"]}}]}
+
+
+def read_fanout(db, now) -> int:
+    n, last = 0, None
+    while True:
+        q = {"status": "pending", "startAt": {"$gte": now}, **_after(last)}
+        page = list(db.bookings.find(q, PROJECTION).sort([("startAt", 1), ("_id", 1)]).limit(PAGE))
+        if not page:
+            return n
+        users = {u["userId"]: u for u in db.users.find(
+            {"userId": {"$in": list({b["userId"] for b in page})}}, {"_id": 0, "userId": 1, "displayName": 1, "phone": 1})}
+        sids = list({sid for b in page for sid in b["serviceIds"]})
+        names = {s["_id"]: s["name"] for s in db.services.find({"_id": {"$in": sids}}, {"name": 1})}
+        for b in page:
+            u = users.get(b["userId"], {})
+            b["user"] = {"displayName": u.get("displayName"), "phone": u.get("phone")}
+            b["serviceNames"] = [names[s] for s in b["serviceIds"] if s in names]
+        n += len(page)
+        last = page[-1]
+
+
+def read_lookup(db, now) -> int:
+    n, last = 0, None
+    while True:
+        pipeline = [
+            {"$match": {"status": "pending", "startAt": {"$gte": now}, **_after(last)}},
+            {"$sort": {"startAt": 1, "_id": 1}},
+            {"$limit": PAGE},
+            {"$project": PROJECTION},
+            {"$lookup": {"from": "users", "localField": "userId", "foreignField": "userId", "as": "user"}},
+            {"$lookup": {"from": "services", "localField": "serviceIds", "foreignField": "_id", "as": "services"}},
+            {"$project": {**PROJECTION, "user.displayName": 1, "user.phone": 1, "services._id": 1, "services.name": 1}},
+        ]
+        page = list(db.bookings.aggregate(pipeline))
+        if not page:
+            return n
+        for b in page:
+            b["user"] = b["user"][0] if b["user"] else {}
+            # $lookup 不保證順序，依 serviceIds 排回原本順序
+            names = {s["_id"]: s["name"] for s in b.pop("services")}
+            b["serviceNames"] = [names[s] for s in b["serviceIds"] if s in names]
+        n += len(page)
+        last = page[-1]
+
+
+def read_snapshot(db, now) -> int:
+    n, last = 0, None
+    proj = {**PROJECTION, "userSnapshot": 1, "serviceNames": 1}
+    while True:
+        q = {"status": "pending", "startAt": {"$gte": now}, **_after(last)}
+        page = list(db.bookings.find(q, proj).sort([("startAt", 1), ("_id", 1)]).limit(PAGE))
+        if not page:
+            return n
+        for b in page:
+            b["user"] = b.pop("userSnapshot") or {}
+        n += len(page)
+        last = page[-1]
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--rows", type=int, default=10_000)
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--mock", action="store_true")
+    args = ap.parse_args()
+
+    if args.mock:
+        import mongomock
+        client = mongomock.MongoClient()
+    else:
+        from pymongo import MongoClient
+        uri = os.environ.get("MONGO_URI")
+        if not uri:
+            sys.exit("MONGO_URI 未設定（或加上 --mock）")
+        client = MongoClient(uri)
+    db = client.minyue_bench
+    seed(db, args.rows)
+    now = datetime.utcnow()
+
+    print(f"rows={args.rows} page={PAGE} repeat={args.repeat}{' (mongomock)' if args.mock else ''}")
+    for name, fn in (("fanout", read_fanout), ("lookup", read_lookup), ("snapshot", read_snapshot)):
+        times = []
+        for _ in range(args.repeat):
+            t0 = time.perf_counter()
+            n = fn(db, now)
+            times.append((time.perf_counter() - t0) * 1000)
+        print(f"{name:9s} rows={n:6d}  median={statistics.median(times):8.1f}ms  min={min(times):8.1f}ms")
+
+    if not args.mock:
+        for name in ("bookings", "users", "services"):
+            db[name].drop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""API 回應序列化吞吐量（10k 筆預約）
+
+    python bench/serialization.py [--rows 10000] [--repeat 5]
+
+比較：
+  stdlib    原本的做法：每個欄位 astimezone(ZoneInfo) + Flask 內建 json
+  orjson    LocalClock 固定 offset + OrjsonProvider
+另外量測 gzip 壓縮的額外耗時與壓縮後大小。不需要 MongoDB。
+"""
+import argparse
+import gzip
+import os
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bson import ObjectId  # noqa: E402
+from flask import Flask  # noqa: E402
+from flask.json.provider import DefaultJSONProvider  # noqa: E402
+
+from serialize import COMPRESS_LEVEL, LocalClock, OrjsonProvider, orjson, utc_iso  # noqa: E402
+
+TAIPEI = ZoneInfo("Asia/Taipei")
+
+
+def make_docs(n: int) -> list:
+    now = datetime.utcnow().replace(microsecond=123000)
+    svc = [ObjectId() for _ in range(3)]
+    docs = []
+    for i in range(n):
+        start = now + timedelta(hours=i)
+        docs.append({
+            "_id": ObjectId(), "userId": f"U{i:05d}", "date": start.strftime("%Y-%m-%d"),
+            "time": start.strftime("%H:00"), "serviceIds": svc[: 1 + i % 3], "status": "confirmed",
+            "startAt": start, "finalStartAt": start, "finalEndAt": start + timedelta(hours=1),
+            "calendarEventId": None, "calendarHtmlLink": None, "reminderId": ObjectId(),
+            "createdAt": now, "updatedAt": now,
+            "userSnapshot": {"displayName": f"顧客{i}", "phone": "0912345678"}, "serviceNames": ["剪髮", "染髮"],
+        })
+    return docs
+
+
+# 原本 app.py 的 _iso_or_none / _to_local
+def _old_iso(dt):
+    if not dt:
+        return None
+    if dt.tzinfo is None:
+        return dt.replace(tzinfo=timezone.utc).isoformat()
+    return dt.isoformat()
+
+
+def _old_local(dt):
+    return None if dt is None else dt.replace(tzinfo=timezone.utc).astimezone(TAIPEI)
+
+
+def shape(doc, iso, local_iso) -> dict:
+    return {
+        "_id": str(doc["_id"]), "userId": doc["userId"], "date": doc["date"], "time": doc["time"],
+        "serviceIds": [str(x) for x in doc["serviceIds"]], "status": doc["status"],
+        "startAt": iso(doc["startAt"]), "startAtLocal": local_iso(doc["startAt"]),
+        "finalStartAt": iso(doc["finalStartAt"]), "finalStartAtLocal": local_iso(doc["finalStartAt"]),
+        "finalEndAt": iso(doc["finalEndAt"]), "finalEndAtLocal": local_iso(doc["finalEndAt"]),
+        "calendarEventId": doc["calendarEventId"], "calendarHtmlLink": doc["calendarHtmlLink"],
+        "reminderId": str(doc["reminderId"]), "createdAt": iso(doc["createdAt"]), "updatedAt": iso(doc["updatedAt"]),
+        "user": doc["userSnapshot"], "serviceNames": doc["serviceNames"],
+    }
+
+
+def run(label, fn, repeat):
+    times = []
+    out = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        out = fn()
+        times.append((time.perf_counter() - t0) * 1000)
+    return label, statistics.median(times), out
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--rows", type=int, default=10_000)
+    ap.add_argument("--repeat", type=int, default=5)
+    args = ap.parse_args()
+    if orjson is None:
+        sys.exit("orjson 未安裝")
+
+    docs = make_docs(args.rows)
+    clock = LocalClock(TAIPEI)
+    std_app, fast_app = Flask("std"), Flask("fast")
+    std_app.json = DefaultJSONProvider(std_app)
+    fast_app.json = OrjsonProvider(fast_app)
+
+    def stdlib():
+        with std_app.app_context():
+            return std_app.json.response([shape(d, _old_iso, lambda dt: _old_iso(_old_local(dt))) for d in docs]).get_data()
+
+    def fast():
+        with fast_app.app_context():
+            return fast_app.json.response([shape(d, utc_iso, clock.local_iso) for d in docs]).get_data()
+
+    print(f"rows={args.rows} repeat={args.repeat}")
+    results = [run("stdlib", stdlib, args.repeat), run("orjson", fast, args.repeat)]
+    base = results[0][1]
+    for label, ms, body in results:
+        print(f"{label:8s} median={ms:8.1f}ms  {args.rows / ms * 1000:10.0f} docs/s  {len(body) / 1024:8.1f} KiB"
+              f"  x{base / ms:.2f}")
+    body = results[1][2]
+    label, ms, gz = run("gzip", lambda: gzip.compress(body, compresslevel=COMPRESS_LEVEL, mtime=0), args.repeat)
+    print(f"gzip     +{ms:.1f}ms  {len(gz) / 1024:.1f} KiB ({len(gz) / len(body):.1%})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""統計重建與同時寫入的競態檢查（StatsRollup.rebuild 期間新增消費紀錄 / 確認預約）
+
+    python bench/stats_rebuild_races.py                # 使用 MONGO_URI（寫入 minyue_bench 資料庫）
+
+重建的 pipeline 用到 $trim、$dateToString timezone，mongomock 不支援，需要真的 mongod。
+
+情境（在 pipeline 之前、rename 前後插入寫入，最後與靜止狀態下再重建一次的結果比較）：
+  visits         rename 之前與之後各新增一筆消費紀錄；rename 之後的那筆不能被算兩次
+  confirmations  pipeline 掃描前改期一筆已確認的預約；pipeline 跑完、rename 之前確認一筆新預約並改期
+                 另一筆，rename 之後再改期一次；計數不能遺失也不能重複
+"""
+import argparse
+import os
+import sys
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+
+from bson import ObjectId
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND)
+
+from stats import StatsRollup  # noqa: E402
+
+TAIPEI = ZoneInfo("Asia/Taipei")
+FIELDS = ("revenue", "visits", "bookingsConfirmed")
+
+
+class RacingRollup(StatsRollup):
+    # scan：pipeline 開始之前；before / after：rename 前後各執行一次的寫入
+    def __init__(self, *args, scan=None, before=None, after=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.scan = scan
+        self.before = before
+        self.after = after
+
+    def _aggregate(self, *args):
+        if self.scan:
+            self.scan()
+        return super()._aggregate(*args)
+
+    def _swap(self):
+        if self.before:
+            self.before()
+        super()._swap()
+        if self.after:
+            self.after()
+
+
+def seed(db):
+    for name in ("hair_records", "bookings", "services", "stats_rollups", "stats_rollups_rebuild", "meta"):
+        db[name].drop()
+    svc = {"_id": ObjectId(), "name": "剪髮"}
+    db.services.insert_one(svc)
+    db.hair_records.insert_many([{"date": "2026-03-0%d" % (1 + i % 3), "amount": 500, "userId": f"U{i}",
+                                  "items": ["剪髮"]} for i in range(6)])
+    db.bookings.insert_many([
+        {"status": "confirmed", "finalStartAt": datetime(2026, 3, 1, 2), "serviceIds": [svc["_id"]]},
+        {"status": "confirmed", "finalStartAt": datetime(2026, 3, 1, 4), "serviceIds": [svc["_id"]]},
+        {"status": "pending", "startAt": datetime(2026, 3, 2, 2), "serviceIds": [svc["_id"]]},
+    ])
+    return svc
+
+
+def snapshot(col) -> dict:
+    return {d["_id"]: {f: d.get(f, 0) for f in FIELDS} for d in col.find()}
+
+
+def add_visit(db, rollup, date: str):
+    rec = {"date": date, "amount": 300, "userId": "U-new", "items": ["剪髮"]}
+    db.hair_records.insert_one(rec)
+    rollup.record_visit(rec)
+
+
+# 與 admin_confirm_booking 相同的寫入順序
+def confirm(db, rollup, svc, b: dict, start_utc: datetime):
+    now = datetime.utcnow()
+    fields = rollup.confirmation_fields(b, now, rollup.rebuild_boundary())
+    db.bookings.update_one({"_id": b["_id"]}, {"$set": {"status": "confirmed", "finalStartAt": start_utc, **fields}})
+    start_local = start_utc.replace(tzinfo=ZoneInfo("UTC")).astimezone(TAIPEI)
+    rollup.record_confirmations([(b, start_local, [svc["name"]])], now)
+
+
+def check(name: str, db, rollup) -> bool:
+    got = snapshot(db.stats_rollups)
+    StatsRollup(db.stats_rollups, TAIPEI, db.meta, grace_secs=0).rebuild(
+        [db.hair_records], [db.bookings], lambda ids: {s["_id"]: s["name"] for s in db.services.find()})
+    want = snapshot(db.stats_rollups)
+    diff = {k: (got.get(k), want.get(k)) for k in set(got) | set(want) if got.get(k) != want.get(k)}
+    print(f"{name:<14} {'ok' if not diff else 'MISMATCH'}")
+    for k, (g, w) in sorted(diff.items()):
+        print(f"  {k}: got {g} want {w}")
+    return not diff
+
+
+def run_visits(db) -> bool:
+    seed(db)
+    rollup = RacingRollup(db.stats_rollups, TAIPEI, db.meta, grace_secs=0)
+    rollup.before = lambda: add_visit(db, rollup, "2026-03-04")
+    rollup.after = lambda: add_visit(db, rollup, "2026-03-05")
+    rollup.rebuild([db.hair_records], [db.bookings], lambda ids: {s["_id"]: s["name"] for s in db.services.find()})
+    return check("visits", db, rollup)
+
+
+def run_confirmations(db) -> bool:
+    svc = seed(db)
+    rollup = RacingRollup(db.stats_rollups, TAIPEI, db.meta, grace_secs=0)
+    confirmed, early = db.bookings.find({"status": "confirmed"}).sort("finalStartAt", 1)
+    pending = db.bookings.find_one({"status": "pending"})
+
+    def scan():
+        confirm(db, rollup, svc, early, early["finalStartAt"] + timedelta(days=3))
+
+    def before():
+        confirm(db, rollup, svc, pending, datetime(2026, 3, 2, 2))
+        confirm(db, rollup, svc, confirmed, confirmed["finalStartAt"] + timedelta(days=2))
+
+    # 再改期一次：statsBase 仍是分界當下的狀態
+    def after():
+        moved = db.bookings.find_one({"_id": confirmed["_id"]})
+        confirm(db, rollup, svc, moved, moved["finalStartAt"] + timedelta(days=1))
+
+    rollup.scan = scan
+    rollup.before = before
+    rollup.after = after
+    rollup.rebuild([db.hair_records], [db.bookings], lambda ids: {s["_id"]: s["name"] for s in db.services.find()})
+    return check("confirmations", db, rollup)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mongo-uri", default=os.environ.get("MONGO_URI", "mongodb://localhost:27017"))
+    args = parser.parse_args()
+    from pymongo import MongoClient
+    db = MongoClient(args.mongo_uri)["minyue_bench"]
+    ok = all([run_visits(db), run_confirmations(db)])
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
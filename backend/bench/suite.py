@@ -0,0 +1,426 @@
+"""離線效能測試：Flask app + 本機替身（mongomock 或本機 mongod、假的 LINE / Google Calendar）
+
+    python bench/suite.py                                   # mongomock，全部情境
+    python bench/suite.py --scenario admin_lists --scale 100000
+    python bench/suite.py --mongo-uri mongodb://localhost:27017 --concurrency 8
+    python bench/suite.py --json out/$(git rev-parse --short HEAD).json --compare out/base.json
+
+預設模式需要 mongomock：pip install -r bench/requirements.txt（在 backend/ 目錄下）。
+mongomock 4.3 只相容 pymongo 4.7.x；motor 帶進較新的 pymongo（例如 4.18）時 cron_dispatch 的 bulk_write 會出錯，
+同一個環境也裝了 requirements-asgi.txt 時請確認 pymongo 仍是 4.7.x。
+
+注意：app 固定使用 minyue_db 資料庫，--mongo-uri 只能指向可丟棄的本機 mongod（每個情境開始前會清空）。
+
+情境：
+  booking_burst  連續送出 --bookings 筆 POST /api/bookings（不同顧客、不同時段，另有 10% 撞同一時段）
+  admin_lists    種 --scale 筆顧客 / 消費紀錄 / 待確認預約，量測後台列表、搜尋與分頁
+  cron_dispatch  種 --reminders 筆到期提醒，量測 /api/admin/cron/dispatch 一輪的處理量
+
+輸出每個端點的 requests、rps、p50 / p95 / p99 與每個請求的 Mongo 指令數；
+--json 另存結果（含 commit 與參數），--compare 與先前的結果比較。
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import types
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND)
+
+
+# ----------------------------------------------------------------------------- #
+# 替身
+# ----------------------------------------------------------------------------- #
+class FakeLineBotApi:
+    def __init__(self, latency_ms: float):
+        self.latency = latency_ms / 1000
+        self.pushes = 0
+        self.multicasts = 0
+        self._lock = threading.Lock()
+
+    def push_message(self, to, messages, retry_key=None):
+        time.sleep(self.latency)
+        with self._lock:
+            self.pushes += 1
+
+    def multicast(self, to, messages, retry_key=None):
+        time.sleep(self.latency)
+        with self._lock:
+            self.multicasts += 1
+
+
+class _FakeRequest:
+    def __init__(self, latency: float, result: dict):
+        self.latency = latency
+        self.result = result
+
+    def execute(self):
+        time.sleep(self.latency)
+        return self.result
+
+
+class _FakeBatch:
+    def __init__(self, latency: float, callback):
+        self.latency = latency
+        self.callback = callback
+        self.items = []
+
+    def add(self, req, request_id=None):
+        self.items.append((request_id, req))
+
+    def execute(self):
+        # 一個 batch 只算一次往返
+        time.sleep(self.latency)
+        for rid, req in self.items:
+            self.callback(rid, req.result, None)
+
+
+class FakeCalendarService:
+    def __init__(self, latency_ms: float):
+        self.latency = latency_ms / 1000
+
+    def events(self):
+        svc = self
+
+        class _Events:
+            def insert(self, calendarId=None, body=None, sendUpdates=None):
+                eid = (body or {}).get("id") or f"ev{random.getrandbits(48):x}"
+                return _FakeRequest(svc.latency, {"id": eid, "htmlLink": f"https://calendar.test/{eid}"})
+
+            def get(self, calendarId=None, eventId=None):
+                return _FakeRequest(svc.latency, {"id": eventId, "htmlLink": f"https://calendar.test/{eventId}"})
+
+        return _Events()
+
+    def calendarList(self):
+        svc = self
+
+        class _List:
+            def get(self, calendarId=None):
+                return _FakeRequest(svc.latency, {"id": calendarId, "summary": "bench"})
+
+        return _List()
+
+    def new_batch_http_request(self, callback=None):
+        return _FakeBatch(self.latency, callback)
+
+
+# mongomock 不會發出 command monitoring 事件：直接在 Collection 方法上計數
+_MOCK_OPS = ("find", "find_one", "insert_one", "insert_many", "update_one", "update_many", "replace_one",
+             "delete_one", "delete_many", "find_one_and_update", "bulk_write", "aggregate", "count_documents",
+             "distinct")
+
+
+class OpCounter:
+    def __init__(self):
+        self.n = 0
+        self._lock = threading.Lock()
+
+    def hit(self):
+        with self._lock:
+            self.n += 1
+
+
+def patch_mongomock(counter: OpCounter):
+    try:
+        import mongomock
+    except ImportError:
+        sys.exit("需要 mongomock：pip install -r bench/requirements.txt，或改用 --mongo-uri 指向本機 mongod")
+    import pymongo
+
+    if not pymongo.version.startswith("4.7."):
+        print(f"[BENCH] 警告：mongomock 只相容 pymongo 4.7.x，目前是 {pymongo.version}", file=sys.stderr)
+
+    for name in _MOCK_OPS:
+        orig = getattr(mongomock.collection.Collection, name)
+
+        def wrapped(self, *a, __orig=orig, **kw):
+            counter.hit()
+            return __orig(self, *a, **kw)
+
+        setattr(mongomock.collection.Collection, name, wrapped)
+    pymongo.MongoClient = mongomock.MongoClient
+
+
+def load_app(args, counter: OpCounter):
+    os.environ.setdefault("ADMIN_TOKEN", "bench")
+    os.environ.setdefault("CRON_SECRET", "bench")
+    # outbox 背景執行緒不在量測範圍內
+    os.environ["OUTBOX_MODE"] = "off"
+    os.environ["REMINDER_SCHEDULER"] = "off"
+    # 所有請求都來自同一個 IP，預設關閉限流（--rate-limit 打開時量測限流本身的成本）
+    os.environ["RATE_LIMIT_ENABLED"] = "1" if args.rate_limit else "0"
+    os.environ["LINE_RATE_PER_SEC"] = str(args.line_rate)
+    os.environ["LINE_RATE_BURST"] = str(max(1, int(args.line_rate)))
+    if args.mongo_uri:
+        os.environ["MONGO_URI"] = args.mongo_uri
+    else:
+        os.environ["MONGO_URI"] = "mongodb://bench.invalid"
+        patch_mongomock(counter)
+
+    import app as m
+    m.app.testing = True
+
+    fake_line = FakeLineBotApi(args.line_latency_ms)
+    m.line_delivery.token = "bench"
+    m.line_delivery._api = fake_line
+    fake_cal = FakeCalendarService(args.google_latency_ms)
+    m.google_calendar.credentials = lambda: types.SimpleNamespace(token="bench", valid=True, expiry=None)
+    m.google_calendar.service = lambda: fake_cal
+
+    if args.mongo_uri:
+        # 真的 mongod：用 CommandListener 的累計次數
+        def mongo_ops():
+            with m.metrics.MONGO_DURATION._lock:
+                return sum(v["count"] for v in m.metrics.MONGO_DURATION._values.values())
+        counter.read = mongo_ops
+    else:
+        counter.read = lambda: counter.n
+    return m, fake_line
+
+
+# ----------------------------------------------------------------------------- #
+# 量測
+# ----------------------------------------------------------------------------- #
+class Recorder:
+    def __init__(self, counter):
+        self.counter = counter
+        self.rows = {}
+
+    def run(self, name: str, calls: list, concurrency: int = 1):
+        """calls：[(callable, 預期狀態碼集合)]"""
+        latencies = []
+        bad = 0
+        ops0 = self.counter.read()
+        t0 = time.perf_counter()
+
+        def one(call):
+            fn, ok = call
+            s = time.perf_counter()
+            resp = fn()
+            return (time.perf_counter() - s) * 1000, resp.status_code in ok
+
+        if concurrency > 1:
+            with ThreadPoolExecutor(concurrency) as pool:
+                results = list(pool.map(one, calls))
+        else:
+            results = [one(c) for c in calls]
+        elapsed = time.perf_counter() - t0
+        for ms, good in results:
+            latencies.append(ms)
+            bad += 0 if good else 1
+        ops = self.counter.read() - ops0
+        lat = sorted(latencies)
+
+        def pct(p):
+            return round(lat[min(len(lat) - 1, int(len(lat) * p))], 2) if lat else 0.0
+
+        row = {
+            "requests": len(lat),
+            "rps": round(len(lat) / elapsed, 1) if elapsed else 0.0,
+            "p50": pct(0.50), "p95": pct(0.95), "p99": pct(0.99),
+            "mean": round(statistics.fmean(lat), 2) if lat else 0.0,
+            "mongoOpsPerReq": round(ops / len(lat), 2) if lat else 0.0,
+            "unexpected": bad,
+        }
+        self.rows[name] = row
+        print(f"  {name:40s} n={row['requests']:6d} rps={row['rps']:8.1f} p50={row['p50']:8.2f} "
+              f"p95={row['p95']:8.2f} p99={row['p99']:8.2f}ms ops/req={row['mongoOpsPerReq']:6.2f}"
+              + (f" unexpected={bad}" if bad else ""))
+        return row
+
+
+def reset(m):
+    for col in (m.bookings_col, m.users_col, m.customers_col, m.hair_records_col, m.reminders_col,
+                m.outbox_col, m.slots_col, m.stats_col, m.services_col, m.meta_col, m.idempotency_col,
+                m.rate_limits_col):
+        col.delete_many({})
+    m.run_migrations()
+    ids = []
+    for i, (name, price) in enumerate([("剪髮", 500), ("染髮", 1500), ("燙髮", 2500), ("護髮", 800)]):
+        ids.append(str(m.services_col.insert_one(
+            {"name": name, "price": price, "is_active": True, "display_order": i}).inserted_id))
+    m.service_catalog.invalidate()
+    return ids
+
+
+ADMIN = {"X-Admin-Token": "bench"}
+
+
+def scenario_booking_burst(m, rec, args):
+    print("booking_burst")
+    ids = reset(m)
+    rnd = random.Random(1)
+    base = datetime.now() + timedelta(days=7)
+    calls = []
+    ok = {201, 409, 429} if args.rate_limit else {201, 409}
+    for i in range(args.bookings):
+        # 每 10 筆有一筆刻意撞已用過的時段（409 路徑）
+        slot = i - 1 if i % 10 == 9 else i
+        day = base + timedelta(days=slot // 10)
+        body = {
+            "userProfile": {"userId": f"Ub{i:06d}", "displayName": f"顧客{i}"},
+            "date": day.strftime("%Y-%m-%d"),
+            "time": f"{10 + slot % 10:02d}:00",
+            "serviceIds": rnd.sample(ids, rnd.randint(1, 2)),
+        }
+        client = m.app.test_client()
+        calls.append((lambda b=body, c=client: c.post("/api/bookings", json=b), ok))
+    rec.run("POST /api/bookings", calls, args.concurrency)
+    m._background.submit(lambda: None).result()
+
+
+def scenario_admin_lists(m, rec, args):
+    print(f"admin_lists (scale={args.scale})")
+    ids = reset(m)
+    from bson import ObjectId
+    from search import customer_keys
+    rnd = random.Random(2)
+    now = datetime.utcnow()
+    surnames = "陳林黃張李王吳劉蔡楊"
+    customers = []
+    for i in range(args.scale):
+        c = {"_id": ObjectId(), "name": f"{surnames[i % 10]}小{i}", "nickname": "", "phone": f"09{i:08d}",
+             "lineUserId": f"U{i:06d}", "lineDisplayName": f"line{i}", "birthday": "", "note": "",
+             "createdAt": now, "updatedAt": now - timedelta(seconds=i)}
+        c.update(customer_keys(c))
+        customers.append(c)
+    for i in range(0, len(customers), 5000):
+        m.customers_col.insert_many(customers[i:i + 5000])
+    records = []
+    for i in range(args.scale):
+        c = customers[rnd.randrange(len(customers))]
+        records.append({"customerId": c["_id"], "userId": None, "date": f"2025-{1 + i % 12:02d}-{1 + i % 28:02d}",
+                        "items": ["剪髮"], "amount": 500, "createdAt": now, "updatedAt": now})
+    for i in range(0, len(records), 5000):
+        m.hair_records_col.insert_many(records[i:i + 5000])
+    pending = []
+    for i in range(args.scale):
+        start = now + timedelta(hours=1 + i)
+        pending.append({"userId": f"U{i:06d}", "date": start.strftime("%Y-%m-%d"), "time": start.strftime("%H:00"),
+                        "serviceIds": [ObjectId(ids[0])], "status": "pending", "startAt": start,
+                        "userSnapshot": {"displayName": f"line{i}", "phone": f"09{i:08d}"},
+                        "serviceNames": ["剪髮"], "createdAt": now, "updatedAt": now})
+    for i in range(0, len(pending), 5000):
+        m.bookings_col.insert_many(pending[i:i + 5000])
+
+    c = m.app.test_client()
+    n = args.list_requests
+    rec.run("GET /api/admin/customers", [(lambda: c.get("/api/admin/customers", headers=ADMIN), {200})] * n)
+    rec.run("GET /api/admin/customers?q=陳小", [(lambda: c.get("/api/admin/customers?q=陳小", headers=ADMIN), {200})] * n)
+    rec.run("GET /api/admin/customers?q=0900001",
+            [(lambda: c.get("/api/admin/customers?q=0900001", headers=ADMIN), {200})] * n)
+    cursor = c.get("/api/admin/customers", headers=ADMIN).headers.get("X-Next-Cursor")
+    if cursor:
+        rec.run("GET /api/admin/customers (page 2)",
+                [(lambda: c.get(f"/api/admin/customers?cursor={cursor}", headers=ADMIN), {200})] * n)
+    rec.run("GET /api/admin/bookings/pending", [(lambda: c.get("/api/admin/bookings/pending", headers=ADMIN), {200})] * n)
+    cid = str(customers[0]["_id"])
+    rec.run("GET /api/admin/hair-records?customerId",
+            [(lambda: c.get(f"/api/admin/hair-records?customerId={cid}", headers=ADMIN), {200})] * n)
+    rec.run("GET /api/admin/stats", [(lambda: c.get("/api/admin/stats", headers=ADMIN), {200})] * n)
+
+
+def scenario_cron_dispatch(m, rec, args, fake_line):
+    print(f"cron_dispatch (reminders={args.reminders})")
+    reset(m)
+    from bson import ObjectId
+    now = datetime.utcnow()
+    docs = []
+    for i in range(args.reminders):
+        # 同一時段的提醒內容相同，會被合併成 multicast
+        slot = i % 20
+        docs.append({"_id": ObjectId(), "bookingId": ObjectId(), "userId": f"U{i:06d}", "channel": "line",
+                     "message": f"溫馨提醒：您的預約將於 {10 + slot % 10}:00 開始", "dueAt": now - timedelta(minutes=1),
+                     "status": "scheduled", "attempts": 0, "createdAt": now, "updatedAt": now - timedelta(minutes=5)})
+    for i in range(0, len(docs), 5000):
+        m.reminders_col.insert_many(docs[i:i + 5000])
+    c = m.app.test_client()
+    pushes0, multi0 = fake_line.pushes, fake_line.multicasts
+    t0 = time.perf_counter()
+    row = rec.run("GET /api/admin/cron/dispatch",
+                  [(lambda: c.get("/api/admin/cron/dispatch?token=bench&deadline=600"), {200})])
+    elapsed = time.perf_counter() - t0
+    sent = m.reminders_col.count_documents({"status": "sent"})
+    row["remindersSent"] = sent
+    row["remindersPerSec"] = round(sent / elapsed, 1)
+    row["linePushCalls"] = fake_line.pushes - pushes0
+    row["lineMulticastCalls"] = fake_line.multicasts - multi0
+    print(f"    sent={sent} ({row['remindersPerSec']}/s) push={row['linePushCalls']} "
+          f"multicast={row['lineMulticastCalls']}")
+
+
+def _git_rev() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND, text=True).strip()
+    except Exception:
+        return "unknown"
+
+
+def compare(current: dict, baseline_path: str):
+    with open(baseline_path, encoding="utf-8") as f:
+        base = json.load(f)
+    print(f"\ncompare with {baseline_path} ({base.get('commit')})")
+    for name, row in current["results"].items():
+        old = base.get("results", {}).get(name)
+        if not old:
+            continue
+        def delta(k):
+            return f"{k} {old[k]:.2f}->{row[k]:.2f} ({(row[k] - old[k]) / old[k] * 100:+.0f}%)" if old[k] else k
+        print(f"  {name:40s} {delta('p50')}  {delta('p95')}  {delta('mongoOpsPerReq')}")
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--scenario", action="append", choices=["booking_burst", "admin_lists", "cron_dispatch"])
+    ap.add_argument("--mongo-uri", help="本機 mongod（預設使用 mongomock）")
+    ap.add_argument("--bookings", type=int, default=500)
+    ap.add_argument("--scale", type=int, default=10_000)
+    ap.add_argument("--list-requests", type=int, default=30)
+    ap.add_argument("--reminders", type=int, default=2000)
+    ap.add_argument("--concurrency", type=int, default=1, help="mongomock 不是 thread-safe，並行請搭配 --mongo-uri")
+    ap.add_argument("--line-latency-ms", type=float, default=80)
+    ap.add_argument("--google-latency-ms", type=float, default=150)
+    ap.add_argument("--line-rate", type=float, default=1000)
+    ap.add_argument("--rate-limit", action="store_true", help="啟用公開端點限流")
+    ap.add_argument("--json")
+    ap.add_argument("--compare")
+    args = ap.parse_args()
+
+    counter = OpCounter()
+    m, fake_line = load_app(args, counter)
+    rec = Recorder(counter)
+    scenarios = args.scenario or ["booking_burst", "admin_lists", "cron_dispatch"]
+    print(f"commit={_git_rev()} mongo={'mongod' if args.mongo_uri else 'mongomock'}")
+    if "booking_burst" in scenarios:
+        scenario_booking_burst(m, rec, args)
+    if "admin_lists" in scenarios:
+        scenario_admin_lists(m, rec, args)
+    if "cron_dispatch" in scenarios:
+        scenario_cron_dispatch(m, rec, args, fake_line)
+
+    out = {
+        "commit": _git_rev(),
+        "at": datetime.utcnow().isoformat(),
+        "mongo": "mongod" if args.mongo_uri else "mongomock",
+        "params": {k: v for k, v in vars(args).items() if k not in ("json", "compare", "mongo_uri")},
+        "results": rec.rows,
+    }
+    if args.json:
+        os.makedirs(os.path.dirname(os.path.abspath(args.json)), exist_ok=True)
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(out, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        compare(out, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+import os
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from pymongo import DeleteOne, ReplaceOne, UpdateOne
+
+from gcal import http_status
+
+# Google Calendar -> calendar_events 的增量同步（syncToken）
+# 行事曆上手動加的休假、現場客等事件也鏡像到本機，忙碌時段只查 Mongo，不再呼叫 Google
+#   第一次（或 syncToken 失效 410）：從 CALENDAR_SYNC_PAST_DAYS 天前開始整批列出
+#   之後：只帶 syncToken 取得變更（含已刪除事件）
+# 事件 _id = Google event id；start / end 為 naive UTC，全天事件以行事曆時區的午夜換算
+# 預約確認時建立的事件帶 extendedProperties.private.bookingId：時段已由 booking_slots 佔用，
+# 忙碌查詢排除這些事件（重新確認後留在行事曆上的舊事件也不會擋住顧客）
+CALENDAR_SYNC_PAST_DAYS = int(os.environ.get("CALENDAR_SYNC_PAST_DAYS", "30"))
+CALENDAR_SYNC_PAGE_SIZE = int(os.environ.get("CALENDAR_SYNC_PAGE_SIZE", "250"))
+CALENDAR_SYNC_LEASE_SECS = int(os.environ.get("CALENDAR_SYNC_LEASE_SECS", "300"))
+SYNC_META_ID = "calendar_sync"
+_EVENT_FIELDS = ("nextPageToken,nextSyncToken,"
+                 "items(id,status,summary,start,end,transparency,htmlLink,updated,extendedProperties)")
+
+
+def _parse_time(t: dict, tz):
+    if not t:
+        return None, False
+    if t.get("dateTime"):
+        dt = datetime.fromisoformat(t["dateTime"].replace("Z", "+00:00"))
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=tz)
+        return dt.astimezone(timezone.utc).replace(tzinfo=None), False
+    if t.get("date"):
+        y, m, d = map(int, t["date"].split("-"))
+        return datetime(y, m, d, tzinfo=tz).astimezone(timezone.utc).replace(tzinfo=None), True
+    return None, False
+
+
+class CalendarSync:
+    def __init__(self, col, meta_col, bookings_col, calendar, calendar_id: str, tz):
+        self.col = col
+        self.meta_col = meta_col
+        self.bookings_col = bookings_col
+        self.calendar = calendar
+        self.calendar_id = calendar_id
+        self.tz = tz
+
+    # (collection, keys, options)；由 migrations 建立
+    def indexes(self) -> list:
+        return [
+            (self.col, [("start", 1), ("end", 1)], {}),
+            (self.bookings_col, [("calendarEventId", 1)], {"sparse": True}),
+        ]
+
+    def _doc(self, ev: dict, now) -> dict:
+        start, all_day = _parse_time(ev.get("start"), self.tz)
+        end, _ = _parse_time(ev.get("end"), self.tz)
+        return {
+            "_id": ev["id"],
+            "summary": ev.get("summary"),
+            "start": start,
+            "end": end,
+            "allDay": all_day,
+            # 「顯示為有空」的事件不算忙碌
+            "busy": ev.get("transparency") != "transparent",
+            "htmlLink": ev.get("htmlLink"),
+            "bookingId": ((ev.get("extendedProperties") or {}).get("private") or {}).get("bookingId"),
+            "updated": ev.get("updated"),
+            "syncedAt": now,
+        }
+
+    # 同一時間只讓一個 worker 同步（syncToken 只能依序使用）
+    def _claim(self, now) -> str:
+        token = uuid.uuid4().hex
+        res = self.meta_col.update_one(
+            {"_id": SYNC_META_ID, "$or": [{"leaseUntil": {"$lt": now}}, {"leaseUntil": {"$exists": False}}]},
+            {"$set": {"leaseUntil": now + timedelta(seconds=CALENDAR_SYNC_LEASE_SECS), "leaseToken": token}},
+        )
+        if res.matched_count:
+            return token
+        # 第一次執行：還沒有 meta 文件
+        if self.meta_col.find_one({"_id": SYNC_META_ID}, {"_id": 1}) is None:
+            self.meta_col.update_one(
+                {"_id": SYNC_META_ID},
+                {"$setOnInsert": {"leaseUntil": now + timedelta(seconds=CALENDAR_SYNC_LEASE_SECS),
+                                  "leaseToken": token}},
+                upsert=True)
+            doc = self.meta_col.find_one({"_id": SYNC_META_ID}, {"leaseToken": 1})
+            if doc and doc.get("leaseToken") == token:
+                return token
+        return None
+
+    def _list(self, svc, sync_token):
+        kwargs = {"calendarId": self.calendar_id, "singleEvents": True, "maxResults": CALENDAR_SYNC_PAGE_SIZE,
+                  "fields": _EVENT_FIELDS}
+        if sync_token:
+            kwargs["syncToken"] = sync_token
+        else:
+            start = datetime.now(timezone.utc) - timedelta(days=CALENDAR_SYNC_PAST_DAYS)
+            kwargs["timeMin"] = start.isoformat().replace("+00:00", "Z")
+        page_token = None
+        while True:
+            resp = self.calendar.execute(svc.events().list(**kwargs, pageToken=page_token), "events.list")
+            yield resp
+            page_token = resp.get("nextPageToken")
+            if not page_token:
+                return
+
+    # 一輪同步；回傳統計。full=True 時忽略既有的 syncToken 重新整批列出
+    def sync(self, full: bool = False) -> dict:
+        now = datetime.utcnow()
+        lease = self._claim(now)
+        if lease is None:
+            return {"skipped": "另一個同步正在進行"}
+        stats = {"full": False, "upserted": 0, "deleted": 0, "pages": 0, "bookingsUpdated": 0}
+        try:
+            state = self.meta_col.find_one({"_id": SYNC_META_ID}) or {}
+            sync_token = None if full or state.get("calendarId") != self.calendar_id else state.get("syncToken")
+            svc = self.calendar.service()
+            try:
+                next_token = self._apply_pages(svc, sync_token, now, stats)
+            except Exception as e:
+                if not (sync_token and http_status(e) == 410):
+                    raise
+                # syncToken 過期：清掉本機鏡像重新整批同步
+                sync_token = None
+                next_token = self._apply_pages(svc, None, now, stats)
+            stats["full"] = sync_token is None
+            self.meta_col.update_one(
+                {"_id": SYNC_META_ID, "leaseToken": lease},
+                {"$set": {"syncToken": next_token, "calendarId": self.calendar_id, "syncedAt": datetime.utcnow(),
+                          "lastStats": stats}})
+            return stats
+        finally:
+            self.meta_col.update_one({"_id": SYNC_META_ID, "leaseToken": lease},
+                                     {"$unset": {"leaseUntil": "", "leaseToken": ""}})
+
+    def _apply_pages(self, svc, sync_token, now, stats: dict):
+        full = sync_token is None
+        seen = set()
+        next_token = None
+        for page in self._list(svc, sync_token):
+            stats["pages"] += 1
+            ops = []
+            changed, deleted = {}, []
+            for ev in page.get("items") or []:
+                if ev.get("status") == "cancelled":
+                    ops.append(DeleteOne({"_id": ev["id"]}))
+                    deleted.append(ev["id"])
+                else:
+                    doc = self._doc(ev, now)
+                    ops.append(ReplaceOne({"_id": ev["id"]}, doc, upsert=True))
+                    changed[ev["id"]] = doc
+                    seen.add(ev["id"])
+            if ops:
+                self.col.bulk_write(ops, ordered=True)
+            stats["upserted"] += len(changed)
+            stats["deleted"] += len(deleted)
+            stats["bookingsUpdated"] += self._reconcile(changed, deleted)
+            next_token = page.get("nextSyncToken") or next_token
+        if full:
+            # 整批同步時沒出現的事件代表已不存在（或早於同步範圍）
+            gone = [d["_id"] for d in self.col.find({"_id": {"$nin": list(seen)}}, {"_id": 1})]
+            if gone:
+                self.col.delete_many({"_id": {"$in": gone}})
+                stats["deleted"] += len(gone)
+                stats["bookingsUpdated"] += self._reconcile({}, gone, past_ok=False)
+        return next_token
+
+    # 預約上的 calendarEventId / calendarHtmlLink 對齊行事曆：
+    # 事件被刪掉就清掉連結並記下 calendarEventDeletedAt；被移動時記下行事曆上的時間，方便後台比對
+    def _reconcile(self, changed: dict, deleted: list, past_ok: bool = True) -> int:
+        now = datetime.utcnow()
+        n = 0
+        if changed:
+            ops = []
+            for b in self.bookings_col.find({"calendarEventId": {"$in": list(changed)}},
+                                            {"calendarEventId": 1, "calendarHtmlLink": 1, "finalStartAt": 1,
+                                             "finalEndAt": 1}):
+                ev = changed[b["calendarEventId"]]
+                update = {
+                    "calendarStartAt": ev["start"],
+                    "calendarEndAt": ev["end"],
+                    "calendarMoved": (ev["start"], ev["end"]) != (b.get("finalStartAt"), b.get("finalEndAt")),
+                    "updatedAt": now,
+                }
+                if ev["htmlLink"] and ev["htmlLink"] != b.get("calendarHtmlLink"):
+                    update["calendarHtmlLink"] = ev["htmlLink"]
+                ops.append(UpdateOne({"_id": b["_id"], "calendarEventId": b["calendarEventId"]}, {"$set": update}))
+            if ops:
+                n += self.bookings_col.bulk_write(ops, ordered=False).modified_count
+        if deleted:
+            q = {"calendarEventId": {"$in": deleted}}
+            if not past_ok:
+                # 超出整批同步範圍的舊預約：事件只是沒被列出，不代表被刪除
+                q["finalEndAt"] = {"$gte": now - timedelta(days=CALENDAR_SYNC_PAST_DAYS)}
+            n += self.bookings_col.update_many(q, {
+                "$set": {"calendarEventDeletedAt": now, "updatedAt": now},
+                "$unset": {"calendarEventId": "", "calendarHtmlLink": "", "calendarStartAt": "",
+                           "calendarEndAt": "", "calendarMoved": ""},
+            }).modified_count
+        return n
+
+    # 與 [from_utc, to_utc) 重疊、不是由預約建立的忙碌事件；一次 (start, end) 索引查詢
+    @staticmethod
+    def _busy_query(from_utc, to_utc) -> dict:
+        return {"start": {"$lt": to_utc}, "end": {"$gt": from_utc}, "busy": True, "bookingId": None}
+
+    def busy_events(self, from_utc, to_utc) -> list:
+        return list(self.col.find(self._busy_query(from_utc, to_utc),
+                                  {"start": 1, "end": 1, "summary": 1}).sort("start", 1))
+
+    def overlaps(self, start_utc, end_utc) -> bool:
+        return self.col.find_one(self._busy_query(start_utc, end_utc), {"_id": 1}) is not None
+
+    def status(self) -> dict:
+        state = self.meta_col.find_one({"_id": SYNC_META_ID}, {"syncToken": 0}) or {}
+        return {
+            "calendarId": state.get("calendarId"),
+            "syncedAt": state.get("syncedAt"),
+            "lastStats": state.get("lastStats"),
+            "running": bool(state.get("leaseUntil") and state["leaseUntil"] > datetime.utcnow()),
+            "events": self.col.estimated_document_count(),
+        }
+
+
+if __name__ == "__main__":
+    # 手動同步：python -m calsync [--full]（在 backend/ 目錄下）
+    import sys
+    import app as _app
+    print(f"[CALSYNC] {_app.calendar_sync.sync(full='--full' in sys.argv)}")
@@ -0,0 +1,100 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+from pymongo import ReturnDocument
+
+# 服務項目快取：整份 services 放在記憶體，依 display_order 排序
+# 跨 gunicorn worker 的失效靠 meta collection 裡的版本號
+CATALOG_META_ID = "services_catalog"
+CATALOG_CHECK_SECS = float(os.environ.get("SERVICES_CACHE_CHECK_SECS", "5"))
+
+_PROJECTION = {"name": 1, "price": 1, "is_active": 1, "display_order": 1}
+
+
+class ServiceCatalog:
+    def __init__(self, services_col, meta_col, check_secs: float = CATALOG_CHECK_SECS):
+        self._services_col = services_col
+        self._meta_col = meta_col
+        self._check_secs = check_secs
+        self._lock = threading.Lock()
+        self._by_id = {}
+        self._snapshot = (None, [])
+        self._version = None
+        self._checked_at = 0.0
+
+    def _remote_version(self) -> int:
+        doc = self._meta_col.find_one({"_id": CATALOG_META_ID}, {"version": 1})
+        return int((doc or {}).get("version", 0))
+
+    def _reload(self, version: int):
+        docs = list(self._services_col.find({}, _PROJECTION).sort("display_order", 1))
+        by_id = {}
+        for s in docs:
+            by_id[s["_id"]] = {
+                "_id": s["_id"],
+                "name": s.get("name", ""),
+                "price": s.get("price", 0),
+                "is_active": bool(s.get("is_active", True)),
+                "display_order": s.get("display_order", 0),
+            }
+        active = [s for s in by_id.values() if s["is_active"]]
+        public = [{"_id": str(s["_id"]), "name": s["name"], "price": s["price"]} for s in active]
+        digest = hashlib.sha1(json.dumps(public, ensure_ascii=False).encode("utf-8")).hexdigest()
+        self._by_id = by_id
+        self._snapshot = (f"svc-{digest[:16]}", active)
+        self._version = version
+
+    def _ensure_fresh(self, recheck: bool = False):
+        now = time.monotonic()
+        if not recheck and self._version is not None and now - self._checked_at < self._check_secs:
+            return
+        with self._lock:
+            if not recheck and self._version is not None and now - self._checked_at < self._check_secs:
+                return
+            version = self._remote_version()
+            if version != self._version:
+                self._reload(version)
+            self._checked_at = time.monotonic()
+
+    def active(self) -> list:
+        self._ensure_fresh()
+        return self._snapshot[1]
+
+    # (etag, 啟用中的服務)；一起取以免兩次讀到不同版本
+    def snapshot(self) -> tuple:
+        self._ensure_fresh()
+        return self._snapshot
+
+    # 依傳入順序取回服務；有缺漏時立即比對一次版本（可能是別的 worker 剛新增）
+    def lookup(self, oids, active_only: bool = False) -> list:
+        self._ensure_fresh()
+        found = self._pick(oids, active_only)
+        if len(found) != len(oids):
+            self._ensure_fresh(recheck=True)
+            found = self._pick(oids, active_only)
+        return found
+
+    def _pick(self, oids, active_only: bool) -> list:
+        out = []
+        for oid in oids:
+            s = self._by_id.get(oid)
+            if s and (s["is_active"] or not active_only):
+                out.append(s)
+        return out
+
+    def names(self, oids) -> list:
+        return [s["name"] for s in self.lookup(oids)]
+
+    def invalidate(self):
+        doc = self._meta_col.find_one_and_update(
+            {"_id": CATALOG_META_ID},
+            {"$inc": {"version": 1}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        with self._lock:
+            self._reload(int(doc.get("version", 0)))
+            self._checked_at = time.monotonic()
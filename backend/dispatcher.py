@@ -0,0 +1,119 @@
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from pymongo import UpdateOne
+
+# 提醒派送：一次領一批（lease token + 到期時間），平行推播，結果一次 bulk_write 寫回
+REMINDER_BATCH_SIZE = int(os.environ.get("REMINDER_BATCH_SIZE", "200"))
+REMINDER_CONCURRENCY = int(os.environ.get("REMINDER_CONCURRENCY", "8"))
+REMINDER_DEADLINE_SECS = float(os.environ.get("REMINDER_DEADLINE_SECS", "25"))
+REMINDER_LEASE_SECS = int(os.environ.get("REMINDER_LEASE_SECS", "120"))
+
+
+class ReminderDispatcher:
+    # send(reminder) -> bool；或 send_batch(reminders, pool) -> [bool]，可合併相同內容一起送
+    def __init__(self, col, send, max_attempts: int, batch_size: int = REMINDER_BATCH_SIZE,
+                 concurrency: int = REMINDER_CONCURRENCY, lease_secs: int = REMINDER_LEASE_SECS,
+                 send_batch=None):
+        self.col = col
+        self.send = send
+        self.send_batch = send_batch
+        self.max_attempts = max_attempts
+        self.batch_size = max(1, batch_size)
+        self.concurrency = max(1, concurrency)
+        self.lease_secs = lease_secs
+
+    # (collection, keys, options)；由 migrations 建立
+    def indexes(self) -> list:
+        return [
+            (self.col, [("status", 1), ("leaseUntil", 1)], {}),
+            (self.col, [("leaseToken", 1)], {"sparse": True}),
+        ]
+
+    # started：本輪開始時間；本輪失敗退回 scheduled 的不會在同一輪被重領
+    def _due_filter(self, now: datetime, started: datetime) -> dict:
+        stale = now - timedelta(seconds=self.lease_secs)
+        return {"$or": [
+            {"status": "scheduled", "dueAt": {"$lte": now}, "updatedAt": {"$lt": started}},
+            # 派送到一半當掉的 sending：lease 過期就重新領取
+            {"status": "sending", "leaseUntil": {"$lt": now}},
+            {"status": "sending", "leaseUntil": {"$exists": False}, "updatedAt": {"$lt": stale}},
+        ]}
+
+    # 先挑出候選 _id，再用同一個條件 update_many 蓋上自己的 token；
+    # 被別的 worker 搶先領走的不會符合條件，最後只讀回帶著自己 token 的那幾筆
+    def claim(self, limit: int, started: datetime) -> tuple:
+        now = datetime.utcnow()
+        due = self._due_filter(now, started)
+        ids = [d["_id"] for d in self.col.find(due, {"_id": 1}).sort("dueAt", 1).limit(limit)]
+        if not ids:
+            return None, []
+        token = uuid.uuid4().hex
+        self.col.update_many(
+            {"$and": [{"_id": {"$in": ids}}, due]},
+            {"$set": {
+                "status": "sending",
+                "leaseToken": token,
+                "leaseUntil": now + timedelta(seconds=self.lease_secs),
+                "updatedAt": now,
+            }},
+        )
+        return token, list(self.col.find({"leaseToken": token}))
+
+    def _send_one(self, r: dict) -> bool:
+        try:
+            return bool(self.send(r))
+        except Exception as e:
+            print(f"[CRON] send error: {e}")
+            return False
+
+    def _send_all(self, batch: list, pool) -> list:
+        if self.send_batch is None:
+            return list(pool.map(self._send_one, batch))
+        try:
+            return [bool(ok) for ok in self.send_batch(batch, pool)]
+        except Exception as e:
+            print(f"[CRON] batch send error: {e}")
+            return [False] * len(batch)
+
+    def _outcome(self, r: dict, token: str, ok: bool) -> UpdateOne:
+        now = datetime.utcnow()
+        flt = {"_id": r["_id"], "leaseToken": token}
+        unset = {"leaseToken": "", "leaseUntil": ""}
+        if ok:
+            return UpdateOne(flt, {"$set": {"status": "sent", "sentAt": now, "updatedAt": now}, "$unset": unset})
+        status = "failed" if r.get("attempts", 0) + 1 >= self.max_attempts else "scheduled"
+        return UpdateOne(flt, {"$set": {"status": status, "updatedAt": now}, "$inc": {"attempts": 1}, "$unset": unset})
+
+    def dispatch(self, max_items: int = None, deadline_secs: float = REMINDER_DEADLINE_SECS) -> dict:
+        t0 = time.monotonic()
+        started = datetime.utcnow()
+        stats = {"processed": 0, "sent": 0, "retried": 0, "failed": 0, "batches": 0}
+        with ThreadPoolExecutor(self.concurrency, thread_name_prefix="reminder") as pool:
+            while time.monotonic() - t0 < deadline_secs:
+                limit = self.batch_size
+                if max_items is not None:
+                    limit = min(limit, max_items - stats["processed"])
+                    if limit <= 0:
+                        break
+                token, batch = self.claim(limit, started)
+                if not batch:
+                    break
+                results = self._send_all(batch, pool)
+                ops = [self._outcome(r, token, ok) for r, ok in zip(batch, results)]
+                self.col.bulk_write(ops, ordered=False)
+
+                stats["batches"] += 1
+                stats["processed"] += len(batch)
+                for r, ok in zip(batch, results):
+                    if ok:
+                        stats["sent"] += 1
+                    elif r.get("attempts", 0) + 1 >= self.max_attempts:
+                        stats["failed"] += 1
+                    else:
+                        stats["retried"] += 1
+        stats["elapsedMs"] = round((time.monotonic() - t0) * 1000, 1)
+        return stats
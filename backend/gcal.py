@@ -0,0 +1,137 @@
+import os
+import sys
+import threading
+import time
+from typing import Optional
+
+from metrics import outbound
+from perf import lazy_import
+
+# Google Calendar client：整個 process 共用 credentials，
+# access token 快過期才 refresh；discovery 用套件內建的靜態文件，不需要連線抓
+# Google SDK 很重，第一次真的要呼叫 API 時才 import
+GOOGLE_TOKEN_URI = "https://oauth2.googleapis.com/token"
+GOOGLE_SCOPES = ["https://www.googleapis.com/auth/calendar"]
+GOOGLE_HTTP_TIMEOUT = float(os.environ.get("GOOGLE_HTTP_TIMEOUT", "15"))
+# Calendar API 建議一個 batch 不超過 50 個請求
+GOOGLE_BATCH_MAX = 50
+
+
+class CalendarClient:
+    def __init__(self, client_id: str, client_secret: str, refresh_token: str):
+        self._client_id = client_id
+        self._client_secret = client_secret
+        self._refresh_token = refresh_token
+        self._creds = None
+        self._lock = threading.Lock()
+        # httplib2.Http 不是 thread-safe：每個執行緒各自一個 service / 連線，連線會 keep-alive 重用
+        self._local = threading.local()
+        self._token_session = None
+        self._stats_lock = threading.Lock()
+        self._token_refreshes = 0
+        self._services_built = 0
+        self._calls = {}
+
+    def configured(self) -> bool:
+        return bool(self._client_id and self._client_secret and self._refresh_token)
+
+    def credentials(self):
+        if not self.configured():
+            raise RuntimeError("Google OAuth 環境變數未設定完全")
+        creds = self._creds
+        if creds is not None and creds.valid:
+            return creds
+        with self._lock:
+            if self._creds is None:
+                Credentials = lazy_import("google.oauth2.credentials").Credentials
+                self._token_session = lazy_import("requests").Session()
+                self._creds = Credentials(
+                    None,
+                    refresh_token=self._refresh_token,
+                    token_uri=GOOGLE_TOKEN_URI,
+                    client_id=self._client_id,
+                    client_secret=self._client_secret,
+                    scopes=GOOGLE_SCOPES,
+                )
+            # valid 已內含到期前的緩衝時間，快過期時就會是 False
+            if not self._creds.valid:
+                t0 = time.perf_counter()
+                Request = lazy_import("google.auth.transport.requests").Request
+                with outbound("google", "oauth.refresh"):
+                    self._creds.refresh(Request(self._token_session))
+                self._record("oauth.refresh", time.perf_counter() - t0)
+                with self._stats_lock:
+                    self._token_refreshes += 1
+            return self._creds
+
+    def service(self):
+        creds = self.credentials()
+        svc = getattr(self._local, "svc", None)
+        if svc is None:
+            authorized = lazy_import("google_auth_httplib2").AuthorizedHttp
+            http = authorized(creds, http=lazy_import("httplib2").Http(timeout=GOOGLE_HTTP_TIMEOUT))
+            build = lazy_import("googleapiclient.discovery").build
+            svc = build("calendar", "v3", http=http, cache_discovery=False, static_discovery=True)
+            self._local.svc = svc
+            with self._stats_lock:
+                self._services_built += 1
+        return svc
+
+    def execute(self, req, op: str):
+        t0 = time.perf_counter()
+        try:
+            with outbound("google", op):
+                return req.execute()
+        finally:
+            self._record(op, time.perf_counter() - t0)
+
+    # reqs：request_id -> HttpRequest；回傳 request_id -> (response, exception)
+    def batch_execute(self, reqs: dict, op: str) -> dict:
+        svc = self.service()
+        out = {}
+
+        def _cb(request_id, response, exception):
+            out[request_id] = (response, exception)
+
+        items = list(reqs.items())
+        for i in range(0, len(items), GOOGLE_BATCH_MAX):
+            batch = svc.new_batch_http_request(callback=_cb)
+            chunk = items[i:i + GOOGLE_BATCH_MAX]
+            for rid, req in chunk:
+                batch.add(req, request_id=rid)
+            try:
+                self.execute(batch, f"batch:{op}")
+            except Exception as e:
+                # 整包失敗（連線等）：還沒有回應的項目都記為失敗，其他包照常送
+                for rid, _req in chunk:
+                    out.setdefault(rid, (None, e))
+        return out
+
+    def _record(self, op: str, secs: float):
+        with self._stats_lock:
+            c = self._calls.setdefault(op, {"count": 0, "totalMs": 0.0, "maxMs": 0.0})
+            ms = secs * 1000
+            c["count"] += 1
+            c["totalMs"] += ms
+            c["maxMs"] = max(c["maxMs"], ms)
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            calls = {
+                op: {**c, "avgMs": round(c["totalMs"] / c["count"], 2) if c["count"] else 0.0}
+                for op, c in self._calls.items()
+            }
+            return {
+                "tokenRefreshes": self._token_refreshes,
+                "servicesBuilt": self._services_built,
+                "tokenExpiry": self._creds.expiry.isoformat() if self._creds and self._creds.expiry else None,
+                "calls": calls,
+            }
+
+
+# googleapiclient 的 HttpError 狀態碼；SDK 還沒載入代表不可能是 HttpError
+def http_status(e: Exception) -> Optional[int]:
+    errors = sys.modules.get("googleapiclient.errors")
+    if errors is not None and isinstance(e, errors.HttpError):
+        return e.resp.status
+    return None
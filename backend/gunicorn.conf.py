@@ -0,0 +1,25 @@
+import os
+import sys
+
+# gunicorn 會自動讀取目前目錄的 gunicorn.conf.py：gunicorn app:app（在 backend/ 目錄下）
+# preload 只在 master 載入程式碼；Mongo client 在各 worker 第一次查詢時才建立（見 mongo.py）
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+workers = int(os.environ.get("WEB_CONCURRENCY", "2"))
+threads = int(os.environ.get("GUNICORN_THREADS", "8"))
+worker_class = "gthread"
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "60"))
+keepalive = 5
+
+# 公開端點的 admission 上限（ratelimit.PUBLIC_MAX_INFLIGHT）要小於 threads，否則 503 永遠不會觸發
+_max_inflight = os.environ.get("PUBLIC_MAX_INFLIGHT")
+if _max_inflight and int(_max_inflight) >= threads:
+    print(f"[GUNICORN] 警告：PUBLIC_MAX_INFLIGHT={_max_inflight} 不小於 threads={threads}，過載保護不會生效",
+          file=sys.stderr)
+preload_app = os.environ.get("GUNICORN_PRELOAD", "1") != "0"
+
+
+def post_fork(server, worker):
+    # mongo.py 已用 os.register_at_fork 處理；這裡再明確重設一次，不依賴 fork hook
+    app = sys.modules.get("app")
+    if app is not None:
+        app.mongo.reset()
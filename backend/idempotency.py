@@ -0,0 +1,83 @@
+import hashlib
+import json
+import os
+import re
+from datetime import datetime, timedelta
+
+from pymongo.errors import DuplicateKeyError
+
+# Idempotency-Key：同一個 key 的重送直接回傳第一次的結果（一次 _id 查詢），不再跑副作用
+#   _id = "<scope>:<key>"，scope 含使用者，避免不同人撞 key
+#   state processing：第一次請求處理中（leaseUntil 前的重送回 409，過期可接手重跑）
+#   state done：保存 status / body，expiresAt 由 TTL 索引清除
+IDEMPOTENCY_TTL_SECS = int(os.environ.get("IDEMPOTENCY_TTL_SECS", "86400"))
+IDEMPOTENCY_LEASE_SECS = int(os.environ.get("IDEMPOTENCY_LEASE_SECS", "60"))
+_KEY_RE = re.compile(r"[\x21-\x7e]{1,255}")
+
+
+def valid_key(key: str) -> bool:
+    return bool(_KEY_RE.fullmatch(key or ""))
+
+
+def fingerprint(payload) -> str:
+    raw = json.dumps(payload, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class IdempotencyStore:
+    def __init__(self, col, ttl_secs: int = IDEMPOTENCY_TTL_SECS, lease_secs: int = IDEMPOTENCY_LEASE_SECS):
+        self.col = col
+        self.ttl_secs = ttl_secs
+        self.lease_secs = lease_secs
+
+    # (collection, keys, options)；由 migrations 建立
+    def indexes(self) -> list:
+        return [(self.col, [("expiresAt", 1)], {"expireAfterSeconds": 0})]
+
+    # 回傳 (state, doc)：
+    #   new          這次要實際處理，完成後呼叫 finish / release
+    #   replay       doc 有第一次的 status / body
+    #   in_progress  第一次請求還在處理
+    #   mismatch     同一個 key 用在不同內容
+    def begin(self, scope: str, key: str, payload) -> tuple:
+        _id = f"{scope}:{key}"
+        fp = fingerprint(payload)
+        doc = self.col.find_one({"_id": _id})
+        if doc is not None:
+            if doc.get("fingerprint") != fp:
+                return "mismatch", doc
+            if doc.get("state") == "done":
+                return "replay", doc
+        now = datetime.utcnow()
+        claim = {
+            "fingerprint": fp,
+            "state": "processing",
+            "leaseUntil": now + timedelta(seconds=self.lease_secs),
+            "createdAt": now,
+            "expiresAt": now + timedelta(seconds=self.ttl_secs),
+        }
+        if doc is None:
+            try:
+                self.col.insert_one({"_id": _id, **claim})
+            except DuplicateKeyError:
+                # 同一個 key 同時送進來兩次：晚到的當作處理中
+                return "in_progress", None
+            return "new", None
+        if doc["leaseUntil"] >= now:
+            return "in_progress", doc
+        # 前一次處理中斷（worker 重啟等）：lease 過期後由這次接手
+        res = self.col.update_one({"_id": _id, "state": "processing", "leaseUntil": doc["leaseUntil"]},
+                                  {"$set": claim})
+        return ("new", None) if res.modified_count else ("in_progress", doc)
+
+    def finish(self, scope: str, key: str, status: int, body):
+        now = datetime.utcnow()
+        self.col.update_one(
+            {"_id": f"{scope}:{key}"},
+            {"$set": {"state": "done", "status": status, "body": body, "completedAt": now,
+                      "expiresAt": now + timedelta(seconds=self.ttl_secs)},
+             "$unset": {"leaseUntil": ""}})
+
+    # 5xx 等暫時性失敗不保存結果，讓重送可以重跑
+    def release(self, scope: str, key: str):
+        self.col.delete_one({"_id": f"{scope}:{key}", "state": "processing"})
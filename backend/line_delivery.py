@@ -0,0 +1,156 @@
+import hashlib
+import os
+import sys
+import threading
+import time
+import uuid
+
+from metrics import outbound
+from perf import lazy_import
+
+# LINE 推播層：相同內容合併成 multicast（每次最多 500 人），
+# multicast 失敗時退回逐一 push；所有呼叫都經過 token bucket 限速
+# line-bot-sdk 在第一次推播時才 import / 建立 client
+LINE_MULTICAST_MAX = 500
+LINE_RATE_PER_SEC = float(os.environ.get("LINE_RATE_PER_SEC", "50"))
+LINE_RATE_BURST = int(os.environ.get("LINE_RATE_BURST", "20"))
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self._tokens = float(self.capacity)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    # 取得一個 token；回傳等待秒數
+    def acquire(self) -> float:
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+
+def _retry_key(*parts) -> str:
+    return str(uuid.uuid5(uuid.NAMESPACE_OID, ":".join(str(p) for p in parts)))
+
+
+def _text_message(text: str):
+    return lazy_import("linebot.models").TextSendMessage(text=text)
+
+
+def _line_error(e: Exception):
+    errors = sys.modules.get("linebot.exceptions")
+    return e if errors is not None and isinstance(e, errors.LineBotApiError) else None
+
+
+class LineDelivery:
+    def __init__(self, token: str, rate_per_sec: float = LINE_RATE_PER_SEC, burst: int = LINE_RATE_BURST):
+        self.token = token
+        self._api = None
+        self._api_lock = threading.Lock()
+        self.bucket = TokenBucket(rate_per_sec, burst)
+        self._stats_lock = threading.Lock()
+        self._stats = {"pushCalls": 0, "multicastCalls": 0, "multicastFallbacks": 0,
+                       "errors": 0, "throttledSecs": 0.0}
+
+    @property
+    def api(self):
+        if self._api is None and self.token:
+            with self._api_lock:
+                if self._api is None:
+                    self._api = lazy_import("linebot").LineBotApi(self.token)
+        return self._api
+
+    def _count(self, key: str, n=1):
+        with self._stats_lock:
+            self._stats[key] += n
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return {**self._stats, "throttledSecs": round(self._stats["throttledSecs"], 3)}
+
+    def push(self, user_id: str, text: str, retry_key: str = None) -> bool:
+        if not self.token:
+            print("[LINE] LINE_CHANNEL_ACCESS_TOKEN 未設定，跳過推播")
+            return False
+        self._count("throttledSecs", self.bucket.acquire())
+        self._count("pushCalls")
+        try:
+            with outbound("line", "push"):
+                self.api.push_message(user_id, _text_message(text), retry_key=retry_key)
+            return True
+        except Exception as exc:
+            e = _line_error(exc)
+            if e is None:
+                raise
+            if retry_key and e.status_code == 409:
+                # 同一個 retry key 已被 LINE 接受過，視為成功
+                return True
+            self._count("errors")
+            print(f"[LINE] push error: {e}")
+            return False
+
+    def _multicast(self, user_ids: list, text: str, retry_key: str) -> bool:
+        self._count("throttledSecs", self.bucket.acquire())
+        self._count("multicastCalls")
+        try:
+            with outbound("line", "multicast"):
+                self.api.multicast(user_ids, _text_message(text), retry_key=retry_key)
+            return True
+        except Exception as exc:
+            e = _line_error(exc)
+            if e is None:
+                raise
+            if e.status_code == 409:
+                return True
+            self._count("errors")
+            print(f"[LINE] multicast error ({len(user_ids)} 人): {e}")
+            return False
+
+    def _send_unit(self, unit) -> dict:
+        text, text_hash, chunk, users, key_prefix = unit
+        if len(chunk) == 1:
+            u = chunk[0]
+            return {u: self.push(u, text, users[u]["pushKey"] or _retry_key(key_prefix, text_hash, u))}
+        if self._multicast(chunk, text, _retry_key(key_prefix, text_hash, *sorted(chunk))):
+            return {u: True for u in chunk}
+        self._count("multicastFallbacks")
+        return {u: self.push(u, text, users[u]["pushKey"] or _retry_key(key_prefix, text_hash, u)) for u in chunk}
+
+    # items：[(ref, userId, text, push_retry_key)]；回傳 {ref: 是否送出}
+    # 同一段文字的收件人合併成 multicast；同一人同一段文字只送一次
+    # pool：可傳入 executor 讓不同文字 / 不同 chunk 平行送出（仍受 token bucket 限速）
+    def deliver(self, items: list, key_prefix: str, pool=None) -> dict:
+        if not self.token:
+            print("[LINE] LINE_CHANNEL_ACCESS_TOKEN 未設定，跳過推播")
+            return {ref: False for ref, *_ in items}
+
+        groups = {}
+        for ref, user_id, text, push_key in items:
+            users = groups.setdefault(text, {})
+            users.setdefault(user_id, {"refs": [], "pushKey": push_key})["refs"].append(ref)
+
+        units = []
+        for text, users in groups.items():
+            user_ids = list(users)
+            text_hash = hashlib.sha1(text.encode("utf-8")).hexdigest()[:12]
+            for i in range(0, len(user_ids), LINE_MULTICAST_MAX):
+                units.append((text, text_hash, user_ids[i:i + LINE_MULTICAST_MAX], users, key_prefix))
+
+        results = {}
+        for unit, sent in zip(units, (pool.map if pool else map)(self._send_unit, units)):
+            users = unit[3]
+            for u, ok in sent.items():
+                for ref in users[u]["refs"]:
+                    results[ref] = ok
+        return results
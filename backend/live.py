@@ -0,0 +1,187 @@
+import base64
+import hashlib
+import hmac
+import os
+import threading
+import time
+from typing import Optional
+
+import bson
+from pymongo.errors import OperationFailure
+
+import metrics
+
+# ----------------------------------------------------------------------------- #
+# 後台即時更新（Server-Sent Events）：監看 bookings / reminders 的 change stream，只推送變化
+#   booking.pending    新的待確認預約（附顧客 / 服務名稱，可直接畫成卡片）
+#   booking.<status>   預約狀態改變（confirmed 等），後台把卡片移除
+#   reminder.sent / reminder.failed
+# 每個事件的 id 是 change stream 的 resume token；瀏覽器重連時帶 Last-Event-ID，從斷點接續，不漏也不重複
+# 心跳（ping 事件）也帶最新的 resume token，閒置很久後重連也不必從舊位置重讀
+# EventSource 不能帶自訂 header：先用 X-Admin-Token 換一張短效 ticket，放在網址上
+# ----------------------------------------------------------------------------- #
+LIVE_HEARTBEAT_SECS = int(os.environ.get("LIVE_HEARTBEAT_SECS", "15"))
+# 每條連線最長秒數；到期後關閉，由前端帶 Last-Event-ID 重連，避免長時間佔住 worker 執行緒
+LIVE_MAX_SECS = int(os.environ.get("LIVE_MAX_SECS", "300"))
+# 每個 worker 同時開著的串流上限（gthread 每條串流佔一個執行緒）
+LIVE_MAX_STREAMS = int(os.environ.get("LIVE_MAX_STREAMS", "4"))
+LIVE_TICKET_SECS = int(os.environ.get("LIVE_TICKET_SECS", "300"))
+LIVE_RETRY_MS = int(os.environ.get("LIVE_RETRY_MS", "3000"))
+_CHANGE_STREAM_HISTORY_LOST = 286
+
+LIVE_EVENTS = metrics.Counter(metrics.registry, "admin_live_events_total",
+                              "Events pushed to admin live streams", ("event",))
+
+
+def encode_token(token: dict) -> str:
+    return base64.urlsafe_b64encode(bson.encode(token)).decode("ascii").rstrip("=")
+
+
+def decode_token(value: str) -> dict:
+    try:
+        return bson.decode(base64.urlsafe_b64decode(value + "=" * (-len(value) % 4)))
+    except Exception:
+        raise ValueError("Last-Event-ID 格式錯誤")
+
+
+def _ticket_sig(secret: str, exp: int) -> str:
+    return hmac.new(secret.encode("utf-8"), f"live:{exp}".encode("ascii"), hashlib.sha256).hexdigest()
+
+
+def issue_ticket(secret: str, ttl_secs: int = LIVE_TICKET_SECS) -> str:
+    exp = int(time.time()) + ttl_secs
+    return f"{exp}.{_ticket_sig(secret, exp)}"
+
+
+def verify_ticket(secret: str, ticket: Optional[str]) -> bool:
+    exp, _, sig = (ticket or "").partition(".")
+    if not (secret and exp.isdigit() and sig):
+        return False
+    return int(exp) >= time.time() and hmac.compare_digest(sig, _ticket_sig(secret, int(exp)))
+
+
+def sse(event: str = None, data: str = None, id: str = None) -> str:
+    lines = []
+    if id is not None:
+        lines.append(f"id: {id}")
+    if event is not None:
+        lines.append(f"event: {event}")
+    if data is not None:
+        lines.extend(f"data: {line}" for line in data.split("\n"))
+    return "\n".join(lines) + "\n\n"
+
+
+class LiveFeed:
+    # enrich(event, fullDocument) -> dict；dumps 為 app 的 JSON 序列化（datetime / ObjectId）
+    def __init__(self, mongo, bookings: str, reminders: str, enrich, dumps,
+                 max_streams: int = LIVE_MAX_STREAMS):
+        self.mongo = mongo
+        self.bookings = bookings
+        self.reminders = reminders
+        self.enrich = enrich
+        self.dumps = dumps
+        self.max_streams = max_streams
+        self.active = 0
+        self.peak = 0
+        self._open = set()
+        self._lock = threading.Lock()
+
+    # 只讓需要的變更離開資料庫
+    def pipeline(self) -> list:
+        return [{"$match": {"$or": [
+            {"ns.coll": self.bookings, "operationType": "insert", "fullDocument.status": "pending"},
+            {"ns.coll": self.bookings, "operationType": "update",
+             "updateDescription.updatedFields.status": {"$exists": True}},
+            {"ns.coll": self.reminders, "operationType": "update",
+             "updateDescription.updatedFields.status": {"$in": ["sent", "failed"]}},
+        ]}}]
+
+    def classify(self, change: dict) -> Optional[str]:
+        doc = change.get("fullDocument")
+        if not doc or not doc.get("status"):
+            # updateLookup 時文件已被刪除
+            return None
+        coll = change["ns"]["coll"]
+        if coll == self.bookings:
+            return f"booking.{doc['status']}"
+        if coll == self.reminders and doc["status"] in ("sent", "failed"):
+            return f"reminder.{doc['status']}"
+        return None
+
+    def _watch(self, resume: Optional[dict]):
+        return self.mongo.database().watch(self.pipeline(), full_document="updateLookup", resume_after=resume,
+                                           max_await_time_ms=1000)
+
+    # 開啟一條 change stream；回傳 (stream, reset)，額滿時回傳 (None, False)
+    # reset=True 表示 resume token 已超出 oplog，前端需重新載入整份列表
+    def connect(self, resume: Optional[dict]) -> tuple:
+        with self._lock:
+            if self.max_streams > 0 and self.active >= self.max_streams:
+                return None, False
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+        reset = False
+        try:
+            try:
+                stream = self._watch(resume)
+            except OperationFailure as e:
+                if resume is None or e.code != _CHANGE_STREAM_HISTORY_LOST:
+                    raise
+                stream, reset = self._watch(None), True
+        except Exception:
+            self._release()
+            raise
+        with self._lock:
+            self._open.add(id(stream))
+        return stream, reset
+
+    def _release(self):
+        with self._lock:
+            self.active -= 1
+
+    # 可重複呼叫（generator 結束與 response 關閉都會呼叫）
+    def disconnect(self, stream):
+        with self._lock:
+            if id(stream) not in self._open:
+                return
+            self._open.discard(id(stream))
+        try:
+            stream.close()
+        finally:
+            self._release()
+
+    def events(self, stream, reset: bool = False, max_secs: int = LIVE_MAX_SECS):
+        started = last_sent = time.monotonic()
+        try:
+            token = stream.resume_token
+            yield f"retry: {LIVE_RETRY_MS}\n" + sse("reset" if reset else "ready", self.dumps({"reset": reset}),
+                                                     id=encode_token(token) if token else None)
+            while stream.alive and time.monotonic() - started < max_secs:
+                change = stream.try_next()
+                now = time.monotonic()
+                if change is not None:
+                    name = self.classify(change)
+                    if name:
+                        LIVE_EVENTS.inc(event=name)
+                        yield sse(name, self.dumps(self.enrich(name, change["fullDocument"])),
+                                  id=encode_token(change["_id"]))
+                        last_sent = now
+                        continue
+                if now - last_sent >= LIVE_HEARTBEAT_SECS:
+                    token = stream.resume_token
+                    yield sse("ping", "{}", id=encode_token(token) if token else None)
+                    last_sent = now
+        except Exception as e:
+            print(f"[LIVE] stream error: {e}")
+            yield sse("error", self.dumps({"error": "即時更新中斷，重新連線中"}))
+        finally:
+            self.disconnect(stream)
+
+    def stats(self) -> dict:
+        return {
+            "active": self.active,
+            "peak": self.peak,
+            "maxStreams": self.max_streams,
+            "heartbeatSecs": LIVE_HEARTBEAT_SECS,
+            "maxSecs": LIVE_MAX_SECS,
+        }
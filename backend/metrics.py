@@ -0,0 +1,244 @@
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+
+from pymongo import monitoring
+
+# Prometheus 文字格式的指標（每個 process 各自累計，由 /metrics 輸出）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# 超過這個毫秒數的 Mongo 指令記錄 explain（0 = 關閉）
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", "0"))
+SLOW_QUERY_KEEP = int(os.environ.get("SLOW_QUERY_KEEP", "50"))
+
+
+def _escape(v) -> str:
+    return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, registry, name: str, help_text: str, labels: tuple = ()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+        registry.register(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(n, "")) for n in self.label_names)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_one(key, value))
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, n: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + n
+
+    def _render_one(self, key, value) -> list:
+        return [f"{self.name}{_labels(self.label_names, key)} {value}"]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, registry, name: str, help_text: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(registry, name, help_text, labels)
+
+    def observe(self, secs: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            v = self._values.get(key)
+            if v is None:
+                v = self._values[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, b in enumerate(self.buckets):
+                if secs <= b:
+                    v["counts"][i] += 1
+                    break
+            v["sum"] += secs
+            v["count"] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        t0 = time.perf_counter()
+        try:
+            yield labels
+        finally:
+            self.observe(time.perf_counter() - t0, **labels)
+
+    def _render_one(self, key, v) -> list:
+        lines = []
+        cumulative = 0
+        for b, n in zip(self.buckets, v["counts"]):
+            cumulative += n
+            le = 'le="%s"' % b
+            lines.append(f"{self.name}_bucket{_labels(self.label_names, key, le)} {cumulative}")
+        le = 'le="+Inf"'
+        lines.append(f"{self.name}_bucket{_labels(self.label_names, key, le)} {v['count']}")
+        lines.append(f"{self.name}_sum{_labels(self.label_names, key)} {round(v['sum'], 6)}")
+        lines.append(f"{self.name}_count{_labels(self.label_names, key)} {v['count']}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric: _Metric):
+        self._metrics.append(metric)
+
+    def render(self) -> str:
+        lines = []
+        for m in self._metrics:
+            lines.extend(m.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+HTTP_DURATION = Histogram(registry, "http_request_duration_seconds", "HTTP request latency by route",
+                          ("method", "route", "status"))
+MONGO_DURATION = Histogram(registry, "mongo_command_duration_seconds", "MongoDB command latency",
+                           ("command", "collection"), buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                                                               0.25, 0.5, 1.0, 2.5))
+MONGO_FAILURES = Counter(registry, "mongo_command_failures_total", "Failed MongoDB commands", ("command", "collection"))
+OUTBOUND_DURATION = Histogram(registry, "outbound_call_duration_seconds", "Outbound API call latency",
+                              ("target", "op", "result"))
+CRON_RUNS = Counter(registry, "cron_dispatch_runs_total", "Reminder dispatch cron runs")
+CRON_DURATION = Histogram(registry, "cron_dispatch_duration_seconds", "Reminder dispatch cron run duration",
+                          buckets=(0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 25.0, 60.0))
+REMINDERS = Counter(registry, "reminders_dispatched_total", "Reminders processed by outcome", ("outcome",))
+
+
+@contextmanager
+def outbound(target: str, op: str):
+    t0 = time.perf_counter()
+    result = "error"
+    try:
+        yield
+        result = "ok"
+    finally:
+        OUTBOUND_DURATION.observe(time.perf_counter() - t0, target=target, op=op, result=result)
+
+
+# 目前執行緒正在處理的路由（慢查詢記錄用）
+_current = threading.local()
+
+
+def set_route(route: str):
+    _current.route = route
+
+
+# Mongo 指令耗時；超過 SLOW_QUERY_MS 的讀寫指令在背景執行緒跑 explain 並保留最近幾筆
+_EXPLAINABLE = {"find", "aggregate", "count", "distinct", "update", "delete", "findAndModify"}
+_STRIP_FIELDS = {"lsid", "$db", "$clusterTime", "txnNumber", "$readPreference", "readConcern", "writeConcern",
+                 "startTransaction", "autocommit"}
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    def __init__(self, slow_ms: float = SLOW_QUERY_MS, keep: int = SLOW_QUERY_KEEP):
+        self.slow_ms = slow_ms
+        self._inflight = {}
+        self.slow = deque(maxlen=keep)
+        self._explain = None
+        self._queue = deque()
+        self._wakeup = threading.Event()
+        self._worker = None
+        self._worker_lock = threading.Lock()
+
+    # explain(db_name, command) -> dict；由 app 在建立 client 之後設定
+    def set_explainer(self, explain):
+        self._explain = explain
+
+    def started(self, event):
+        coll = event.command.get(event.command_name)
+        coll = coll if isinstance(coll, str) else ""
+        cmd = event.command if self.slow_ms > 0 and event.command_name in _EXPLAINABLE else None
+        self._inflight[(event.connection_id, event.request_id)] = (coll, cmd)
+
+    def _finish(self, event, failed: bool):
+        coll, cmd = self._inflight.pop((event.connection_id, event.request_id), ("", None))
+        secs = event.duration_micros / 1e6
+        MONGO_DURATION.observe(secs, command=event.command_name, collection=coll)
+        if failed:
+            MONGO_FAILURES.inc(command=event.command_name, collection=coll)
+        elif cmd is not None and secs * 1000 >= self.slow_ms and self._explain is not None:
+            self._queue.append({
+                "at": datetime.utcnow(),
+                "route": getattr(_current, "route", None),
+                "command": event.command_name,
+                "collection": coll,
+                "database": event.database_name,
+                "ms": round(secs * 1000, 1),
+                "cmd": {k: v for k, v in cmd.items() if k not in _STRIP_FIELDS},
+            })
+            self._ensure_worker()
+            self._wakeup.set()
+
+    def succeeded(self, event):
+        self._finish(event, False)
+
+    def failed(self, event):
+        self._finish(event, True)
+
+    def _ensure_worker(self):
+        if self._worker is not None:
+            return
+        with self._worker_lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="slow-query-explain", daemon=True)
+                self._worker.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            while self._queue:
+                item = self._queue.popleft()
+                try:
+                    plan = self._explain(item["database"], item["cmd"])
+                    item["plan"] = plan.get("queryPlanner", {}).get("winningPlan", plan)
+                except Exception as e:
+                    item["plan"] = {"error": str(e)}
+                self.slow.append(item)
+                print(f"[SLOW] {item['ms']}ms {item['command']} {item['collection']} route={item['route']} "
+                      f"plan={_plan_summary(item['plan'])}")
+
+
+# 把 winningPlan 摺成 "FETCH<-IXSCAN(status_1_dueAt_1)" 這種一行摘要
+def _plan_summary(plan) -> str:
+    if not isinstance(plan, dict):
+        return str(plan)
+    if "error" in plan:
+        return f"error: {plan['error']}"
+    stages = []
+    node = plan
+    while isinstance(node, dict) and node.get("stage"):
+        stage = node["stage"]
+        if node.get("indexName"):
+            stage += f"({node['indexName']})"
+        stages.append(stage)
+        node = node.get("inputStage") or (node.get("inputStages") or [None])[0]
+    return "<-".join(stages) or "?"
@@ -0,0 +1,115 @@
+import hashlib
+import json
+from datetime import datetime
+
+from pymongo.errors import PyMongoError
+
+# 索引遷移：啟動時不再建立索引，部署時執行一次
+#   python -m migrations            建立缺少的索引、移除舊索引
+#   python -m migrations --dry-run  只列出會做的變更
+# 先以 index_information() 比對，已存在且 key 與選項都相同的不再送 create_index；
+# 只有 TTL 秒數不同時以 collMod 調整，其餘差異列在 conflicts，且不記錄 schema hash
+SCHEMA_META_ID = "schema"
+# 會影響索引行為、需要與規格比對的選項
+COMPARED_OPTIONS = ("unique", "sparse", "expireAfterSeconds", "partialFilterExpression")
+
+
+def index_name(keys: list, options: dict) -> str:
+    return options.get("name") or "_".join(f"{k}_{d}" for k, d in keys)
+
+
+def _option(info: dict, field: str):
+    value = info.get(field)
+    if field in ("unique", "sparse"):
+        return bool(value)
+    if field == "expireAfterSeconds" and value is not None:
+        return int(value)
+    if field == "partialFilterExpression" and value is not None:
+        return json.loads(json.dumps(value, default=str))
+    return value
+
+
+# 既有索引與規格不同的選項：{欄位: (既有值, 規格值)}
+def option_diff(existing: dict, opts: dict) -> dict:
+    diff = {}
+    for field in COMPARED_OPTIONS:
+        have, want = _option(existing, field), _option(opts, field)
+        if have != want:
+            diff[field] = (have, want)
+    return diff
+
+
+def schema_hash(specs: list, drops: list) -> str:
+    desc = sorted(
+        [[col.name, index_name(keys, opts), [[k, d] for k, d in keys], sorted(opts.items(), key=str)]
+         for col, keys, opts in specs], key=str)
+    desc += sorted([["drop", col.name, name] for col, name in drops])
+    return hashlib.sha1(json.dumps(desc, default=str, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+# specs：[(collection, keys, options)]；drops：[(collection, index 名稱)]
+def migrate(specs: list, drops: list, meta_col, dry_run: bool = False) -> dict:
+    report = {"created": [], "dropped": [], "modified": [], "existing": 0, "conflicts": []}
+    info_cache = {}
+
+    def info(col):
+        if col.name not in info_cache:
+            info_cache[col.name] = col.index_information()
+        return info_cache[col.name]
+
+    for col, name in drops:
+        if name in info(col):
+            report["dropped"].append(f"{col.name}.{name}")
+            if not dry_run:
+                col.drop_index(name)
+                info(col).pop(name, None)
+
+    for col, keys, opts in specs:
+        name = index_name(keys, opts)
+        existing = info(col).get(name)
+        if existing is not None:
+            same_keys = [(k, int(d)) if isinstance(d, (int, float)) else (k, d) for k, d in existing["key"]] == list(keys)
+            diff = option_diff(existing, opts)
+            if same_keys and not diff:
+                report["existing"] += 1
+            elif same_keys and list(diff) == ["expireAfterSeconds"] and None not in diff["expireAfterSeconds"]:
+                # 只有保留天數改變：collMod 直接調整 TTL，不必重建索引
+                if not dry_run:
+                    try:
+                        col.database.command("collMod", col.name, index={
+                            "name": name, "expireAfterSeconds": diff["expireAfterSeconds"][1]})
+                    except PyMongoError as e:
+                        print(f"[MIGRATE] collMod {col.name}.{name} error: {e}")
+                        report["conflicts"].append(f"{col.name}.{name}")
+                        continue
+                report["modified"].append(f"{col.name}.{name}")
+            else:
+                # 同名但 key 或其他選項不同：需要人工處理，不自動刪除
+                report["conflicts"].append(f"{col.name}.{name}")
+            continue
+        report["created"].append(f"{col.name}.{name}")
+        if not dry_run:
+            col.create_index(keys, name=name, **{k: v for k, v in opts.items() if k != "name"})
+
+    if not dry_run and not report["conflicts"]:
+        meta_col.update_one(
+            {"_id": SCHEMA_META_ID},
+            {"$set": {"hash": schema_hash(specs, drops), "appliedAt": datetime.utcnow()}},
+            upsert=True,
+        )
+    report["hash"] = schema_hash(specs, drops)
+    return report
+
+
+# 目前資料庫是否已套用這一版的索引規格（只讀一筆 meta）
+def applied(specs: list, drops: list, meta_col) -> bool:
+    doc = meta_col.find_one({"_id": SCHEMA_META_ID}, {"hash": 1}) or {}
+    return doc.get("hash") == schema_hash(specs, drops)
+
+
+if __name__ == "__main__":
+    # 在 backend/ 目錄下執行
+    import sys
+
+    import app as _app
+    print(f"[MIGRATE] {_app.run_migrations(dry_run='--dry-run' in sys.argv)}")
@@ -0,0 +1,246 @@
+import os
+import threading
+from importlib.util import find_spec
+
+from pymongo import MongoClient, ReadPreference, monitoring
+from pymongo.read_preferences import SecondaryPreferred
+
+import metrics
+
+# ----------------------------------------------------------------------------- #
+# Mongo 連線：每個 process 第一次使用時才建立 client（gunicorn fork 之後各 worker 各自一個），
+# 不會把 master 的連線池帶進 worker。collection 物件以 CollectionRef 代理，模組層級照常使用
+# ----------------------------------------------------------------------------- #
+MONGO_DB_NAME = os.environ.get("MONGO_DB_NAME", "minyue_db")
+MONGO_MAX_POOL_SIZE = int(os.environ.get("MONGO_MAX_POOL_SIZE", "50"))
+MONGO_MIN_POOL_SIZE = int(os.environ.get("MONGO_MIN_POOL_SIZE", "0"))
+MONGO_MAX_IDLE_MS = int(os.environ.get("MONGO_MAX_IDLE_MS", "300000"))
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.environ.get("MONGO_WAIT_QUEUE_TIMEOUT_MS", "5000"))
+MONGO_SERVER_SELECTION_MS = int(os.environ.get("MONGO_SERVER_SELECTION_MS", "5000"))
+MONGO_CONNECT_TIMEOUT_MS = int(os.environ.get("MONGO_CONNECT_TIMEOUT_MS", "10000"))
+# 依序協商；沒裝對應套件（zstandard / python-snappy）的自動略過
+MONGO_COMPRESSORS = os.environ.get("MONGO_COMPRESSORS", "zstd,snappy,zlib")
+MONGO_RETRY_WRITES = os.environ.get("MONGO_RETRY_WRITES", "1") != "0"
+MONGO_RETRY_READS = os.environ.get("MONGO_RETRY_READS", "1") != "0"
+# 後台列表 / 匯出 / 統計這類唯讀查詢的 read preference；primary 表示不分流
+MONGO_ADMIN_READS = os.environ.get("MONGO_ADMIN_READS", "secondaryPreferred")
+# secondary 落後超過這個秒數就不讀（0 = 不限制；MongoDB 要求至少 90）
+MONGO_MAX_STALENESS_SECS = int(os.environ.get("MONGO_MAX_STALENESS_SECS", "0"))
+
+_COMPRESSOR_MODULES = {"zstd": "zstandard", "snappy": "snappy", "zlib": "zlib"}
+
+
+def available_compressors(names: str) -> list:
+    out = []
+    for name in (n.strip().lower() for n in names.split(",")):
+        module = _COMPRESSOR_MODULES.get(name)
+        if module and find_spec(module) is not None:
+            out.append(name)
+    return out
+
+
+def client_options(listeners: list = ()) -> dict:
+    opts = {
+        "maxPoolSize": MONGO_MAX_POOL_SIZE,
+        "minPoolSize": MONGO_MIN_POOL_SIZE,
+        "maxIdleTimeMS": MONGO_MAX_IDLE_MS,
+        "waitQueueTimeoutMS": MONGO_WAIT_QUEUE_TIMEOUT_MS,
+        "serverSelectionTimeoutMS": MONGO_SERVER_SELECTION_MS,
+        "connectTimeoutMS": MONGO_CONNECT_TIMEOUT_MS,
+        "retryWrites": MONGO_RETRY_WRITES,
+        "retryReads": MONGO_RETRY_READS,
+        "event_listeners": list(listeners),
+    }
+    compressors = available_compressors(MONGO_COMPRESSORS)
+    if compressors:
+        opts["compressors"] = ",".join(compressors)
+    return opts
+
+
+def admin_read_preference():
+    if MONGO_ADMIN_READS == "primary":
+        return ReadPreference.PRIMARY
+    if MONGO_ADMIN_READS != "secondaryPreferred":
+        raise RuntimeError(f"MONGO_ADMIN_READS 不支援 {MONGO_ADMIN_READS}")
+    if MONGO_MAX_STALENESS_SECS > 0:
+        return SecondaryPreferred(max_staleness=max(90, MONGO_MAX_STALENESS_SECS))
+    return ReadPreference.SECONDARY_PREFERRED
+
+
+POOL_CHECKOUT_WAIT = metrics.Histogram(
+    metrics.registry, "mongo_pool_checkout_seconds", "Time spent waiting for a pooled connection",
+    ("client", "result"), buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0))
+POOL_EVENTS = metrics.Counter(metrics.registry, "mongo_pool_events_total", "Connection pool events",
+                              ("client", "event"))
+
+
+# 連線池事件：各 server 目前的連線數 / 使用中、建立 / 關閉次數、借用失敗原因與等待時間
+# 每個 client 各用一個（client 標籤區分 pymongo / motor），否則同一個 server 的計數會混在一起
+class PoolListener(monitoring.ConnectionPoolListener):
+    def __init__(self, client: str = "pymongo"):
+        self.client = client
+        self._lock = threading.Lock()
+        self._pools = {}
+
+    def _pool(self, address) -> dict:
+        key = "%s:%s" % address
+        p = self._pools.get(key)
+        if p is None:
+            p = self._pools[key] = {"open": 0, "inUse": 0, "peakInUse": 0, "created": 0, "closed": 0,
+                                    "checkedOut": 0, "checkoutFailed": {}, "cleared": 0}
+        return p
+
+    def _event(self, address, event: str, **changes):
+        with self._lock:
+            p = self._pool(address)
+            for k, v in changes.items():
+                p[k] += v
+            p["peakInUse"] = max(p["peakInUse"], p["inUse"])
+        POOL_EVENTS.inc(event=event, client=self.client)
+
+    def pool_created(self, event):
+        with self._lock:
+            self._pool(event.address)
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self._event(event.address, "pool_cleared", cleared=1)
+
+    def pool_closed(self, event):
+        with self._lock:
+            self._pools.pop("%s:%s" % event.address, None)
+
+    def connection_created(self, event):
+        self._event(event.address, "created", created=1, open=1)
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._event(event.address, f"closed_{event.reason}", closed=1, open=-1)
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        POOL_CHECKOUT_WAIT.observe(getattr(event, "duration", 0) or 0, client=self.client, result=event.reason)
+        with self._lock:
+            failed = self._pool(event.address)["checkoutFailed"]
+            failed[event.reason] = failed.get(event.reason, 0) + 1
+        POOL_EVENTS.inc(event=f"checkout_failed_{event.reason}", client=self.client)
+
+    def connection_checked_out(self, event):
+        POOL_CHECKOUT_WAIT.observe(getattr(event, "duration", 0) or 0, client=self.client, result="ok")
+        self._event(event.address, "checked_out", checkedOut=1, inUse=1)
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self._pool(event.address)["inUse"] -= 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {k: {**v, "checkoutFailed": dict(v["checkoutFailed"])} for k, v in self._pools.items()}
+
+
+class Connections:
+    def __init__(self, uri: str, listeners: list = (), db_name: str = MONGO_DB_NAME):
+        self.uri = uri
+        self.db_name = db_name
+        self.pool = PoolListener()
+        self.listeners = [*listeners, self.pool]
+        # 同一個 process 裡其他 client（例如 ASGI 的 Motor）的連線池
+        self.client_pools = {}
+        self.generation = 0
+        self._client = None
+        self._pid = None
+        self._lock = threading.Lock()
+        # fork 後的子 process 不可沿用父 process 的連線池；丟掉參照（不 close，連線屬於父 process）
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self.reset)
+
+    def reset(self):
+        self._client = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.pool = PoolListener()
+        self.listeners[-1] = self.pool
+        self.client_pools = {}
+
+    def client_pool(self, name: str) -> PoolListener:
+        return self.client_pools.setdefault(name, PoolListener(name))
+
+    # 確保 client 屬於目前的 process；回傳 generation（重建 client 時遞增）
+    def ensure(self) -> int:
+        if self._client is None or self._pid != os.getpid():
+            with self._lock:
+                if self._client is None or self._pid != os.getpid():
+                    self._client = MongoClient(self.uri, **client_options(self.listeners))
+                    self._pid = os.getpid()
+                    self.generation += 1
+        return self.generation
+
+    @property
+    def client(self) -> MongoClient:
+        self.ensure()
+        return self._client
+
+    def database(self, secondary: bool = False):
+        db = self.client[self.db_name]
+        if secondary:
+            return db.with_options(read_preference=admin_read_preference())
+        return db
+
+    # 模組層級使用的 collection：每次存取時確認仍是這個 process 的 client
+    def collection(self, name: str, secondary: bool = False) -> "CollectionRef":
+        return CollectionRef(self, name, secondary)
+
+    def close(self):
+        with self._lock:
+            if self._client is not None and self._pid == os.getpid():
+                self._client.close()
+            self._client = None
+            self._pid = None
+
+    def stats(self) -> dict:
+        return {
+            "pid": os.getpid(),
+            "connected": self._client is not None and self._pid == os.getpid(),
+            "maxPoolSize": MONGO_MAX_POOL_SIZE,
+            "minPoolSize": MONGO_MIN_POOL_SIZE,
+            "maxIdleTimeMS": MONGO_MAX_IDLE_MS,
+            "compressors": available_compressors(MONGO_COMPRESSORS),
+            "retryWrites": MONGO_RETRY_WRITES,
+            "adminReads": MONGO_ADMIN_READS,
+            "servers": self.pool.stats(),
+            "clients": {name: p.stats() for name, p in self.client_pools.items()},
+        }
+
+
+class CollectionRef:
+    __slots__ = ("_conns", "_name", "_secondary", "_gen", "_col")
+
+    def __init__(self, conns: Connections, name: str, secondary: bool = False):
+        self._conns = conns
+        self._name = name
+        self._secondary = secondary
+        self._gen = None
+        self._col = None
+
+    def _resolve(self):
+        gen = self._conns.ensure()
+        if self._gen != gen:
+            self._col = self._conns.database(self._secondary)[self._name]
+            self._gen = gen
+        return self._col
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    def __getattr__(self, attr):
+        return getattr(self._resolve(), attr)
+
+    def __repr__(self):
+        return f"CollectionRef({self._conns.db_name}.{self._name}{', secondary' if self._secondary else ''})"
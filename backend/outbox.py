@@ -0,0 +1,178 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+# 對外副作用（LINE 推播、Google Calendar）的 outbox：
+# handler 只負責 enqueue，背景 worker 依序領取、重試、記錄結果
+OUTBOX_CONCURRENCY = int(os.environ.get("OUTBOX_CONCURRENCY", "4"))
+OUTBOX_POLL_SECS = float(os.environ.get("OUTBOX_POLL_SECS", "2"))
+OUTBOX_LEASE_SECS = int(os.environ.get("OUTBOX_LEASE_SECS", "120"))
+OUTBOX_BACKOFF_BASE = int(os.environ.get("OUTBOX_BACKOFF_BASE", "5"))
+OUTBOX_BACKOFF_MAX = int(os.environ.get("OUTBOX_BACKOFF_MAX", "900"))
+# thread：在 web worker 內起背景執行緒；external：另外跑 python -m outbox
+OUTBOX_MODE = os.environ.get("OUTBOX_MODE", "thread")
+# 完成的工作保留天數（doneAt 上的 TTL 索引；0 = 永久保留）。刪除後同一個 idemKey 可再次 enqueue
+OUTBOX_DONE_RETENTION_DAYS = int(os.environ.get("OUTBOX_DONE_RETENTION_DAYS", "30"))
+
+
+class Outbox:
+    def __init__(self, col, max_attempts: int, concurrency: int = OUTBOX_CONCURRENCY,
+                 poll_secs: float = OUTBOX_POLL_SECS, lease_secs: int = OUTBOX_LEASE_SECS,
+                 autostart: bool = OUTBOX_MODE == "thread"):
+        self.col = col
+        self.max_attempts = max_attempts
+        self.concurrency = max(1, concurrency)
+        self.poll_secs = poll_secs
+        self.lease_secs = lease_secs
+        self.autostart = autostart
+        self._handlers = {}
+        self._wake = threading.Event()
+        self._started = False
+        self._start_lock = threading.Lock()
+
+    def handler(self, kind: str):
+        def deco(fn):
+            self._handlers[kind] = fn
+            return fn
+        return deco
+
+    # (collection, keys, options)；由 migrations 建立
+    def indexes(self) -> list:
+        specs = [
+            (self.col, [("idemKey", 1)], {"unique": True}),
+            (self.col, [("status", 1), ("nextAttemptAt", 1)], {}),
+        ]
+        if OUTBOX_DONE_RETENTION_DAYS > 0:
+            specs.append((self.col, [("doneAt", 1)], {"expireAfterSeconds": OUTBOX_DONE_RETENTION_DAYS * 86400}))
+        return specs
+
+    # 以 idemKey 去重：同一個 key 只會有一筆工作，重複 enqueue 視為成功
+    def enqueue(self, kind: str, payload: dict, key: str) -> bool:
+        if kind not in self._handlers:
+            raise ValueError(f"unknown outbox kind: {kind}")
+        now = datetime.utcnow()
+        try:
+            self.col.insert_one({
+                "kind": kind,
+                "idemKey": key,
+                "payload": payload,
+                "status": "queued",
+                "attempts": 0,
+                "nextAttemptAt": now,
+                "createdAt": now,
+                "updatedAt": now,
+            })
+        except DuplicateKeyError:
+            return False
+        if self.autostart:
+            self.start()
+        self._wake.set()
+        return True
+
+    def claim(self):
+        now = datetime.utcnow()
+        return self.col.find_one_and_update(
+            {"$or": [
+                {"status": "queued", "nextAttemptAt": {"$lte": now}},
+                {"status": "sending", "leaseUntil": {"$lt": now}},
+            ]},
+            {"$set": {
+                "status": "sending",
+                "leaseUntil": now + timedelta(seconds=self.lease_secs),
+                "updatedAt": now,
+            }},
+            sort=[("nextAttemptAt", 1)],
+            return_document=ReturnDocument.AFTER,
+        )
+
+    def _backoff(self, attempts: int) -> timedelta:
+        return timedelta(seconds=min(OUTBOX_BACKOFF_MAX, OUTBOX_BACKOFF_BASE * (2 ** attempts)))
+
+    def process(self, job: dict) -> bool:
+        fn = self._handlers.get(job.get("kind"))
+        try:
+            if fn is None:
+                raise RuntimeError(f"no handler for {job.get('kind')}")
+            result = fn(job)
+        except Exception as e:
+            print(f"[OUTBOX] {job.get('kind')} {job.get('idemKey')} error: {e}")
+            attempts = job.get("attempts", 0) + 1
+            now = datetime.utcnow()
+            if attempts >= self.max_attempts:
+                update = {"status": "failed"}
+            else:
+                update = {"status": "queued", "nextAttemptAt": now + self._backoff(attempts)}
+            self.col.update_one(
+                {"_id": job["_id"]},
+                {"$set": {**update, "lastError": str(e)[:500], "updatedAt": now},
+                 "$inc": {"attempts": 1}, "$unset": {"leaseUntil": ""}},
+            )
+            return False
+
+        now = datetime.utcnow()
+        self.col.update_one(
+            {"_id": job["_id"]},
+            {"$set": {"status": "done", "result": result or {}, "doneAt": now, "updatedAt": now},
+             "$unset": {"leaseUntil": ""}},
+        )
+        return True
+
+    # 同步清空到期的工作（cron / CLI 用）
+    def drain(self, limit: int = 500, deadline_secs: float = 25.0) -> dict:
+        stats = {"processed": 0, "ok": 0, "failed": 0}
+        until = time.monotonic() + deadline_secs
+        with ThreadPoolExecutor(self.concurrency) as pool:
+            while stats["processed"] < limit and time.monotonic() < until:
+                jobs = []
+                for _ in range(min(self.concurrency, limit - stats["processed"])):
+                    job = self.claim()
+                    if not job:
+                        break
+                    jobs.append(job)
+                if not jobs:
+                    break
+                for ok in pool.map(self.process, jobs):
+                    stats["processed"] += 1
+                    stats["ok" if ok else "failed"] += 1
+        return stats
+
+    def run_forever(self, stop: threading.Event = None):
+        stop = stop or threading.Event()
+        slots = threading.BoundedSemaphore(self.concurrency)
+        with ThreadPoolExecutor(self.concurrency, thread_name_prefix="outbox") as pool:
+            while not stop.is_set():
+                slots.acquire()
+                try:
+                    job = self.claim()
+                except Exception as e:
+                    print(f"[OUTBOX] claim error: {e}")
+                    job = None
+                if not job:
+                    slots.release()
+                    self._wake.wait(self.poll_secs)
+                    self._wake.clear()
+                    continue
+                fut = pool.submit(self.process, job)
+                fut.add_done_callback(lambda _f: slots.release())
+
+    # 第一次 enqueue 時才在目前的（已 fork 的）worker process 啟動背景執行緒
+    def start(self):
+        if self._started:
+            return
+        with self._start_lock:
+            if self._started:
+                return
+            threading.Thread(target=self.run_forever, name="outbox-loop", daemon=True).start()
+            self._started = True
+
+
+if __name__ == "__main__":
+    # 獨立執行：python -m outbox（在 backend/ 目錄下）
+    import app as _app
+    print(f"[OUTBOX] worker started, concurrency={_app.outbox.concurrency}")
+    _app.outbox.run_forever()
@@ -0,0 +1,101 @@
+import importlib
+import sys
+import threading
+import time
+
+# 各階段耗時：單次請求以 Server-Timing header 回傳，並累計在 process 內供後台查詢
+
+
+class StageStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data = {}
+
+    def record(self, route: str, stages: list):
+        with self._lock:
+            per_route = self._data.setdefault(route, {})
+            for name, secs in stages:
+                c = per_route.setdefault(name, {"count": 0, "totalMs": 0.0, "maxMs": 0.0})
+                ms = secs * 1000
+                c["count"] += 1
+                c["totalMs"] += ms
+                c["maxMs"] = max(c["maxMs"], ms)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                route: {
+                    name: {**c, "totalMs": round(c["totalMs"], 2), "maxMs": round(c["maxMs"], 2),
+                           "avgMs": round(c["totalMs"] / c["count"], 2) if c["count"] else 0.0}
+                    for name, c in per_route.items()
+                }
+                for route, per_route in self._data.items()
+            }
+
+
+class StageTimer:
+    def __init__(self, route: str, stats: StageStats):
+        self.route = route
+        self.stats = stats
+        self.stages = []
+        self._t = time.perf_counter()
+
+    # 記錄從上一個 mark 到現在的耗時
+    def mark(self, name: str):
+        now = time.perf_counter()
+        self.stages.append((name, now - self._t))
+        self._t = now
+
+    def finish(self, resp):
+        self.stats.record(self.route, self.stages)
+        resp.headers["Server-Timing"] = ", ".join(f"{n};dur={s * 1000:.1f}" for n, s in self.stages)
+        return resp
+
+
+# 啟動耗時：import 各階段 + 第一次使用時才載入的 SDK
+class StartupReport:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._t0 = time.perf_counter()
+        self._t = self._t0
+        self.phases = []
+        self.lazy = {}
+
+    # t0：process 開始載入 app 的時間（perf 模組本身較晚才被 import）
+    def begin(self, t0: float):
+        self._t0 = self._t = t0
+
+    def mark(self, name: str):
+        now = time.perf_counter()
+        self.phases.append((name, now - self._t))
+        self._t = now
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            lazy = {k: round(v * 1000, 1) for k, v in self.lazy.items()}
+        return {
+            "phasesMs": {n: round(s * 1000, 1) for n, s in self.phases},
+            "totalMs": round((self._t - self._t0) * 1000, 1),
+            "lazyImportsMs": lazy,
+        }
+
+    def summary(self) -> str:
+        snap = self.snapshot()
+        parts = " ".join(f"{n}={ms}ms" for n, ms in snap["phasesMs"].items())
+        return f"{parts} total={snap['totalMs']}ms"
+
+
+startup = StartupReport()
+
+
+# 第一次 import 時記錄耗時（之後直接從 sys.modules 取）
+def lazy_import(name: str):
+    mod = sys.modules.get(name)
+    if mod is not None:
+        return mod
+    t0 = time.perf_counter()
+    mod = importlib.import_module(name)
+    secs = time.perf_counter() - t0
+    with startup._lock:
+        startup.lazy.setdefault(name, secs)
+    return mod
@@ -0,0 +1,170 @@
+import math
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from pymongo import ReturnDocument
+
+import metrics
+
+# ----------------------------------------------------------------------------- #
+# 公開端點的限流與過載保護（在任何 DB 工作之前判斷）
+#   1. Admission：每個 worker 同時處理的公開請求上限，超過直接 503
+#   2. 每個 LINE userId、每個來源 IP 各一個 token bucket，用完回 429
+# bucket 放在 Mongo（各 worker 共用，TTL 清除）；RATE_LIMIT_STORE=local 時改用記憶體（單一 process）
+# 規則寫法 "容量/秒數"：5/60 = 一次最多 5 個，每 60 秒補滿
+# ----------------------------------------------------------------------------- #
+RATE_LIMIT_ENABLED = os.environ.get("RATE_LIMIT_ENABLED", "1") != "0"
+RATE_LIMIT_STORE = os.environ.get("RATE_LIMIT_STORE", "mongo")
+# 前面有幾層 proxy（Render / Cloudflare）；用來從 X-Forwarded-For 取出真正的來源 IP
+RATE_LIMIT_PROXY_HOPS = int(os.environ.get("RATE_LIMIT_PROXY_HOPS", "1"))
+# gthread worker 同時最多只有 GUNICORN_THREADS 個請求，admission 上限必須小於 threads 才會生效；
+# 未設定時取 threads 扣掉保留給後台 / health check 的 ADMIN_RESERVED_THREADS
+GUNICORN_THREADS = int(os.environ.get("GUNICORN_THREADS", "8"))
+ADMIN_RESERVED_THREADS = int(os.environ.get("ADMIN_RESERVED_THREADS", "2"))
+PUBLIC_MAX_INFLIGHT = int(os.environ.get("PUBLIC_MAX_INFLIGHT") or max(1, GUNICORN_THREADS - ADMIN_RESERVED_THREADS))
+OVERLOAD_RETRY_AFTER_SECS = int(os.environ.get("OVERLOAD_RETRY_AFTER_SECS", "2"))
+
+RATE_LIMITED = metrics.Counter(metrics.registry, "rate_limited_requests_total",
+                               "Requests rejected before handling", ("route", "reason"))
+
+
+def parse_rule(rule: str) -> tuple:
+    cap, _, secs = rule.partition("/")
+    cap, secs = int(cap), float(secs or 1)
+    if cap <= 0 or secs <= 0:
+        raise ValueError(f"不合法的限流規則：{rule}")
+    return cap, cap / secs
+
+
+def client_ip(forwarded_for: str, remote_addr: str, hops: int = RATE_LIMIT_PROXY_HOPS) -> str:
+    # 每層 proxy 都往 X-Forwarded-For 尾端加上它看到的來源；從尾端數 hops 個才是可信的那一筆
+    chain = [p.strip() for p in (forwarded_for or "").split(",") if p.strip()]
+    if hops > 0 and len(chain) >= hops:
+        return chain[-hops]
+    return remote_addr or "unknown"
+
+
+class LocalBucketStore:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    # 取一個 token；回傳 (是否允許, 還要等幾秒)
+    def take(self, key: str, capacity: int, rate: float) -> tuple:
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.get(key, (float(capacity), now))
+            tokens = min(capacity, tokens + (now - last) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > 100_000:
+                # 補滿的 bucket 等同不存在，清掉避免無限成長
+                self._buckets = {k: v for k, v in self._buckets.items()
+                                 if v[0] + (now - v[1]) * rate < capacity}
+        return allowed, 0.0 if allowed else (1 - tokens) / rate
+
+    def indexes(self) -> list:
+        return []
+
+
+class MongoBucketStore:
+    def __init__(self, col):
+        self.col = col
+
+    # (collection, keys, options)；由 migrations 建立
+    def indexes(self) -> list:
+        return [(self.col, [("expireAt", 1)], {"expireAfterSeconds": 0})]
+
+    # 一次 findOneAndUpdate（update pipeline）完成補充與扣除，多個 worker 同時取也不會超發
+    def take(self, key: str, capacity: int, rate: float) -> tuple:
+        now = datetime.utcnow()
+        refill_ms = {"$subtract": [now, {"$ifNull": ["$at", now]}]}
+        refilled = {"$min": [capacity, {"$add": [{"$ifNull": ["$tokens", capacity]},
+                                                 {"$multiply": [refill_ms, rate / 1000]}]}]}
+        doc = self.col.find_one_and_update(
+            {"_id": key},
+            [
+                {"$set": {"tokens": refilled, "at": now,
+                          "expireAt": now + timedelta(seconds=math.ceil(capacity / rate) + 1)}},
+                {"$set": {"allowed": {"$gte": ["$tokens", 1]},
+                          "tokens": {"$cond": [{"$gte": ["$tokens", 1]}, {"$subtract": ["$tokens", 1]}, "$tokens"]}}},
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+            projection={"tokens": 1, "allowed": 1},
+        )
+        if doc["allowed"]:
+            return True, 0.0
+        return False, (1 - doc["tokens"]) / rate
+
+
+# 每個 worker 同時處理的公開請求數；不排隊，滿了就拒絕
+class Admission:
+    def __init__(self, limit: int = PUBLIC_MAX_INFLIGHT):
+        self.limit = limit
+        self.inflight = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+    def try_enter(self) -> bool:
+        with self._lock:
+            if self.limit > 0 and self.inflight >= self.limit:
+                return False
+            self.inflight += 1
+            self.peak = max(self.peak, self.inflight)
+            return True
+
+    def leave(self):
+        with self._lock:
+            self.inflight -= 1
+
+
+class RateLimiter:
+    # rules：{route: {"user": "5/60", "ip": "30/60"}}
+    def __init__(self, store, rules: dict, admission: Admission, enabled: bool = RATE_LIMIT_ENABLED):
+        self.store = store
+        self.rules = {route: {scope: parse_rule(r) for scope, r in per.items() if r}
+                      for route, per in rules.items()}
+        self.admission = admission
+        self.enabled = enabled
+
+    def limited(self, route: str) -> bool:
+        return self.enabled and route in self.rules
+
+    # 回傳 None（放行）或 (status, 訊息, Retry-After 秒數)；放行時已佔用 admission，結束後呼叫 leave()
+    def check(self, route: str, user_id: str = None, ip: str = None):
+        if not self.admission.try_enter():
+            RATE_LIMITED.inc(route=route, reason="overload")
+            return 503, "系統忙碌中，請稍後再試", OVERLOAD_RETRY_AFTER_SECS
+        try:
+            for scope, ident in (("user", user_id), ("ip", ip)):
+                rule = self.rules[route].get(scope)
+                if not rule or not ident:
+                    continue
+                allowed, wait = self.store.take(f"{route}|{scope}:{ident}", *rule)
+                if not allowed:
+                    self.admission.leave()
+                    RATE_LIMITED.inc(route=route, reason=scope)
+                    return 429, "請求過於頻繁，請稍後再試", max(1, math.ceil(wait))
+        except Exception as e:
+            # 限流的儲存出問題時不擋正常請求
+            print(f"[RATELIMIT] {route}: {e}")
+        return None
+
+    def leave(self):
+        self.admission.leave()
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "store": type(self.store).__name__,
+            "inflight": self.admission.inflight,
+            "peakInflight": self.admission.peak,
+            "maxInflight": self.admission.limit,
+            "rules": {route: {scope: {"capacity": cap, "perSec": round(rate, 4)} for scope, (cap, rate) in per.items()}
+                      for route, per in self.rules.items()},
+        }
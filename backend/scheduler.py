@@ -0,0 +1,264 @@
+import heapq
+import os
+import socket
+import threading
+import uuid
+from datetime import datetime, timedelta
+
+from pymongo.errors import PyMongoError
+
+import metrics
+
+# ----------------------------------------------------------------------------- #
+# 提醒排程：不必等外部 cron，到期時間一到就派送
+#   - 只有取得 leader lease 的那個 worker / 節點執行（meta _id = "reminder_scheduler"）
+#   - leader 把 SCHEDULER_HORIZON_SECS 內到期的 (dueAt, _id) 放進 heap，睡到最早的到期時間
+#   - change stream 即時收到新增 / 改期的提醒；不支援 change stream（單機 mongod）時定期重新載入
+#   - 實際派送仍由 ReminderDispatcher 領取（lease token），與 /api/admin/cron/dispatch 並存也不會重複送
+# thread：web worker 內的背景執行緒；external：另外跑 python -m scheduler；off：只靠 cron
+# ----------------------------------------------------------------------------- #
+REMINDER_SCHEDULER = os.environ.get("REMINDER_SCHEDULER", "thread")
+SCHEDULER_LEASE_SECS = int(os.environ.get("SCHEDULER_LEASE_SECS", "30"))
+SCHEDULER_HORIZON_SECS = int(os.environ.get("SCHEDULER_HORIZON_SECS", "21600"))
+SCHEDULER_RELOAD_SECS = int(os.environ.get("SCHEDULER_RELOAD_SECS", "300"))
+SCHEDULER_MAX_LOADED = int(os.environ.get("SCHEDULER_MAX_LOADED", "10000"))
+# 派送失敗退回 scheduled 的提醒，多久後再試
+SCHEDULER_RETRY_SECS = int(os.environ.get("SCHEDULER_RETRY_SECS", "60"))
+SCHEDULER_DEADLINE_SECS = float(os.environ.get("SCHEDULER_DEADLINE_SECS", "25"))
+# change stream 暫時性錯誤（例如 failover 的 NotPrimaryError）重試的退避上限
+SCHEDULER_WATCH_BACKOFF_MAX = float(os.environ.get("SCHEDULER_WATCH_BACKOFF_MAX", "30"))
+LEADER_META_ID = "reminder_scheduler"
+_CHANGE_STREAM_HISTORY_LOST = 286
+# 伺服器不支援 change stream：40573 只支援 replica set、115 CommandNotSupported
+_CHANGE_STREAM_UNSUPPORTED = (40573, 115)
+
+SCHEDULER_RUNS = metrics.Counter(metrics.registry, "reminder_scheduler_runs_total",
+                                 "Reminder dispatch passes started by the in-process scheduler", ("trigger",))
+SCHEDULER_LAG = metrics.Histogram(metrics.registry, "reminder_scheduler_lag_seconds",
+                                  "Delay between a reminder's dueAt and the dispatch pass that picked it up",
+                                  buckets=(0.1, 0.5, 1.0, 2.5, 5.0, 15.0, 60.0, 300.0))
+
+
+class LeaderLease:
+    def __init__(self, meta_col, name: str, lease_secs: int = SCHEDULER_LEASE_SECS):
+        self.meta_col = meta_col
+        self.name = name
+        self.lease_secs = lease_secs
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+    # 取得或續約；回傳自己是否為 leader
+    def acquire(self) -> bool:
+        now = datetime.utcnow()
+        until = now + timedelta(seconds=self.lease_secs)
+        res = self.meta_col.update_one(
+            {"_id": self.name, "$or": [{"owner": self.owner}, {"leaseUntil": {"$lt": now}}]},
+            {"$set": {"owner": self.owner, "leaseUntil": until, "renewedAt": now}},
+        )
+        if res.matched_count:
+            return True
+        if self.meta_col.find_one({"_id": self.name}, {"_id": 1}) is None:
+            self.meta_col.update_one({"_id": self.name},
+                                     {"$setOnInsert": {"owner": self.owner, "leaseUntil": until, "renewedAt": now}},
+                                     upsert=True)
+            doc = self.meta_col.find_one({"_id": self.name}, {"owner": 1}) or {}
+            return doc.get("owner") == self.owner
+        return False
+
+    def release(self):
+        self.meta_col.update_one({"_id": self.name, "owner": self.owner}, {"$set": {"leaseUntil": datetime.utcnow()}})
+
+    def holder(self) -> dict:
+        return self.meta_col.find_one({"_id": self.name}, {"_id": 0}) or {}
+
+
+class ReminderScheduler:
+    # dispatch(deadline_secs) -> stats：與 cron 相同的派送（含提醒結果指標）
+    def __init__(self, col, meta_col, dispatch, autostart: bool = REMINDER_SCHEDULER == "thread"):
+        self.col = col
+        self.dispatch = dispatch
+        self.autostart = autostart
+        self.lease = LeaderLease(meta_col, LEADER_META_ID)
+        self.is_leader = False
+        self.watching = False
+        self._heap = []
+        self._queued = set()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._started = False
+        self._start_lock = threading.Lock()
+        self._last = {}
+
+    def _push(self, due, rid):
+        with self._lock:
+            if (due, rid) in self._queued:
+                return
+            self._queued.add((due, rid))
+            heapq.heappush(self._heap, (due, rid))
+        self._wake.set()
+
+    def _pop_due(self, now) -> list:
+        out = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                item = heapq.heappop(self._heap)
+                self._queued.discard(item)
+                out.append(item)
+        return out
+
+    def _next_due(self):
+        with self._lock:
+            return self._heap[0][0] if self._heap else None
+
+    # 重新載入 horizon 內的到期時間；也把 lease 過期的 sending 排到 lease 到期時
+    def reload(self):
+        horizon = datetime.utcnow() + timedelta(seconds=SCHEDULER_HORIZON_SECS)
+        cur = self.col.find({"status": "scheduled", "dueAt": {"$lte": horizon}}, {"dueAt": 1}) \
+            .sort("dueAt", 1).limit(SCHEDULER_MAX_LOADED)
+        items = [(d["dueAt"], d["_id"]) for d in cur]
+        items += [(d["leaseUntil"], d["_id"]) for d in
+                  self.col.find({"status": "sending", "leaseUntil": {"$lte": horizon}}, {"leaseUntil": 1})
+                  .limit(SCHEDULER_MAX_LOADED)]
+        with self._lock:
+            self._heap = items
+            heapq.heapify(self._heap)
+            self._queued = set(items)
+        self._wake.set()
+
+    # change stream 收到的提醒：scheduled 依 dueAt；失敗退回的延後 SCHEDULER_RETRY_SECS
+    def _on_change(self, doc: dict):
+        if not doc or doc.get("status") != "scheduled" or not doc.get("dueAt"):
+            return
+        due = doc["dueAt"]
+        if doc.get("attempts"):
+            due = max(due, datetime.utcnow() + timedelta(seconds=SCHEDULER_RETRY_SECS))
+        if due <= datetime.utcnow() + timedelta(seconds=SCHEDULER_HORIZON_SECS):
+            self._push(due, doc["_id"])
+
+    def _watch(self):
+        pipeline = [{"$match": {"operationType": {"$in": ["insert", "update", "replace"]}}}]
+        resume = None
+        backoff = 1.0
+        while not self._stop.is_set() and self.is_leader:
+            try:
+                with self.col.watch(pipeline, full_document="updateLookup", resume_after=resume,
+                                    max_await_time_ms=1000) as stream:
+                    self.watching = True
+                    backoff = 1.0
+                    while stream.alive and not self._stop.is_set() and self.is_leader:
+                        change = stream.try_next()
+                        if change is not None:
+                            self._on_change(change.get("fullDocument"))
+                        resume = stream.resume_token
+            except PyMongoError as e:
+                self.watching = False
+                if getattr(e, "code", None) == _CHANGE_STREAM_HISTORY_LOST:
+                    # resume token 已超出 oplog：重新載入後從現在開始監看
+                    resume = None
+                    self.reload()
+                    continue
+                if getattr(e, "code", None) in _CHANGE_STREAM_UNSUPPORTED:
+                    # 單機 mongod 等不支援 change stream：退回定期重新載入
+                    print(f"[SCHEDULER] change stream 停止：{e}")
+                    return
+                # failover、網路中斷等暫時性錯誤：退避後從上次的 resume token 接續
+                print(f"[SCHEDULER] change stream 中斷，{backoff:.0f} 秒後重試：{e}")
+                self._stop.wait(backoff)
+                backoff = min(backoff * 2, SCHEDULER_WATCH_BACKOFF_MAX)
+            except Exception as e:
+                print(f"[SCHEDULER] change stream 不可用：{e}")
+                self.watching = False
+                return
+        self.watching = False
+
+    def _lead(self):
+        self.reload()
+        watcher = threading.Thread(target=self._watch, name="scheduler-watch", daemon=True)
+        watcher.start()
+        renew_every = self.lease.lease_secs / 3
+        last_renew = last_reload = datetime.utcnow()
+        while not self._stop.is_set():
+            now = datetime.utcnow()
+            if (now - last_renew).total_seconds() >= renew_every:
+                if not self.lease.acquire():
+                    print("[SCHEDULER] lease 被其他 worker 取得，轉為待命")
+                    return
+                last_renew = now
+            reload_every = SCHEDULER_RELOAD_SECS if self.watching else min(SCHEDULER_RELOAD_SECS, 60)
+            if (now - last_reload).total_seconds() >= reload_every:
+                self.reload()
+                last_reload = now
+            due = self._pop_due(now)
+            if due:
+                self._run(due, now)
+                continue
+            nxt = self._next_due()
+            timeout = renew_every
+            if nxt is not None:
+                timeout = min(timeout, max(0.0, (nxt - now).total_seconds()))
+            self._wake.wait(timeout)
+            self._wake.clear()
+
+    def _run(self, due: list, now):
+        SCHEDULER_RUNS.inc(trigger="timer")
+        for d, _rid in due:
+            SCHEDULER_LAG.observe(max(0.0, (now - d).total_seconds()))
+        try:
+            stats = self.dispatch(SCHEDULER_DEADLINE_SECS)
+            self._last = {"at": now, "due": len(due), **stats}
+        except Exception as e:
+            print(f"[SCHEDULER] dispatch error: {e}")
+            # 派送失敗（例如 Mongo 暫時斷線）：稍後再試
+            retry = now + timedelta(seconds=SCHEDULER_RETRY_SECS)
+            for _d, rid in due:
+                self._push(retry, rid)
+
+    def run_forever(self):
+        while not self._stop.is_set():
+            try:
+                self.is_leader = self.lease.acquire()
+                if self.is_leader:
+                    self._lead()
+            except Exception as e:
+                print(f"[SCHEDULER] error: {e}")
+            self.is_leader = False
+            self._stop.wait(self.lease.lease_secs / 2)
+
+    # 第一個請求時在目前的（已 fork 的）worker 啟動；同一時間只有 leader 真正排程
+    def start(self):
+        if self._started:
+            return
+        with self._start_lock:
+            if self._started:
+                return
+            threading.Thread(target=self.run_forever, name="reminder-scheduler", daemon=True).start()
+            self._started = True
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self.is_leader:
+            self.lease.release()
+
+    def stats(self) -> dict:
+        with self._lock:
+            loaded = len(self._heap)
+            nxt = self._heap[0][0] if self._heap else None
+        return {
+            "mode": REMINDER_SCHEDULER,
+            "started": self._started,
+            "leader": self.is_leader,
+            "owner": self.lease.owner,
+            "holder": self.lease.holder(),
+            "watching": self.watching,
+            "loaded": loaded,
+            "nextDueAt": nxt,
+            "last": self._last,
+        }
+
+
+if __name__ == "__main__":
+    # 獨立執行：python -m scheduler（在 backend/ 目錄下）
+    import app as _app
+    print(f"[SCHEDULER] started, owner={_app.reminder_scheduler.lease.owner}")
+    _app.reminder_scheduler.run_forever()
@@ -0,0 +1,53 @@
+import re
+
+# 顧客搜尋鍵：
+# - 英數字：小寫後的單字，查詢時以前綴（^）比對，可走索引
+# - 中日韓文字：單字 + 相鄰兩字（bigram），查詢時要求關鍵字的所有 bigram 都存在
+# - 電話：只留數字存在 phoneDigits，查詢時以前綴比對
+_WORD_RE = re.compile(r"[a-z0-9]+")
+_CJK_RE = re.compile(r"[㐀-䶿一-鿿豈-﫿぀-ヿ가-힯]+")
+SEARCH_FIELDS = ("name", "nickname", "lineDisplayName")
+
+
+def text_keys(text) -> list:
+    if not text or not isinstance(text, str):
+        return []
+    s = text.strip().lower()
+    keys = set(_WORD_RE.findall(s))
+    for run in _CJK_RE.findall(s):
+        keys.update(run)
+        keys.update(run[i:i + 2] for i in range(len(run) - 1))
+    return sorted(keys)
+
+
+def phone_digits(phone) -> str:
+    return re.sub(r"\D", "", phone or "") if isinstance(phone, str) else ""
+
+
+def customer_keys(doc: dict) -> dict:
+    keys = set()
+    for f in SEARCH_FIELDS:
+        keys.update(text_keys(doc.get(f)))
+    return {"searchKeys": sorted(keys), "phoneDigits": phone_digits(doc.get("phone"))}
+
+
+# 回傳 Mongo 查詢條件；關鍵字沒有可搜尋的字元時回傳 None
+def customer_query(keyword: str):
+    kw = (keyword or "").strip().lower()
+    if not kw:
+        return {}
+    compact = re.sub(r"[\s\-()+]", "", kw)
+    if compact.isdigit():
+        return {"phoneDigits": {"$regex": "^" + compact}}
+
+    conds = []
+    for word in _WORD_RE.findall(kw):
+        conds.append({"searchKeys": {"$regex": "^" + re.escape(word)}})
+    for run in _CJK_RE.findall(kw):
+        if len(run) == 1:
+            conds.append({"searchKeys": run})
+        else:
+            conds.append({"searchKeys": {"$all": [run[i:i + 2] for i in range(len(run) - 1)]}})
+    if not conds:
+        return None
+    return conds[0] if len(conds) == 1 else {"$and": conds}
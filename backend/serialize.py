@@ -0,0 +1,124 @@
+import gzip
+import os
+from datetime import datetime, timezone
+
+from bson import ObjectId
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # 沒裝 orjson 時沿用 Flask 內建的 json
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# 回應序列化：orjson 直接處理 ObjectId / datetime；後台的大回應視 Accept-Encoding 壓縮
+COMPRESS_MIN_BYTES = int(os.environ.get("COMPRESS_MIN_BYTES", "4096"))
+COMPRESS_LEVEL = int(os.environ.get("COMPRESS_LEVEL", "5"))
+
+
+def _default(o):
+    if isinstance(o, ObjectId):
+        return str(o)
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    # naive datetime 一律視為 UTC（與 _iso_or_none 相同輸出 +00:00）
+    _OPTS = (orjson.OPT_NAIVE_UTC | orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS) if orjson else 0
+
+    def dumps(self, obj, **kwargs) -> str:
+        return orjson.dumps(obj, default=_default, option=self._OPTS).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, default=_default, option=self._OPTS), mimetype=self.mimetype)
+
+
+class BsonJSONProvider(DefaultJSONProvider):
+    @staticmethod
+    def default(o):
+        if isinstance(o, ObjectId):
+            return str(o)
+        if isinstance(o, datetime):
+            return (o if o.tzinfo else o.replace(tzinfo=timezone.utc)).isoformat()
+        return DefaultJSONProvider.default(o)
+
+
+def json_provider_class():
+    return OrjsonProvider if orjson else BsonJSONProvider
+
+
+# UTC -> 當地時間：時區沒有日光節約（例如 Asia/Taipei）時直接用固定 offset，
+# 不必每個欄位都查 zoneinfo；有日光節約的時區退回 astimezone
+class LocalClock:
+    def __init__(self, tz):
+        self.tz = tz
+        year = datetime.utcnow().year
+        offsets = {tz.utcoffset(datetime(year, m, 1)) for m in (1, 4, 7, 10)}
+        self.fixed = timezone(offsets.pop(), tz.key if hasattr(tz, "key") else None) if len(offsets) == 1 else None
+
+    def local(self, dt_utc_naive):
+        if not dt_utc_naive:
+            return None
+        if dt_utc_naive.tzinfo is not None:
+            dt_utc_naive = dt_utc_naive.astimezone(timezone.utc).replace(tzinfo=None)
+        if self.fixed is not None:
+            return (dt_utc_naive + self.fixed.utcoffset(None)).replace(tzinfo=self.fixed)
+        return dt_utc_naive.replace(tzinfo=timezone.utc).astimezone(self.tz)
+
+    def local_iso(self, dt_utc_naive):
+        dt = self.local(dt_utc_naive)
+        return dt.isoformat() if dt else None
+
+
+def utc_iso(dt):
+    if not dt:
+        return None
+    if dt.tzinfo is None:
+        return dt.isoformat() + "+00:00"
+    return dt.isoformat()
+
+
+def _accepted(accept_encoding: str) -> set:
+    out = set()
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        if params.strip().replace(" ", "") in ("q=0", "q=0.0"):
+            continue
+        out.add(name.strip().lower())
+    return out
+
+
+# after_request 用：JSON 回應超過門檻且用戶端接受時壓縮（優先 br）
+def compress_response(resp, accept_encoding: str):
+    if (resp.direct_passthrough or resp.is_streamed or resp.status_code < 200 or resp.status_code in (204, 304)
+            or "Content-Encoding" in resp.headers or resp.mimetype != "application/json"):
+        return resp
+    body = resp.get_data()
+    if len(body) < COMPRESS_MIN_BYTES:
+        return resp
+    accepted = _accepted(accept_encoding or "")
+    if brotli and "br" in accepted:
+        data, enc = brotli.compress(body, quality=COMPRESS_LEVEL), "br"
+    elif "gzip" in accepted:
+        data, enc = gzip.compress(body, compresslevel=COMPRESS_LEVEL, mtime=0), "gzip"
+    else:
+        return resp
+    resp.set_data(data)
+    resp.headers["Content-Encoding"] = enc
+    resp.vary.add("Accept-Encoding")
+    if resp.headers.get("ETag"):
+        # 壓縮後內容不同，ETag 改為弱比對
+        tag, weak = resp.get_etag()
+        if tag and not weak:
+            resp.set_etag(tag, weak=True)
+    return resp
+
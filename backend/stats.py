@@ -0,0 +1,273 @@
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from itertools import chain
+
+from bson import ObjectId
+from pymongo import UpdateOne
+
+from scheduler import LeaderLease
+
+# 營收 / 來店統計的預先彙總（stats_rollups）：每筆 _id = "<kind>:<key>"
+#   total            全部
+#   day:YYYY-MM-DD   依消費日期（已確認預約依確認後的當地開始日）
+#   month:YYYY-MM
+#   service:<名稱>   消費紀錄的項目；預約的 serviceIds 換成服務名稱後計入同一筆
+#   customer:<id>    customerId，沒有的話 "user:<userId>"
+# 欄位：revenue / visits（消費紀錄）、bookingsConfirmed（預約確認）、firstVisit / lastVisit
+# 消費金額是整筆紀錄的金額，無法拆到各項目，所以 service 只累計次數不累計營收
+KINDS = ("total", "day", "month", "service", "customer")
+# 重建期間 meta _id = "stats_rebuild" 記錄分界時間；lease 過期視為重建已中止，寫入端不再同步寫暫存 collection
+STATS_REBUILD_LEASE_SECS = int(os.environ.get("STATS_REBUILD_LEASE_SECS", "1800"))
+# 分界時間比重建開始晚幾秒，涵蓋各 worker 之間的時鐘誤差與尚未寫完的請求
+STATS_REBUILD_GRACE_SECS = float(os.environ.get("STATS_REBUILD_GRACE_SECS", "2"))
+REBUILD_META_ID = "stats_rebuild"
+
+
+def customer_key(rec: dict):
+    if rec.get("customerId"):
+        return str(rec["customerId"])
+    if rec.get("userId"):
+        return f"user:{rec['userId']}"
+    return None
+
+
+def _keys(kind_keys: list) -> list:
+    return [(f"{kind}:{key}" if key is not None else kind, kind, key) for kind, key in kind_keys]
+
+
+class StatsRollup:
+    # read_col：後台查詢用（可指向 secondary），寫入與重建一律走 col
+    def __init__(self, col, tz, meta_col, read_col=None, grace_secs: float = STATS_REBUILD_GRACE_SECS):
+        self.col = col
+        self.tz = tz
+        self.meta_col = meta_col
+        self.read_col = read_col if read_col is not None else col
+        self.staging = col.database[f"{col.name}_rebuild"]
+        self.grace_secs = grace_secs
+        self.lease = LeaderLease(meta_col, REBUILD_META_ID, STATS_REBUILD_LEASE_SECS)
+
+    # (collection, keys, options)；由 migrations 建立
+    def indexes(self) -> list:
+        return [
+            (self.col, [("kind", 1), ("key", 1)], {}),
+            (self.col, [("kind", 1), ("revenue", -1)], {}),
+        ]
+
+    def _op(self, _id: str, kind: str, key, inc: dict, date: str = None, now=None) -> UpdateOne:
+        update = {
+            "$inc": inc,
+            "$set": {"updatedAt": now or datetime.utcnow()},
+            "$setOnInsert": {"kind": kind, "key": key},
+        }
+        if date:
+            update["$min"] = {"firstVisit": date}
+            update["$max"] = {"lastVisit": date}
+        return UpdateOne({"_id": _id}, update, upsert=True)
+
+    def _visit_ops(self, rec: dict, now=None) -> list:
+        date = rec.get("date")
+        if not date:
+            return []
+        inc = {"revenue": int(rec.get("amount") or 0), "visits": 1}
+        ck = customer_key(rec)
+        targets = [("total", None), ("day", date), ("month", date[:7])] + ([("customer", ck)] if ck else [])
+        ops = [self._op(_id, kind, key, inc, date, now) for _id, kind, key in _keys(targets)]
+        items = {i.strip() for i in rec.get("items") or [] if isinstance(i, str) and i.strip()}
+        ops += [self._op(_id, kind, key, {"visits": 1}, date, now)
+                for _id, kind, key in _keys([("service", i) for i in sorted(items)])]
+        return ops
+
+    # 進行中的重建分界時間；沒有重建（或 lease 已過期）回傳 None
+    def rebuild_boundary(self):
+        state = self.meta_col.find_one({"_id": REBUILD_META_ID, "leaseUntil": {"$gt": datetime.utcnow()}},
+                                       {"boundary": 1}) or {}
+        return state.get("boundary")
+
+    # 新增一筆消費紀錄；重建進行中且紀錄不在 pipeline 範圍內（_id 晚於分界）時同時記到暫存 collection
+    def record_visit(self, rec: dict):
+        ops = self._visit_ops(rec)
+        if not ops:
+            return
+        boundary = self.rebuild_boundary()
+        self.col.bulk_write(ops, ordered=False)
+        _id = rec.get("_id")
+        if boundary and isinstance(_id, ObjectId) and _id >= ObjectId.from_datetime(boundary):
+            self.staging.bulk_write(ops, ordered=False)
+
+    def _confirmation_ops(self, delta: dict, now) -> list:
+        return [self._op(_id, kind, key, {"bookingsConfirmed": n}, now=now)
+                for (_id, kind, key), n in zip(_keys(list(delta)), delta.values()) if n]
+
+    # 確認預約時一併寫進 booking 的欄位；now 要在讀 boundary 之前取得
+    # 分界之後第一次確認時留下確認前的狀態（statsBase），重建的 pipeline 依它計算，
+    # 不論 pipeline 掃到這筆預約時確認了沒有，結果都是分界當下的狀態
+    @staticmethod
+    def confirmation_fields(b: dict, now, boundary) -> dict:
+        fields = {"confirmedAt": now}
+        if boundary and now >= boundary and not (b.get("confirmedAt") and b["confirmedAt"] >= boundary):
+            fields["statsBase"] = {"status": b.get("status"), "finalStartAt": b.get("finalStartAt")}
+        return fields
+
+    # items：[(booking 原始資料, 確認後的當地開始時間, 服務名稱清單)]；confirmed_at：這次寫入 booking 的 confirmedAt
+    # 第一次確認 +1；已確認的改時間則把日 / 月的計數移到新日期
+    # 重建進行中且 confirmedAt 晚於分界：同樣的增減也寫進暫存 collection
+    def record_confirmations(self, items: list, confirmed_at=None):
+        now = datetime.utcnow()
+        delta = {}
+        for b, start_local, names in items:
+            day = start_local.astimezone(self.tz).strftime("%Y-%m-%d")
+            targets = [("day", day), ("month", day[:7])]
+            if b.get("status") == "confirmed" and b.get("finalStartAt"):
+                old_day = b["finalStartAt"].replace(tzinfo=timezone.utc).astimezone(self.tz).strftime("%Y-%m-%d")
+                for t in (("day", old_day), ("month", old_day[:7])):
+                    delta[t] = delta.get(t, 0) - 1
+            elif b.get("status") == "pending":
+                targets += [("total", None)] + [("service", n) for n in names]
+            else:
+                continue
+            for t in targets:
+                delta[t] = delta.get(t, 0) + 1
+        ops = [self._op(_id, kind, key, {"bookingsConfirmed": n}, now=now)
+               for (_id, kind, key), n in zip(_keys(list(delta)), delta.values()) if n]
+        if not ops:
+            return
+        boundary = self.rebuild_boundary()
+        self.col.bulk_write(ops, ordered=False)
+        if boundary and (confirmed_at or now) >= boundary:
+            self.staging.bulk_write(ops, ordered=False)
+
+    def get(self, kind: str, key: str = None) -> dict:
+        return self.read_col.find_one({"_id": f"{kind}:{key}" if key is not None else kind}) or {}
+
+    # 依 key 範圍（day / month）或依營收排序（service / customer）取一段
+    def range(self, kind: str, lo: str = None, hi: str = None, limit: int = 100, by_revenue: bool = False) -> list:
+        q = {"kind": kind}
+        if lo or hi:
+            q["key"] = {**({"$gte": lo} if lo else {}), **({"$lte": hi} if hi else {})}
+        sort = [("revenue", -1), ("key", 1)] if by_revenue else [("key", 1)]
+        return list(self.read_col.find(q, {"_id": 0}).sort(sort).limit(limit))
+
+    # 以 aggregation pipeline 由 hair_records / bookings 重新計算全部彙總
+    # 傳入多個 collection（hot 與 archive）時各自彙總後相加
+    # 結果先寫進暫存 collection 再 rename 覆蓋，重建期間查詢仍讀得到舊的彙總
+    # pipeline 只算分界之前的消費紀錄（_id）與分界當下的預約狀態；分界之後的增減由 record_visit /
+    # record_confirmations 在重建期間同時寫進暫存 collection，rename 之後不必再補記
+    def rebuild(self, hair_records_cols: list, bookings_cols: list, service_names) -> dict:
+        if not self.lease.acquire():
+            return {"skipped": "另一個重建正在進行"}
+        try:
+            self.staging.drop()
+            for _col, keys, opts in self.indexes():
+                self.staging.create_index(keys, **opts)
+            # 分界取整秒（ObjectId 只到秒）；之後才開始的寫入一定看得到 boundary
+            boundary = (datetime.utcnow() + timedelta(seconds=self.grace_secs + 1)).replace(microsecond=0)
+            self.meta_col.update_one({"_id": REBUILD_META_ID, "owner": self.lease.owner},
+                                     {"$set": {"boundary": boundary}})
+            # 等分界之前開始的寫入完成，pipeline 才讀得到
+            time.sleep(max(0.0, (boundary - datetime.utcnow()).total_seconds()) + self.grace_secs)
+            docs = self._aggregate(hair_records_cols, bookings_cols, service_names, boundary)
+            if docs:
+                self.staging.bulk_write([self._merge_op(d) for d in docs.values()], ordered=False)
+            self._swap()
+            return {"rollups": len(docs), "boundary": boundary}
+        finally:
+            self.meta_col.update_one({"_id": REBUILD_META_ID, "owner": self.lease.owner},
+                                     {"$unset": {"boundary": ""}})
+            self.lease.release()
+
+    # 重建期間寫入端已同步記到暫存 collection 的文件，用 $inc / $min / $max 併入
+    def _merge_op(self, d: dict) -> UpdateOne:
+        counters = {f: d[f] for f in ("revenue", "visits", "bookingsConfirmed") if f in d}
+        update = {"$set": {"updatedAt": d["updatedAt"]}, "$setOnInsert": {"kind": d["kind"], "key": d["key"]}}
+        if counters:
+            update["$inc"] = counters
+        if "firstVisit" in d:
+            update["$min"] = {"firstVisit": d["firstVisit"]}
+        if "lastVisit" in d:
+            update["$max"] = {"lastVisit": d["lastVisit"]}
+        return UpdateOne({"_id": d["_id"]}, update, upsert=True)
+
+    def _swap(self):
+        self.staging.rename(self.col.name, dropTarget=True)
+
+    def _aggregate(self, hair_records_cols: list, bookings_cols: list, service_names, boundary) -> dict:
+        now = datetime.utcnow()
+        docs = {}
+
+        def add(kind, key, values: dict):
+            _id = f"{kind}:{key}" if key is not None else kind
+            d = docs.setdefault(_id, {"_id": _id, "kind": kind, "key": key, "updatedAt": now})
+            for f, v in values.items():
+                if v is None:
+                    continue
+                if f == "firstVisit":
+                    d[f] = min(d.get(f, v), v)
+                elif f == "lastVisit":
+                    d[f] = max(d.get(f, v), v)
+                else:
+                    d[f] = d.get(f, 0) + v
+
+        visit_group = {"revenue": {"$sum": {"$ifNull": ["$amount", 0]}}, "visits": {"$sum": 1},
+                       "firstVisit": {"$min": "$date"}, "lastVisit": {"$max": "$date"}}
+        has_date = {"$match": {"_id": {"$lt": ObjectId.from_datetime(boundary)}, "date": {"$type": "string"}}}
+        pipelines = {
+            # 月與總計由日彙總再加總，不必再掃一次
+            "day": [has_date, {"$group": {"_id": "$date", **visit_group}}],
+            "customer": [has_date, {"$group": {"_id": {"c": "$customerId", "u": "$userId"}, **visit_group}}],
+            # 與 record_visit 相同：同一筆紀錄重複的項目只算一次
+            "service": [has_date, {"$unwind": "$items"}, {"$match": {"items": {"$type": "string"}}},
+                        {"$group": {"_id": {"r": "$_id", "i": {"$trim": {"input": "$items"}}},
+                                    "date": {"$first": "$date"}}},
+                        {"$group": {"_id": "$_id.i", "visits": {"$sum": 1},
+                                    "firstVisit": {"$min": "$date"}, "lastVisit": {"$max": "$date"}}}],
+        }
+        for kind, pipeline in pipelines.items():
+            for g in chain.from_iterable(col.aggregate(pipeline, allowDiskUse=True) for col in hair_records_cols):
+                values = {f: g.get(f) for f in ("revenue", "visits", "firstVisit", "lastVisit")}
+                if kind == "day":
+                    for k, key in (("day", g["_id"]), ("month", g["_id"][:7]), ("total", None)):
+                        add(k, key, values)
+                elif kind == "customer":
+                    ck = customer_key({"customerId": g["_id"].get("c"), "userId": g["_id"].get("u")})
+                    if ck:
+                        add("customer", ck, values)
+                elif kind == "service":
+                    name = g["_id"].strip() if isinstance(g["_id"], str) else ""
+                    if name:
+                        add("service", name, values)
+
+        # 分界之後確認過的預約改用 statsBase（分界當下的狀態）
+        confirmed = [
+            {"$match": {"$or": [
+                {"confirmedAt": {"$not": {"$gte": boundary}}, "status": "confirmed", "finalStartAt": {"$type": "date"}},
+                {"confirmedAt": {"$gte": boundary}, "statsBase.status": "confirmed",
+                 "statsBase.finalStartAt": {"$type": "date"}},
+            ]}},
+            {"$addFields": {"finalStartAt": {
+                "$cond": [{"$gte": ["$confirmedAt", boundary]}, "$statsBase.finalStartAt", "$finalStartAt"]}}},
+        ]
+        local_day = {"$dateToString": {"format": "%Y-%m-%d", "date": "$finalStartAt", "timezone": str(self.tz)}}
+        counts = {}
+        for bookings_col in bookings_cols:
+            for g in bookings_col.aggregate(confirmed + [{"$group": {"_id": local_day, "n": {"$sum": 1}}}],
+                                            allowDiskUse=True):
+                add("day", g["_id"], {"bookingsConfirmed": g["n"]})
+                add("month", g["_id"][:7], {"bookingsConfirmed": g["n"]})
+                add("total", None, {"bookingsConfirmed": g["n"]})
+            by_sid = bookings_col.aggregate(
+                confirmed + [{"$unwind": "$serviceIds"}, {"$group": {"_id": "$serviceIds", "n": {"$sum": 1}}}],
+                allowDiskUse=True)
+            for g in by_sid:
+                counts[g["_id"]] = counts.get(g["_id"], 0) + g["n"]
+        names = service_names(list(counts))
+        for sid, n in counts.items():
+            if names.get(sid):
+                add("service", names[sid], {"bookingsConfirmed": n})
+
+        return docs
+
+if __name__ == "__main__":
+    # 重新計算：python -m stats（在 backend/ 目錄下）
+    import app as _app
+    print(f"[STATS] {_app.rebuild_stats()}")
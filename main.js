@@ -54,6 +54,7 @@
     });
 
     bookingForm.addEventListener('submit', onSubmitBooking);
+    datePicker.addEventListener('change', () => loadAvailability(datePicker.value));
 
     priceListButton.addEventListener('click', () => priceListModal.classList.remove('hidden'));
     closeModalButton.addEventListener('click',  () => priceListModal.classList.add('hidden'));
@@ -119,6 +120,33 @@
     }
   }
 
+  // --- 可預約時段：已被佔用的時段設為不可選 ---
+  function toMinutes(hm) {
+    const [h, m] = hm.split(':').map(Number);
+    return h * 60 + m;
+  }
+
+  async function loadAvailability(dateVal) {
+    const options = Array.from(timeSelect.options).filter(o => o.value);
+    options.forEach(o => { o.disabled = false; });
+    if (!dateVal) return;
+    try {
+      const res = await fetch(`${BACKEND_BASE_URL}/api/availability?from=${dateVal}&to=${dateVal}`);
+      if (!res.ok) return;
+      const data = await res.json();
+      const busy = (data.busy && data.busy[dateVal]) || [];
+      const hold = data.holdMins || 60;
+      options.forEach(o => {
+        const start = toMinutes(o.value);
+        o.disabled = busy.some(([b, e]) => start < toMinutes(e) && start + hold > toMinutes(b));
+      });
+      if (timeSelect.selectedOptions[0] && timeSelect.selectedOptions[0].disabled) timeSelect.value = '';
+    } catch (err) {
+      // 查不到時段不影響送出，後端仍會檢查
+      console.warn('[Availability] 讀取失敗：', err);
+    }
+  }
+
   async function onSubmitBooking(e) {
     e.preventDefault();
     const submitButton = e.target.querySelector('button[type="submit"]');
@@ -173,17 +201,41 @@
     };
   }
 
+  // 同樣內容重送時沿用同一個 Idempotency-Key，後端直接回傳第一次的結果
+  let lastBooking = null;
+  function idempotencyKeyFor(body) {
+    if (!lastBooking || lastBooking.body !== body) {
+      const key = (window.crypto && crypto.randomUUID) ? crypto.randomUUID()
+        : `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`;
+      lastBooking = { body, key };
+    }
+    return lastBooking.key;
+  }
+
+  async function postBooking(body, key, signal) {
+    return fetch(`${BACKEND_BASE_URL}/api/bookings`, {
+      method: 'POST',
+      headers: {'Content-Type': 'application/json', 'Accept': 'application/json', 'Idempotency-Key': key},
+      body,
+      signal
+    });
+  }
+
   async function submitBooking(payload) {
     const ctrl = new AbortController();
     const timeout = setTimeout(() => ctrl.abort(), 15000); // 15s
+    const body = JSON.stringify(payload);
+    const key = idempotencyKeyFor(body);
 
     try {
-      const res = await fetch(`${BACKEND_BASE_URL}/api/bookings`, {
-        method: 'POST',
-        headers: {'Content-Type': 'application/json', 'Accept': 'application/json'},
-        body: JSON.stringify(payload),
-        signal: ctrl.signal
-      });
+      let res;
+      try {
+        res = await postBooking(body, key, ctrl.signal);
+      } catch (err) {
+        // 網路中斷（不是逾時）：帶同一個 key 自動重送一次
+        if (err.name === 'AbortError') throw err;
+        res = await postBooking(body, key, ctrl.signal);
+      }
       if (!res.ok) {
         const errorData = await res.json().catch(() => ({}));
         const msg = errorData.error || `伺服器發生錯誤 (${res.status})，請稍後再試。`;